@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""
+Compare the database size, load time and publish read time of items stored
+as plain text and compressed with --compress
+usage: python3 -m benchmarks.bench_compress [--entries N] [--feed FILE ...]
+                                            [--directory DIR]
+
+The corpus is a synthetic feed of --entries articles with realistic HTML
+bodies, see bench_ingest, and the recorded feeds (by default the ones in
+tests/fixtures/feeds), converted to items once. The items are then loaded
+into a new database file per storage format, and read back the way
+publish_items reads them.
+"""
+
+import argparse, glob, os, tempfile, time
+import feedparser
+from sh_feeder.sh_feeder import (
+    Feed,
+    FeedItem,
+    connect_db,
+    decompress_item,
+    parse_args,
+    queued_items,
+)
+from benchmarks.bench_ingest import RECORDED, make_feed
+
+
+def corpus(entries, files):
+    """
+    returns the FeedItems of a synthetic feed and of the recorded feeds
+    """
+    items = []
+    for data in [make_feed(entries)] + files:
+        for e in feedparser.parse(data)["entries"]:
+            items.append(FeedItem(e, category_tags=True))
+    return items
+
+
+def bench(directory, name, items, compress):
+    """
+    load the items into a new database, returns its size in bytes and the
+    microseconds per item to load and to read them back
+    """
+    file = os.path.join(directory, "%s.db" % name)
+    conn = connect_db(file)
+    feed = Feed(feed_id="bench", parsed={"entries": []}, compress=compress)
+    feed.items = items
+    start = time.perf_counter()
+    feed.load_db(conn)
+    load = time.perf_counter() - start
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = os.path.getsize(file)
+    args = parse_args(
+        "--feed-id bench --feed-url URL --pod-url POD --token TOKEN --full".split()
+    )
+    start = time.perf_counter()
+    for row in queued_items(conn, args):
+        decompress_item(row)["body"]
+    read = time.perf_counter() - start
+    conn.close()
+    return size, load / len(items) * 1e6, read / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--entries", help="Entries in the synthetic feed", type=int, default=2000
+    )
+    parser.add_argument(
+        "--feed",
+        help="A recorded feed file to add to the corpus. May be specified \
+            multiple times (default: the test fixtures)",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--directory",
+        help="Where to create the benchmark databases (default: a temp dir)",
+    )
+    args = parser.parse_args()
+    files = []
+    for file in args.feed or sorted(glob.glob(os.path.join(RECORDED, "*.xml"))):
+        with open(file, "rb") as fh:
+            files.append(fh.read())
+    items = corpus(args.entries, files)
+    text = sum(
+        len((i.body or "").encode()) + len((i.summary or "").encode()) for i in items
+    )
+    print("%s items, %.1f MB of body and summary text" % (len(items), text / 1e6))
+    print(
+        "%-8s\t%12s\t%8s\t%12s\t%12s"
+        % ("", "bytes", "ratio", "load us/item", "read us/item")
+    )
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        plain = None
+        for name, compress in (("plain", False), ("zlib", True)):
+            size, load, read = bench(directory, name, items, compress)
+            plain = plain or size
+            print(
+                "%-8s\t%12s\t%8.2f\t%12.1f\t%12.1f"
+                % (name, size, plain / size, load, read)
+            )
+
+
+if __name__ == "__main__":
+    main()
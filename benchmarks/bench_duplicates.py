@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+Time find_duplicate() against a large fingerprints table, and simhash() on an
+article-sized text
+usage: python3 -m benchmarks.bench_duplicates [--items N] [--directory DIR]
+"""
+
+import argparse, os, random, tempfile, time
+from sh_feeder.sh_feeder import (
+    connect_db,
+    find_duplicate,
+    simhash,
+    simhash_bands,
+)
+
+
+def fill(conn, items, feeds=500):
+    """
+    insert items posted items with random fingerprints, returns the
+    fingerprints
+    """
+    now = int(time.time())
+    rng = random.Random(0)
+    fingerprints = [rng.getrandbits(64) - 2**63 for n in range(items)]
+    with conn:
+        conn.executemany(
+            "INSERT INTO feeds(guid, feed_id, posted, timestamp, simhash) \
+            VALUES(?, ?, 1, ?, ?)",
+            (
+                ("https://example.com/%s" % n, "feed%s" % (n % feeds), now, f)
+                for n, f in enumerate(fingerprints)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO fingerprints(band, guid) VALUES(?, ?)",
+            (
+                (band, "https://example.com/%s" % n)
+                for n, f in enumerate(fingerprints)
+                for band in simhash_bands(f)
+            ),
+        )
+    return fingerprints
+
+
+def bench(func, runs):
+    """
+    returns the mean milliseconds per call of func(n)
+    """
+    start = time.perf_counter()
+    for n in range(runs):
+        func(n)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", help="Fingerprinted items", type=int, default=500000)
+    parser.add_argument(
+        "--directory",
+        help="Where to create the benchmark database (default: a temp dir)",
+    )
+    args = parser.parse_args()
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        conn = connect_db(os.path.join(directory, "duplicates.db"))
+        start = time.perf_counter()
+        fingerprints = fill(conn, args.items)
+        print("%s items in %.1fs" % (args.items, time.perf_counter() - start))
+        # near-duplicates of stored items, 2 bits off, and new fingerprints
+        near = [
+            fingerprints[rng.randrange(args.items)] ^ (1 << rng.randrange(63)) ^ 1
+            for n in range(1000)
+        ]
+        new = [rng.getrandbits(64) - 2**63 for n in range(1000)]
+        results = [
+            (
+                "near-duplicate",
+                bench(lambda n: find_duplicate(conn, "x", near[n], 1), 1000),
+            ),
+            ("new", bench(lambda n: find_duplicate(conn, "x", new[n], 1), 1000)),
+        ]
+        conn.close()
+    words = [" word%s" % rng.randrange(5000) for n in range(1000)]
+    results.append(
+        ("simhash, 1000 words", bench(lambda n: simhash("".join(words)), 100))
+    )
+    print("milliseconds per call")
+    for name, ms in results:
+        print("%-20s\t%8.3f" % (name, ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Compare ImageExtractor with the old six-regex image search on large bodies
+usage: python3 -m benchmarks.bench_images [--size KB] [--repeat N]
+"""
+
+import argparse, re, time
+from sh_feeder.sh_feeder import ImageExtractor
+
+
+def legacy_find_image_link(content):
+    m = re.search(
+        "(https?:\\/\\/[^'\"]*\\.(gif|jpe?g|png|tiff?|webp))", content, re.IGNORECASE
+    )
+    if m:
+        return m.group(1)
+
+
+def legacy_get_image(entry):
+    """
+    the pre-ImageExtractor search order, one regex scan per source
+    """
+    for media in entry.get("media_content", []):
+        m = legacy_find_image_link(media.get("url", ""))
+        if m is not None:
+            return m
+    for media in entry.get("media_thumbnail", []):
+        m = legacy_find_image_link(media.get("url", ""))
+        if m is not None:
+            return m
+    for link in entry.get("links", []):
+        if re.match("image/", link.get("type", "")):
+            return link.get("href")
+    for c in entry.get("content", []):
+        m = legacy_find_image_link(c.get("value", ""))
+        if m is not None:
+            return m
+    m = legacy_find_image_link(entry.get("summary_detail", {}).get("value", ""))
+    if m is not None:
+        return m
+    return legacy_find_image_link(entry.get("summary", ""))
+
+
+def make_body(size, image=True):
+    """
+    returns roughly size bytes of article HTML full of non-image links,
+    with an <img> at the very end
+    """
+    paragraph = (
+        '<p>Lorem ipsum <a href="https://example.com/articles/%s">dolor sit</a> '
+        "amet, see https://example.com/docs/%s for details. Consectetur "
+        "adipiscing elit, sed do eiusmod tempor incididunt ut labore.</p>\n"
+    )
+    parts = []
+    n = 0
+    while sum(len(p) for p in parts) < size:
+        parts.append(paragraph % (n, n))
+        n += 1
+    if image:
+        parts.append('<img alt="cover" src="https://example.com/cover.jpg">')
+    return "".join(parts)
+
+
+def bench(get_image, entry, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        image = get_image(entry)
+    return (time.perf_counter() - start) / repeat * 1000, image
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", help="Body size in KB", type=int, default=128)
+    parser.add_argument("--repeat", help="Runs per case", type=int, default=5)
+    args = parser.parse_args()
+    extractor = ImageExtractor()
+    cases = []
+    for name, image, quotes in (
+        ("html, image", True, True),
+        ("html", False, True),
+        ("plain text", False, False),
+    ):
+        body = make_body(args.size * 1024, image=image)
+        if not quotes:
+            # e.g. a markdown summary, where the old pattern backtracks from
+            # every url to the end of the text
+            body = body.replace('"', "")
+        entry = {
+            "content": [{"type": "text/html", "value": body}],
+            "summary_detail": {"type": "text/html", "value": body},
+            "summary": body,
+        }
+        cases.append((name, entry))
+    print("%s KB bodies, milliseconds per entry" % args.size)
+    print("%-12s\t%10s\t%10s" % ("", "legacy", "extractor"))
+    for name, entry in cases:
+        legacy, legacy_image = bench(legacy_get_image, entry, args.repeat)
+        new, new_image = bench(extractor.extract, entry, args.repeat)
+        print("%-12s\t%10.2f\t%10.2f" % (name, legacy, new))
+        if legacy_image != new_image:
+            print("  results differ: %s / %s" % (legacy_image, new_image))
+
+
+if __name__ == "__main__":
+    main()
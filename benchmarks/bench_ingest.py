@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+"""
+Time each step of the ingest and publish path on synthetic feeds of a few
+sizes and on recorded feeds, and save the results as JSON to compare runs
+usage: python3 -m benchmarks.bench_ingest [--sizes N,N,...] [--feed FILE ...]
+                                          [--repeat N] [--output FILE]
+                                          [--compare FILE] [--threshold PERCENT]
+
+The synthetic feeds have realistic HTML bodies, media tags and category lists,
+and are the same on every run. The recorded feeds default to the ones in
+tests/fixtures/feeds. Each step is timed --repeat times and the best time is
+kept, in microseconds per entry. With --compare, the steps that got slower
+than --threshold percent are listed and the exit status is 1.
+"""
+
+import argparse, glob, json, os, platform, random, sys, time
+import feedparser
+from sh_feeder.sh_feeder import (
+    Feed,
+    FeedItem,
+    HtmlConverter,
+    PodClient,
+    connect_db,
+    parse_args,
+    publish_items,
+    queued_items,
+    Tags,
+)
+
+RECORDED = os.path.join(os.path.dirname(__file__), "..", "tests", "fixtures", "feeds")
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod \
+    tempor incididunt ut labore et dolore magna aliqua privacy linux release \
+    kernel security update community".split()
+
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for n in range(words)).capitalize() + "."
+
+
+def make_body(rng, n):
+    """
+    returns an article's HTML, with the markup blogs and news sites use
+    """
+    parts = [
+        '<figure><img src="https://cdn.example.com/%s/hero.jpg" alt="%s" '
+        'width="1200" height="630"><figcaption>%s</figcaption></figure>'
+        % (n, sentence(rng, 4), sentence(rng, 6))
+    ]
+    for p in range(rng.randint(4, 10)):
+        parts.append(
+            '<p>%s <a href="https://example.com/%s/%s">%s</a> <em>%s</em> '
+            "<strong>%s</strong> &amp; &#8220;%s&#8221;</p>"
+            % (
+                sentence(rng),
+                n,
+                p,
+                sentence(rng, 3),
+                sentence(rng, 5),
+                sentence(rng, 4),
+                sentence(rng, 6),
+            )
+        )
+        if p == 2:
+            items = "".join("<li>%s</li>" % sentence(rng, 6) for i in range(4))
+            parts.append("<ul>%s</ul>" % items)
+        if p == 3:
+            parts.append("<blockquote><p>%s</p></blockquote>" % sentence(rng, 20))
+        if p == 4:
+            parts.append("<pre><code>$ make &amp;&amp; make install\n</code></pre>")
+    parts.append(
+        '<p><img src="https://example.com/tracker.gif?id=%s" width="1" '
+        'height="1"></p>' % n
+    )
+    return "\n".join(parts)
+
+
+def make_feed(entries, seed=0):
+    """
+    returns the XML of an RSS 2.0 feed of synthetic entries
+    """
+    rng = random.Random(seed)
+    items = []
+    for n in range(entries):
+        body = make_body(rng, n)
+        tags = "".join(
+            "<category>%s</category>" % rng.choice(WORDS).title()
+            for t in range(rng.randint(3, 8))
+        )
+        items.append(
+            """<item>
+            <title>%s</title>
+            <link>https://example.com/%s/article-%s</link>
+            <guid isPermaLink="false">article-%s</guid>
+            <pubDate>Mon, 01 Jan 2024 12:%02d:00 GMT</pubDate>
+            <description><![CDATA[<p>%s</p>]]></description>
+            <content:encoded><![CDATA[%s]]></content:encoded>
+            <media:content url="https://cdn.example.com/%s/hero.jpg"
+                medium="image" type="image/jpeg"/>
+            <media:thumbnail url="https://cdn.example.com/%s/thumb.jpg"/>
+            %s
+            </item>"""
+            % (
+                sentence(rng, 8),
+                n % 97,
+                n,
+                n,
+                n % 60,
+                sentence(rng, 30),
+                body,
+                n,
+                n,
+                tags,
+            )
+        )
+    return ("""<?xml version="1.0" encoding="UTF-8"?>
+        <rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"
+            xmlns:media="http://search.yahoo.com/mrss/">
+        <channel><title>Synthetic</title><link>https://example.com/</link>
+        <description>Benchmark feed</description>
+        %s
+        </channel></rss>""" % "\n".join(items)).encode("utf-8")
+
+
+def best(func, repeat, setup=None):
+    """
+    returns the shortest of repeat runs of func(), in seconds. when given,
+    setup() is called untimed before each run and func gets its result
+    """
+    times = []
+    for n in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_feed(data, repeat):
+    """
+    time each step on one feed, returns a dict of steps to microseconds per
+    entry
+    """
+    entries = feedparser.parse(data)["entries"]
+    count = max(len(entries), 1)
+    stub = FeedItem.__new__(FeedItem)
+    timings = {}
+
+    def fresh_converter():
+        # so that a run doesn't find the documents of the last one cached
+        FeedItem.converter = HtmlConverter()
+
+    def feed_item():
+        fresh_converter()
+        for e in entries:
+            FeedItem(e, category_tags=True)
+
+    def html2markdown():
+        fresh_converter()
+        for e in entries:
+            stub.get_body(e.get("content"))
+            stub.get_summary(e.get("summary_detail"))
+
+    def get_tags():
+        for e in entries:
+            stub.tags = Tags()
+            stub.get_tags(e.get("tags", []))
+
+    items = [FeedItem(e, category_tags=True) for e in entries]
+    args = parse_args(
+        "--feed-id bench --feed-url URL --pod-url POD --token TOKEN --quiet \
+        --full --embed-image".split()
+    )
+
+    def load_db(conn):
+        feed = Feed(feed_id="bench", parsed={"entries": []})
+        feed.items = items
+        feed.load_db(conn)
+        return conn
+
+    def loaded_db():
+        return load_db(connect_db(":memory:"))
+
+    client = PodClient(url="POD", token="TOKEN")
+    # everything but the HTTP request
+    client.post = lambda message, via=None: {"id": 1}
+
+    conn = loaded_db()
+    rows = queued_items(conn, args)
+    conn.close()
+
+    def format_post():
+        for row in rows:
+            client.format_post(row, body=True, embed_image=True)
+
+    timings["feedparser.parse"] = best(lambda: feedparser.parse(data), repeat)
+    timings["FeedItem.__init__"] = best(feed_item, repeat)
+    timings["get_image"] = best(lambda: [stub.get_image(e) for e in entries], repeat)
+    timings["html2markdown"] = best(html2markdown, repeat)
+    timings["get_tags"] = best(get_tags, repeat)
+    timings["Feed.load_db"] = best(load_db, repeat, lambda: connect_db(":memory:"))
+    timings["publish_items"] = best(
+        lambda conn: publish_items(conn, client, args), repeat, loaded_db
+    )
+    timings["format_post"] = best(format_post, repeat)
+    return {step: t / count * 1e6 for step, t in timings.items()}, len(entries)
+
+
+def compare(results, baseline, threshold):
+    """
+    print the change of each step since the baseline results, returns the
+    steps that got slower than threshold percent
+    """
+    slower = []
+    print()
+    print("%-40s\t%10s\t%10s\t%8s" % ("compared to baseline", "before", "after", ""))
+    for name, after in results.items():
+        before = baseline.get(name)
+        if before is None or before == 0:
+            continue
+        change = (after / before - 1) * 100
+        flag = ""
+        if change > threshold:
+            slower.append(name)
+            flag = "  SLOWER"
+        print("%-40s\t%10.1f\t%10.1f\t%+7.1f%%%s" % (name, before, after, change, flag))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        help="Entries in each synthetic feed (default: 10,100,500)",
+        default="10,100,500",
+    )
+    parser.add_argument(
+        "--feed",
+        help="A recorded feed file to time. May be specified multiple times \
+            (default: the test fixtures)",
+        action="append",
+        default=[],
+    )
+    parser.add_argument("--repeat", help="Runs per step", type=int, default=5)
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="A JSON file saved by an earlier run")
+    parser.add_argument(
+        "--threshold",
+        help="Percent slower than --compare that counts as a regression \
+            (default 10)",
+        type=float,
+        default=10,
+    )
+    args = parser.parse_args()
+    feeds = []
+    for size in args.sizes.split(","):
+        if size.strip():
+            feeds.append(("synthetic-%s" % size.strip(), make_feed(int(size))))
+    for file in args.feed or sorted(glob.glob(os.path.join(RECORDED, "*.xml"))):
+        with open(file, "rb") as fh:
+            feeds.append((os.path.basename(file), fh.read()))
+    results = {}
+    converter = FeedItem.converter
+    try:
+        for name, data in feeds:
+            timings, count = bench_feed(data, args.repeat)
+            print("%s, %s entries, microseconds per entry" % (name, count))
+            for step, us in timings.items():
+                print("  %-20s\t%10.1f" % (step, us))
+                results["%s/%s" % (name, step)] = round(us, 2)
+    finally:
+        FeedItem.converter = converter
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(
+                {
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "feedparser": feedparser.__version__,
+                    "repeat": args.repeat,
+                    "results": results,
+                },
+                fh,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare) as fh:
+            slower = compare(results, json.load(fh)["results"], args.threshold)
+        if slower:
+            print("\n%s steps got slower" % len(slower))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Compare the per-item cost of Feed.load_db with the old per-item
+SELECT/INSERT/COMMIT loop
+usage: python3 -m benchmarks.bench_load_db [--items N] [--directory DIR]
+"""
+
+import argparse, os, tempfile, time
+from sh_feeder.sh_feeder import Feed, FeedItem, connect_db
+
+
+def make_items(count):
+    """
+    returns a list of synthetic FeedItems, without parsing anything
+    """
+    items = []
+    for n in range(count):
+        item = FeedItem.__new__(FeedItem)
+        item.guid = "https://example.com/%s/article-%s" % (n % 97, n)
+        item.title = "Article number %s" % n
+        item.link = item.guid
+        item.image = "https://example.com/images/%s.jpg" % n
+        item.body = "Lorem ipsum dolor sit amet. " * 40
+        item.summary = "Lorem ipsum dolor sit amet. " * 5
+        item.tags = ["#bench", "#item%s" % (n % 10)]
+        item.timestamp = int(time.time())
+        item.simhash = None
+        items.append(item)
+    return items
+
+
+def legacy_load_db(feed, conn):
+    """
+    the pre-bulk-ingest implementation: one lookup and one commit per item
+    """
+    for i in feed.items:
+        row = conn.execute(
+            "SELECT guid FROM feeds WHERE guid = ?", (i.guid,)
+        ).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO feeds(guid, feed_id, title, body, summary, \
+                link, image, image_title, hashtags, posted, timestamp) \
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    i.guid,
+                    feed.feed_id,
+                    i.title,
+                    i.body,
+                    i.summary,
+                    i.link,
+                    i.image,
+                    "image",
+                    " ".join(i.tags),
+                    "0",
+                    i.timestamp,
+                ),
+            )
+            conn.commit()
+
+
+def bench(name, load, items, directory):
+    """
+    time a cold ingest of every item, then a re-ingest of the same items
+    """
+    file = os.path.join(directory, "%s.db" % name)
+    conn = connect_db(file)
+    feed = Feed(feed_id="bench", parsed={"entries": []})
+    feed.items = items
+    timings = []
+    for run in ("new", "known"):
+        start = time.perf_counter()
+        load(feed, conn)
+        timings.append((time.perf_counter() - start) / len(items) * 1e6)
+    conn.close()
+    os.remove(file)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", help="Items per feed", type=int, default=3000)
+    parser.add_argument(
+        "--directory",
+        help="Where to create the benchmark databases (default: a temp dir)",
+    )
+    args = parser.parse_args()
+    items = make_items(args.items)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        results = [
+            ("per-item commit", bench("legacy", legacy_load_db, items, directory)),
+            ("bulk ingest", bench("bulk", Feed.load_db, items, directory)),
+        ]
+    print("%s items, microseconds per item" % args.items)
+    print("%-16s\t%10s\t%10s" % ("", "new", "known"))
+    for name, (new, known) in results:
+        print("%-16s\t%10.1f\t%10.1f" % (name, new, known))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+Compare the per-post latency of PodClient's keep-alive session with the old
+shcli path, which opens a new connection for every post
+usage: python3 -m benchmarks.bench_post [--posts N] [--plain]
+
+Posts go to a stand-in pod on localhost. Unless --plain is given it serves
+HTTPS with a throwaway self-signed certificate (made with openssl), so the
+connection cost includes a TLS handshake like a real pod.
+"""
+
+import argparse, http.server, os, ssl, subprocess, tempfile, threading, time
+import requests
+from sh_feeder.sh_feeder import PodClient
+
+
+class StandInPod(http.server.BaseHTTPRequestHandler):
+    """
+    accepts content API posts and answers like a pod
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        response = b'{"id": 1}'
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_certificate(directory):
+    """
+    returns the paths of a new self-signed certificate and key for 127.0.0.1
+    """
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    command = "openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=127.0.0.1 \
+        -addext subjectAltName=IP:127.0.0.1".split()
+    subprocess.run(
+        command + ["-keyout", key, "-out", cert], check=True, capture_output=True
+    )
+    return cert, key
+
+
+def start_pod(cert=None, key=None):
+    """
+    serve the stand-in pod on a background thread, returns the server
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInPod)
+    if cert is not None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def legacy_post(url, cert):
+    """
+    what shcli.create does: a one-off request, so a new connection every time
+    """
+
+    def post(message):
+        requests.post(
+            "%s/api/content/" % url,
+            headers={"Authorization": "Token TOKEN"},
+            data={"text": message, "visibility": "public"},
+            verify=cert or True,
+        ).json()
+
+    return post
+
+
+def session_post(url, cert):
+    """
+    PodClient with its pooled session
+    """
+    client = PodClient(url=url, token="TOKEN")
+    client.session = PodClient.new_session()
+    # REQUESTS_CA_BUNDLE would override verify for a session
+    client.session.trust_env = False
+    client.session.verify = cert or True
+    return client.post
+
+
+def bench(post, posts):
+    """
+    returns the mean milliseconds per post
+    """
+    post("warm up")
+    start = time.perf_counter()
+    for n in range(posts):
+        post("### [Post %s](https://example.com/%s)\n\nLorem ipsum" % (n, n))
+    return (time.perf_counter() - start) / posts * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", help="Posts per run", type=int, default=200)
+    parser.add_argument(
+        "--plain", help="Serve plain HTTP instead of HTTPS", action="store_true"
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = (None, None) if args.plain else make_certificate(directory)
+        server = start_pod(cert, key)
+        url = "%s://127.0.0.1:%s" % (
+            "http" if args.plain else "https",
+            server.server_port,
+        )
+        results = [
+            ("new connection", bench(legacy_post(url, cert), args.posts)),
+            ("keep-alive", bench(session_post(url, cert), args.posts)),
+        ]
+        server.shutdown()
+    print("%s posts over %s, milliseconds per post" % (args.posts, url.split(":")[0]))
+    for name, ms in results:
+        print("%-16s\t%8.2f" % (name, ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+Time the publish queue query on a large database, with and without the
+feeds_queue index
+usage: python3 -m benchmarks.bench_queue [--rows N] [--feeds N] [--directory DIR]
+"""
+
+import argparse, os, random, tempfile, time
+from sh_feeder.sh_feeder import connect_db, queued_items
+
+
+class Args:
+    def __init__(self, feed_id):
+        self.feed_id = feed_id
+        self.limit = -1
+        self.timeout = 72
+        self.render_at_ingest = False
+
+
+def fill(conn, rows, feeds, queued=0.01):
+    """
+    insert rows items spread over feeds feeds, all but a fraction queued of
+    them already published
+    """
+    now = int(time.time())
+    rng = random.Random(0)
+    with conn:
+        conn.executemany(
+            "INSERT INTO feeds(guid, feed_id, title, link, image, image_title, \
+            hashtags, body, summary, posted, timestamp) \
+            VALUES(?, ?, '', '', '', '', '', '', '', ?, ?)",
+            (
+                (
+                    "https://example.com/%s" % n,
+                    "feed%s" % (n % feeds),
+                    0 if rng.random() < queued else 1,
+                    now - rng.randrange(3600 * 24 * 60),
+                )
+                for n in range(rows)
+            ),
+        )
+
+
+def bench(conn, feeds, runs=200):
+    """
+    returns the mean milliseconds per queue query, over random feeds
+    """
+    rng = random.Random(1)
+    queries = [Args("feed%s" % rng.randrange(feeds)) for n in range(runs)]
+    start = time.perf_counter()
+    for args in queries:
+        queued_items(conn, args)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", help="Items in the database", type=int, default=10**6)
+    parser.add_argument("--feeds", help="Feeds in the database", type=int, default=500)
+    parser.add_argument(
+        "--directory",
+        help="Where to create the benchmark database (default: a temp dir)",
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        conn = connect_db(os.path.join(directory, "queue.db"))
+        start = time.perf_counter()
+        fill(conn, args.rows, args.feeds)
+        print("%s rows in %.1fs" % (args.rows, time.perf_counter() - start))
+        indexed = bench(conn, args.feeds)
+        conn.execute("DROP INDEX feeds_queue")
+        full_scan = bench(conn, args.feeds)
+        conn.close()
+    print("%s feeds, milliseconds per queue query" % args.feeds)
+    print("%-16s\t%8.3f" % ("no index", full_scan))
+    print("%-16s\t%8.3f" % ("feeds_queue", indexed))
+
+
+if __name__ == "__main__":
+    main()
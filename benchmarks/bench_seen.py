@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+Compare the size and lookup time of the seen_items store, with and without
+the Bloom filter, against an index of the text guids
+usage: python3 -m benchmarks.bench_seen [--items N] [--directory DIR]
+"""
+
+import argparse, os, random, sqlite3, tempfile, time
+from sh_feeder.sh_feeder import BloomFilter, Feed, connect_db, seen_key
+
+FEEDS = 500
+
+
+def guid(n):
+    return "https://blog%s.example.com/%s/%s/a-post-title-%s" % (
+        n % FEEDS,
+        2000 + n % 25,
+        n % 12 + 1,
+        n,
+    )
+
+
+def database_size(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    return page_size * pages
+
+
+def fill_guids(conn, items):
+    """
+    what the feeds table's guid index held: the text guids
+    """
+    conn.execute("CREATE TABLE guids(guid VARCHAR(255) PRIMARY KEY) WITHOUT ROWID")
+    with conn:
+        conn.executemany(
+            "INSERT INTO guids(guid) VALUES(?)", ((guid(n),) for n in range(items))
+        )
+
+
+def fill_seen(conn, items):
+    with conn:
+        conn.executemany(
+            "INSERT INTO seen_items(key) VALUES(?)",
+            ((seen_key("feed%s" % (n % FEEDS), guid(n)),) for n in range(items)),
+        )
+
+
+def bench(feed, entries, runs=200):
+    """
+    returns the mean milliseconds per known_guids call
+    """
+    start = time.perf_counter()
+    for n in range(runs):
+        feed.known_guids(entries)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", help="Seen items", type=int, default=10**6)
+    parser.add_argument(
+        "--directory",
+        help="Where to create the benchmark databases (default: a temp dir)",
+    )
+    args = parser.parse_args()
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        conn = sqlite3.connect(os.path.join(directory, "guids.db"))
+        fill_guids(conn, args.items)
+        guids_size = database_size(conn)
+        conn.close()
+        conn = connect_db(os.path.join(directory, "seen.db"))
+        empty = database_size(conn)
+        fill_seen(conn, args.items)
+        seen_size = database_size(conn) - empty
+        start = time.perf_counter()
+        bloom = BloomFilter.from_db(conn)
+        load = time.perf_counter() - start
+        # a feed of 20 entries, half of them already seen
+        feed = Feed(feed_id="feed0", db=conn, parsed={"entries": []})
+        numbers = [rng.randrange(args.items // FEEDS) * FEEDS for n in range(10)]
+        entries = [{"id": guid(n)} for n in numbers]
+        entries += [{"id": guid(n + args.items)} for n in numbers]
+        results = [("seen_items", bench(feed, entries))]
+        feed.seen = bloom
+        results.append(("bloom filter", bench(feed, entries)))
+        conn.close()
+    print("%s items, bytes per item" % args.items)
+    print("%-16s\t%8.1f" % ("guid index", guids_size / args.items))
+    print("%-16s\t%8.1f" % ("seen_items", seen_size / args.items))
+    print("%-16s\t%8.1f" % ("bloom filter", len(bloom.bits) / args.items))
+    print("bloom filter loaded in %.1fs" % load)
+    print("milliseconds per known_guids call of %s entries" % len(entries))
+    for name, ms in results:
+        print("%-16s\t%8.3f" % (name, ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Time how long the feeder takes to start, and what each kind of run imports,
+with python -X importtime in a fresh interpreter per run
+usage: python3 -m benchmarks.bench_startup [--runs N] [--top N]
+
+Each scenario imports sh_feeder and does the least a run of that kind needs:
+nothing else, parsing a feed and converting an item (a --fetch-only run), or
+creating a pod session (a --publish-only run). The import time is the sum of
+the top-level imports -X importtime reports, the best of --runs runs.
+"""
+
+import argparse, os, subprocess, sys
+
+FEED = os.path.join(os.path.dirname(__file__), "..", "tests", "fixtures", "feeds")
+
+SCENARIOS = [
+    ("python", "pass"),
+    ("import", "import sh_feeder.sh_feeder"),
+    (
+        "fetch-only",
+        "from sh_feeder.sh_feeder import FeedItem, fetch_feed\n"
+        "FeedItem(fetch_feed(%r)['entries'][0])"
+        % os.path.abspath(os.path.join(FEED, "rss.xml")),
+    ),
+    (
+        "publish-only",
+        "from sh_feeder.sh_feeder import PodClient\nPodClient.new_session()",
+    ),
+]
+
+# the slow imports, and whether each scenario loaded them
+WATCHED = ("diaspy", "feedparser", "html2text", "requests", "shcli")
+
+
+def import_times(code):
+    """
+    run code in a new interpreter, returns a dict of the modules it imported
+    to their (self, cumulative) import times in microseconds, and the top
+    level imports in the order they were made
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        check=True,
+        cwd=os.path.join(os.path.dirname(__file__), ".."),
+    ).stderr.decode()
+    modules = {}
+    top = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        if not own.strip().isdigit():
+            # the header
+            continue
+        modules[name.strip()] = (int(own), int(cumulative))
+        if not name[1:].startswith(" "):
+            top.append(name.strip())
+    return modules, top
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", help="Runs per scenario", type=int, default=5)
+    parser.add_argument(
+        "--top", help="Show this many of the slowest imports", type=int, default=5
+    )
+    args = parser.parse_args()
+    print("milliseconds of imports, best of %s runs" % args.runs)
+    print("%-16s\t%8s\t%s" % ("", "", "loaded"))
+    slowest = {}
+    for name, code in SCENARIOS:
+        best = None
+        for n in range(args.runs):
+            modules, top = import_times(code)
+            total = sum(modules[m][1] for m in top)
+            if best is None or total < best[0]:
+                best = (total, modules, top)
+        total, modules, top = best
+        loaded = [m for m in WATCHED if m in modules]
+        print("%-16s\t%8.3f\t%s" % (name, total / 1000, " ".join(loaded) or "-"))
+        slowest[name] = sorted(top, key=lambda m: -modules[m][1])[: args.top]
+        slowest[name] = [(m, modules[m][1]) for m in slowest[name]]
+    for name, imports in slowest.items():
+        print()
+        print("slowest top-level imports, %s" % name)
+        for module, cumulative in imports:
+            print("%-32s\t%8.3f" % (module, cumulative / 1000))
+
+
+if __name__ == "__main__":
+    main()
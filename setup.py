@@ -19,11 +19,19 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires=">=3",
-    install_requires=["shcli", "diaspy-api", "feedparser", "html2text", "urllib3"],
+    install_requires=[
+        "shcli",
+        "feedparser",
+        "html2text",
+        "requests",
+        "urllib3",
+    ],
     entry_points={
         "console_scripts": [
-            "pod-feeder=pod_feeder_v2.pod_feeder:main",
-            "pf-clean-db=pod_feeder_v2.clean_db:main",
+            "pod-feeder=sh_feeder.sh_feeder:main",
+            "pf-clean-db=sh_feeder.clean_db:main",
+            "sh-feeder-batch=sh_feeder.batch:main",
+            "pf-dead-letters=sh_feeder.dead_letters:main",
         ]
     },
     keywords="atom bot diaspora feeds newsfeeds rss social syndication",
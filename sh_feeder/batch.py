@@ -0,0 +1,812 @@
+#!/usr/bin/env python3
+
+"""
+Process many feeds in one run, driven by a single config file
+usage: ./batch.py [--database DATABASE] [--fetch-only | --publish-only] [--daemon]
+                  <config file>
+
+The config file may be JSON, TOML or YAML. Options use the same names as the
+single-feed command line (with either dashes or underscores), e.g.:
+
+    database = "feed.db"
+
+    [defaults]
+    pod_url = "socialhome.example.com"
+    token = "********"
+    limit = 1
+    summary = true
+
+    [[feeds]]
+    feed_id = "eff"
+    feed_url = "https://www.eff.org/rss/updates.xml"
+    auto_tag = ["eff", "privacy"]
+
+    [[feeds]]
+    feed_id = "lwn"
+    feed_url = "https://lwn.net/headlines/rss"
+    summary = false
+    full = true
+
+Per-feed values override the [defaults] table, which overrides the built-in
+defaults of the single-feed command line. The top level "workers" and
+"per_host" settings control how many feeds are downloaded at once, overall and
+from any one host. Once every feed is fetched, the queued items are published
+with up to "publish_workers" posts in flight (each feed's items are still
+posted one at a time, oldest first), at most "rate" posts per second with
+bursts of "burst" posts to any one pod. "database", "busy_timeout", "no_wal",
+"bloom_filter" and "max_html_size" can only be set at the top level too.
+
+"metrics_json" and "metrics_textfile" (top level only) save the counts and
+timings of each stage of the run, labelled by feed, as a JSON summary and in
+the Prometheus text format for node_exporter's textfile collector.
+
+With --daemon the feeds are run over and over, each one every "interval"
+minutes (60 by default, set it per feed or in [defaults]). The top level
+"jitter" setting (0.1 by default) varies each wait by up to that fraction
+of the interval, so that feeds don't all run at the same moment. Send the
+process SIGHUP to reload the config file, and SIGTERM to stop it.
+"""
+
+import argparse, heapq, itertools, json, os.path, queue, random, signal, sys
+import threading, time, urllib.error, urllib.parse, uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from sh_feeder.sh_feeder import (
+        build_parser,
+        BloomFilter,
+        claim_feed,
+        confirm_claim,
+        connect_db,
+        process_feed,
+        fetch_feed,
+        get_feed_state,
+        mark_failed,
+        record_failure,
+        mark_posted,
+        queued_items,
+        release_feed,
+        render_queued,
+        retry_locked,
+        skip_duplicate,
+        write_metrics,
+        FeedItem,
+        HtmlConverter,
+        METRICS,
+        PodClient,
+        TokenBucket,
+    )
+except ImportError:
+    from sh_feeder import (
+        build_parser,
+        BloomFilter,
+        claim_feed,
+        confirm_claim,
+        connect_db,
+        process_feed,
+        fetch_feed,
+        get_feed_state,
+        mark_failed,
+        record_failure,
+        mark_posted,
+        queued_items,
+        release_feed,
+        render_queued,
+        retry_locked,
+        skip_duplicate,
+        write_metrics,
+        FeedItem,
+        HtmlConverter,
+        METRICS,
+        PodClient,
+        TokenBucket,
+    )
+
+
+# options that only make sense for the whole run, not for a single feed
+RUN_OPTIONS = (
+    "database",
+    "workers",
+    "per_host",
+    "max_html_size",
+    "publish_workers",
+    "rate",
+    "burst",
+    "busy_timeout",
+    "no_wal",
+    "bloom_filter",
+    "jitter",
+    "metrics_json",
+    "metrics_textfile",
+)
+
+# options that are accepted as a single value or as a list of values
+LIST_OPTIONS = ("auto_tag", "ignore_tag")
+
+
+def load_config(file):
+    """
+    read a JSON, TOML or YAML config file into a dict
+    """
+    ext = os.path.splitext(file)[1].lower()
+    with open(file, "rb") as fh:
+        if ext == ".json":
+            config = json.load(fh)
+        elif ext == ".toml":
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    raise ValueError("reading %s requires python 3.11+ or tomli" % file)
+            config = tomllib.load(fh)
+        elif ext in (".yml", ".yaml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("reading %s requires PyYAML" % file)
+            config = yaml.safe_load(fh)
+        else:
+            raise ValueError("unknown config format '%s'" % ext)
+    if not isinstance(config, dict) or not isinstance(config.get("feeds"), list):
+        raise ValueError("%s must contain a list of 'feeds'" % file)
+    return config
+
+
+def normalize_options(options):
+    """
+    accept both 'feed-id' and 'feed_id' style keys
+    """
+    return {k.replace("-", "_"): v for k, v in (options or {}).items()}
+
+
+def feed_defaults():
+    """
+    returns the default value of every per-feed option of the command line
+    """
+    defaults = {}
+    for action in build_parser()._actions:
+        if action.dest != "help":
+            defaults[action.dest] = action.default
+    return defaults
+
+
+def feed_args(config, feed, overrides={}):
+    """
+    merge the built-in defaults, the config defaults, the feed's own options
+    and any command line overrides into a namespace for process_feed()
+    """
+    options = feed_defaults()
+    merged = dict(normalize_options(config.get("defaults")))
+    merged.update(normalize_options(feed))
+    merged.update(overrides)
+    for key, value in merged.items():
+        if key not in options:
+            raise ValueError("unknown option '%s'" % key)
+        if key in RUN_OPTIONS:
+            raise ValueError("'%s' can only be set for the whole run" % key)
+        if key in LIST_OPTIONS and isinstance(value, str):
+            value = [value]
+        options[key] = value
+    options["database"] = config.get("database", "feed.db")
+    args = argparse.Namespace(**options)
+    if not args.feed_id or not args.feed_url:
+        raise ValueError("every feed needs a feed_id and a feed_url")
+    if args.summary and args.full:
+        raise ValueError("%s: summary and full are mutually exclusive" % args.feed_id)
+    if args.debug and args.quiet:
+        raise ValueError("%s: debug and quiet are mutually exclusive" % args.feed_id)
+    if args.fetch_only and args.publish_only:
+        raise ValueError(
+            "%s: fetch_only and publish_only are mutually exclusive" % args.feed_id
+        )
+    if not args.fetch_only and (not args.token or not args.pod_url):
+        raise ValueError("%s: pod_url and token are required to publish" % args.feed_id)
+    if not args.interval > 0:
+        raise ValueError("%s: interval must be more than 0" % args.feed_id)
+    return args
+
+
+def load_feeds(config, overrides={}):
+    """
+    returns a list of namespaces, one per configured feed
+    """
+    feeds = []
+    seen = set()
+    for feed in config["feeds"]:
+        args = feed_args(config, feed, overrides)
+        if args.feed_id in seen:
+            raise ValueError("duplicate feed_id '%s'" % args.feed_id)
+        seen.add(args.feed_id)
+        feeds.append(args)
+    return feeds
+
+
+def interleave_hosts(feeds):
+    """
+    reorder feeds round-robin by host, so that workers waiting on one busy
+    host don't hold up feeds from other hosts
+    """
+    by_host = {}
+    for args in feeds:
+        by_host.setdefault(urllib.parse.urlsplit(args.feed_url).netloc, []).append(args)
+    ordered = []
+    queues = list(by_host.values())
+    while queues:
+        for q in queues:
+            ordered.append(q.pop(0))
+        queues = [q for q in queues if len(q)]
+    return ordered
+
+
+def fetch_feeds(feeds, workers=8, per_host=2, states={}):
+    """
+    download and parse feeds on a pool of worker threads, allowing at most
+    per_host concurrent requests to any one host. states maps feed ids to
+    their saved HTTP validators, see get_feed_state().
+    yields (args, parsed feed, error) tuples as the downloads complete
+    """
+    limits = {}
+    for args in feeds:
+        host = urllib.parse.urlsplit(args.feed_url).netloc
+        limits.setdefault(host, threading.BoundedSemaphore(max(per_host, 1)))
+
+    def fetch(args):
+        with limits[urllib.parse.urlsplit(args.feed_url).netloc]:
+            state = states.get(args.feed_id)
+            if state is None:
+                return fetch_feed(args.feed_url, streaming=args.streaming)
+            return fetch_feed(
+                args.feed_url,
+                state["etag"],
+                state["modified"],
+                streaming=args.streaming,
+                digest=state["digest"],
+            )
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(fetch, args): args for args in interleave_hosts(feeds)}
+        for future in as_completed(futures):
+            # don't keep every parsed feed until the last one is done
+            args = futures.pop(future)
+            try:
+                yield args, future.result(), None
+            except Exception as e:
+                yield args, None, e
+
+
+def publish_feeds(db, feeds, workers=4, buckets={}, sessions=None, stop=None):
+    """
+    publish the queued items of several feeds on a pool of worker threads.
+    a feed's items are posted one after the other in timestamp order, so at
+    most one post per feed is in flight. buckets maps pod urls to the
+    TokenBucket limiting posts to that pod, sessions maps them to the HTTP
+    sessions to post with, which are kept open if it is given. once the stop
+    event is set, the posts in flight are finished but no new ones are
+    started. the workers report back through a queue and the calling thread
+    marks each item as posted once its post has succeeded, or schedules its
+    retry (see mark_failed()), so there is still only one database writer.
+    feeds that another process is publishing are skipped, see claim_feed().
+    before each post a worker has the calling thread renew the feed's lease,
+    and stops if it was lost, see confirm_claim(). with --duplicate-window,
+    items that another feed has posted or queued in this run are skipped,
+    see skip_duplicate(). if marking an item fails, the workers are stopped
+    before the error is raised.
+    returns a dict of feed ids to (published items, error) tuples
+    """
+    events = queue.Queue()
+    close = sessions is None
+    if close:
+        sessions = {}
+    # feeds posting to the same pod share its connections
+    for args in feeds:
+        if args.pod_url not in sessions:
+            sessions[args.pod_url] = PodClient.new_session(max(workers, 1))
+
+    def publish(args, rows):
+        client = PodClient(
+            url=args.pod_url,
+            token=args.token,
+            backend=args.backend,
+            session=sessions[args.pod_url],
+        )
+        bucket = buckets.get(args.pod_url)
+        try:
+            for row in rows:
+                if stop is not None and stop.is_set():
+                    break
+                if not args.quiet:
+                    print("Publishing %s\t%s" % (args.feed_id, row["guid"]))
+                if bucket is not None:
+                    bucket.acquire()
+                # the feed may have waited in the pool for longer than its lease
+                reply = queue.Queue(maxsize=1)
+                events.put(("claim", args, (row, reply)))
+                if not reply.get():
+                    break
+                if row["attempts"]:
+                    METRICS.inc("publish_retries_total", args.feed_id)
+                with METRICS.timer("publish_seconds", args.feed_id):
+                    try:
+                        error = None if client.publish(row, args) else "not published"
+                    except Exception as e:
+                        error = e
+                if error is None:
+                    events.put(("posted", args, row))
+                else:
+                    # stop here, the rest of the feed would be posted out of order
+                    events.put(("failed", args, (row, error)))
+                    break
+        finally:
+            events.put(("done", args, None))
+
+    results = {args.feed_id: (0, None) for args in feeds}
+    owner = uuid.uuid4().hex
+    # (guid, feed_id, simhash) of the rows handed to the workers
+    queued = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        pending = 0
+        try:
+            for args in feeds:
+                # skip feeds that another process is publishing
+                if not retry_locked(db, claim_feed, db, args.feed_id, owner):
+                    continue
+                if args.render_at_ingest:
+                    retry_locked(db, render_queued, db, args)
+                rows = []
+                for row in queued_items(db, args):
+                    # the workers can't check for duplicates as they go
+                    if not skip_duplicate(db, args, row, queued):
+                        rows.append(row)
+                        queued.append((row["guid"], args.feed_id, row["simhash"]))
+                if len(rows):
+                    pool.submit(publish, args, rows)
+                    pending += 1
+                else:
+                    retry_locked(db, release_feed, db, args.feed_id, owner)
+            while pending:
+                event, args, value = events.get()
+                published, error = results[args.feed_id]
+                if event == "claim":
+                    row, reply = value
+                    claimed = False
+                    try:
+                        claimed = retry_locked(
+                            db, confirm_claim, db, args.feed_id, owner, row["guid"]
+                        )
+                    finally:
+                        # the worker is waiting for the answer
+                        reply.put(claimed)
+                elif event == "posted":
+                    retry_locked(db, mark_posted, db, value["guid"])
+                    METRICS.inc("posts_total", args.feed_id, result="published")
+                    results[args.feed_id] = (published + 1, error)
+                elif event == "failed":
+                    record_failure(
+                        args, retry_locked(db, mark_failed, db, args, *value)
+                    )
+                    results[args.feed_id] = (published, value[1])
+                else:
+                    pending -= 1
+                    retry_locked(db, release_feed, db, args.feed_id, owner)
+        finally:
+            # if the loop above failed, the workers still have to finish
+            # before the pool can be shut down: answer their claims with
+            # False so that they stop, and wait for them
+            while pending:
+                event, args, value = events.get()
+                if event == "claim":
+                    value[1].put(False)
+                elif event == "done":
+                    pending -= 1
+    if close:
+        for session in sessions.values():
+            session.close()
+    return results
+
+
+def run(
+    db,
+    feeds,
+    workers=1,
+    per_host=2,
+    publish_workers=1,
+    rate=0,
+    burst=1,
+    seen=None,
+    buckets=None,
+    sessions=None,
+    stop=None,
+):
+    """
+    fetch feeds concurrently and queue their items one feed at a time on the
+    calling thread, so there is only ever one database writer. then publish
+    the queued items of every feed that was fetched or couldn't be
+    downloaded, and of the publish_only feeds which aren't fetched at all,
+    see publish_feeds().
+    seen is an optional BloomFilter shared by all the feeds. buckets and
+    sessions are kept between calls if they are given.
+    returns a list of (feed_id, new, published, error) tuples
+    """
+    results = {}
+    publishing = []
+    fetching = []
+    for args in feeds:
+        if args.publish_only:
+            results[args.feed_id] = (args.feed_id, 0, 0, None)
+            publishing.append(args)
+        else:
+            fetching.append(args)
+    # read the validators up front, the workers can't use the connection
+    states = {}
+    for args in fetching:
+        states[args.feed_id] = get_feed_state(db, args.feed_id, args.feed_url)
+    for args, parsed, error in fetch_feeds(fetching, workers, per_host, states):
+        if isinstance(error, urllib.error.HTTPError):
+            # the status of a successful download is counted by process_feed()
+            METRICS.inc("fetch_responses_total", args.feed_id, status=error.code)
+        stage = "fetch"
+        if error is None:
+            stage = "ingest"
+            try:
+                new = process_feed(db, args, parsed=parsed, publish=False, seen=seen)[0]
+                results[args.feed_id] = (args.feed_id, new, 0, None)
+                if not args.fetch_only:
+                    publishing.append(args)
+            except Exception as e:
+                error = e
+        if error is not None:
+            METRICS.inc("errors_total", args.feed_id, stage=stage)
+            results[args.feed_id] = (args.feed_id, 0, 0, error)
+            if not args.quiet:
+                print("Failed %s\t%s" % (args.feed_id, error), file=sys.stderr)
+            # the items queued before are still published, and retried
+            if stage == "fetch" and not args.fetch_only:
+                publishing.append(args)
+    # one bucket per pod, shared by all the feeds posting to it
+    if buckets is None:
+        buckets = {}
+    for args in publishing:
+        if args.pod_url not in buckets:
+            buckets[args.pod_url] = TokenBucket(rate, burst)
+    published = publish_feeds(db, publishing, publish_workers, buckets, sessions, stop)
+    for args in publishing:
+        count, error = published[args.feed_id]
+        feed_id, new, _, fetch_error = results[args.feed_id]
+        if error is not None and not args.quiet:
+            print("Failed %s\t%s" % (args.feed_id, error), file=sys.stderr)
+        if error is None:
+            error = fetch_error
+        results[args.feed_id] = (feed_id, new, count, error)
+    return [results[args.feed_id] for args in feeds]
+
+
+class Scheduler:
+    """
+    runs the feeds of a config file until it is stopped, each one when its
+    saved next_check is due (see next_poll()) give or take "jitter" (a
+    fraction of the wait), so they don't all run at once. a feed that hasn't
+    been checked yet, or failed, is run again after its "interval" minutes.
+    feeds that are due at the same time are run together, see run(). the
+    database connection and the pods' HTTP sessions and rate limits are kept
+    from one run to the next.
+    load is a function returning the config and the list of feeds, see
+    load_run(). it is called again on SIGHUP. SIGTERM and SIGINT stop the
+    scheduler once the posts in flight are done
+    """
+
+    def __init__(self, db, load, seen=None, clock=time.monotonic, sleep=time.sleep):
+        self.db = db
+        self.load = load
+        self.seen = seen
+        self.clock = clock
+        self.sleep = sleep
+        self.config, feeds = load()
+        self.feeds = {args.feed_id: args for args in feeds}
+        # (due time, sequence number, feed id), the next feed due first
+        self.queue = []
+        self.sequence = itertools.count()
+        self.buckets = {}
+        self.sessions = {}
+        self.reloading = False
+        self.stop = threading.Event()
+        self.rng = random.Random()
+        for args in feeds:
+            # spread the first runs over a minute
+            self.schedule(args, self.rng.uniform(0, 60) if self.jitter() else 0)
+
+    def jitter(self):
+        return max(0, min(self.config.get("jitter", 0.1), 1))
+
+    def schedule(self, args, delay=None):
+        """
+        queue a feed to run after delay seconds, or when it is due next
+        """
+        if delay is None:
+            delay = args.interval * 60
+            state = get_feed_state(self.db, args.feed_id)
+            if state is not None and state["next_check"] is not None:
+                if state["next_check"] > time.time():
+                    delay = state["next_check"] - time.time()
+            delay = delay * (1 + self.rng.uniform(-1, 1) * self.jitter())
+        item = (self.clock() + delay, next(self.sequence), args.feed_id)
+        heapq.heappush(self.queue, item)
+
+    def due(self):
+        """
+        returns the feeds that are due now, and takes them off the queue
+        """
+        feeds = []
+        now = self.clock()
+        while len(self.queue) and self.queue[0][0] <= now:
+            feeds.append(self.feeds[heapq.heappop(self.queue)[2]])
+        return feeds
+
+    def reload(self):
+        """
+        load the config again. feeds that are still there keep their place
+        in the queue. if the new config is broken the old one is kept
+        """
+        self.reloading = False
+        try:
+            config, feeds = self.load()
+        except Exception as e:
+            print("Not reloading the config: %s" % e, file=sys.stderr)
+            return
+        for option in (
+            "database",
+            "busy_timeout",
+            "no_wal",
+            "bloom_filter",
+            "max_html_size",
+        ):
+            if config.get(option) != self.config.get(option):
+                print("Restart to change '%s'" % option, file=sys.stderr)
+        if (config.get("rate"), config.get("burst")) != (
+            self.config.get("rate"),
+            self.config.get("burst"),
+        ):
+            self.buckets = {}
+        self.config = config
+        self.feeds = {args.feed_id: args for args in feeds}
+        self.queue = [item for item in self.queue if item[2] in self.feeds]
+        heapq.heapify(self.queue)
+        queued = set(item[2] for item in self.queue)
+        for args in feeds:
+            if args.feed_id not in queued:
+                self.schedule(args, 0)
+
+    def handle_signal(self, signum, frame):
+        # just set flags, the loop acts on them. stop.set() can't deadlock
+        # as only this handler takes its lock, the threads call is_set()
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stop.set()
+
+    def install_signal_handlers(self):
+        for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.handle_signal)
+
+    def run_once(self, feeds):
+        """
+        run the feeds that are due, see run(), and queue them again
+        """
+        try:
+            results = run(
+                self.db,
+                feeds,
+                workers=self.config.get("workers", 8),
+                per_host=self.config.get("per_host", 2),
+                publish_workers=self.config.get("publish_workers", 4),
+                rate=self.config.get("rate", 0),
+                burst=self.config.get("burst", 1),
+                seen=self.seen,
+                buckets=self.buckets,
+                sessions=self.sessions,
+                stop=self.stop,
+            )
+            if not all(args.quiet for args in feeds):
+                print_summary(results)
+            write_metrics(
+                self.config.get("metrics_json"), self.config.get("metrics_textfile")
+            )
+        except Exception as e:
+            # keep going, the feeds are tried again at their next run
+            print(
+                "Failed %s\t%s" % (", ".join(a.feed_id for a in feeds), e),
+                file=sys.stderr,
+            )
+        for args in feeds:
+            if args.feed_id in self.feeds:
+                self.schedule(self.feeds[args.feed_id])
+
+    def run(self):
+        """
+        run the feeds as they come due until stopped
+        """
+        while not self.stop.is_set():
+            if self.reloading:
+                self.reload()
+            feeds = self.due()
+            if len(feeds):
+                self.run_once(feeds)
+            elif len(self.queue):
+                # wake up at least once a second to check for signals
+                self.sleep(max(min(self.queue[0][0] - self.clock(), 1), 0))
+            else:
+                self.sleep(1)
+        for session in self.sessions.values():
+            session.close()
+
+
+def print_summary(results):
+    """
+    print a per-feed table and the totals
+    """
+    width = max([len("feed")] + [len(r[0]) for r in results])
+    print()
+    print("%s\t%s\t%s" % ("feed".ljust(width), "new", "published"))
+    for feed_id, new, published, error in results:
+        if error is None:
+            print("%s\t%s\t%s" % (feed_id.ljust(width), new, published))
+        else:
+            print("%s\tFAILED: %s" % (feed_id.ljust(width), error))
+    failed = len([r for r in results if r[3] is not None])
+    print(
+        "\n%s feeds, %s new items, %s published, %s failed"
+        % (
+            len(results),
+            sum(r[1] for r in results),
+            sum(r[2] for r in results),
+            failed,
+        )
+    )
+
+
+def parse_args(argv=None):
+    """
+    proccess command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="A JSON, TOML or YAML file listing the feeds")
+    parser.add_argument(
+        "--database", help="The file to store feed data (overrides the config file)"
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--fetch-only",
+        help="Don't publish to SH, queue the new feed items for later",
+        action="store_true",
+        default=False,
+    )
+    mode.add_argument(
+        "--publish-only",
+        help="Don't fetch the feeds, publish the items queued by earlier \
+            --fetch-only runs",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--workers",
+        help="How many feeds to download at once (overrides the config file)",
+        type=int,
+    )
+    parser.add_argument(
+        "--per-host",
+        help="How many feeds to download at once from a single host \
+            (overrides the config file)",
+        type=int,
+    )
+    parser.add_argument(
+        "--publish-workers",
+        help="How many posts to publish at once (overrides the config file)",
+        type=int,
+    )
+    parser.add_argument(
+        "--rate",
+        help="Publish at most this many posts per second to any one pod, \
+            0 for no limit (overrides the config file)",
+        type=float,
+    )
+    parser.add_argument(
+        "--burst",
+        help="How many posts may be published at once before --rate applies \
+            (overrides the config file)",
+        type=int,
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Save a JSON summary of each stage's counts and timings \
+            (overrides the config file)",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="Save the metrics in the Prometheus text format, for \
+            node_exporter's textfile collector (overrides the config file)",
+    )
+    parser.add_argument(
+        "--daemon",
+        help="Keep running, and run each feed every 'interval' minutes. \
+            SIGHUP reloads the config file, SIGTERM stops after the posts in \
+            flight",
+        action="store_true",
+        default=False,
+    )
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "--debug", help="Show debugging output", action="store_true", default=False
+    )
+    verbosity.add_argument(
+        "--quiet", help="Suppress normal output", action="store_true", default=False
+    )
+    return parser.parse_args(argv)
+
+
+def load_run(args):
+    """
+    read the config file and apply the command line options to it.
+    returns the config and the list of feeds
+    """
+    config = load_config(args.config)
+    for option in (
+        "database",
+        "workers",
+        "per_host",
+        "publish_workers",
+        "rate",
+        "burst",
+        "metrics_json",
+        "metrics_textfile",
+    ):
+        if getattr(args, option) is not None:
+            config[option] = getattr(args, option)
+    overrides = {}
+    if args.fetch_only:
+        overrides["fetch_only"] = True
+    if args.publish_only:
+        overrides["publish_only"] = True
+    if args.debug or args.quiet:
+        overrides.update(debug=args.debug, quiet=args.quiet)
+    return config, load_feeds(config, overrides)
+
+
+def main():
+    args = parse_args()
+    config, feeds = load_run(args)
+    FeedItem.converter = HtmlConverter(max_length=config.get("max_html_size", 262144))
+    db = connect_db(
+        config.get("database", "feed.db"),
+        timeout=config.get("busy_timeout", 30),
+        wal=not config.get("no_wal", False),
+    )
+    seen = None
+    if config.get("bloom_filter") and not args.publish_only:
+        seen = BloomFilter.from_db(db)
+    if args.daemon:
+        scheduler = Scheduler(db, lambda: load_run(args), seen=seen)
+        scheduler.install_signal_handlers()
+        scheduler.run()
+        db.close()
+        return
+    results = run(
+        db,
+        feeds,
+        workers=config.get("workers", 8),
+        per_host=config.get("per_host", 2),
+        publish_workers=config.get("publish_workers", 4),
+        rate=config.get("rate", 0),
+        burst=config.get("burst", 1),
+        seen=seen,
+    )
+    db.close()
+    write_metrics(config.get("metrics_json"), config.get("metrics_textfile"))
+    if not args.quiet:
+        print_summary(results)
+    if any(r[3] is not None for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
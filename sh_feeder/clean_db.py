@@ -2,31 +2,261 @@
 
 """
 Run this periodically to remove already posted data
-usage: ./clean_db.py <sqlite file>
+usage: ./clean_db.py [--retention DAYS] [--feed-retention FEED_ID=DAYS]
+                     [--time-budget SECONDS] [--full-vacuum] <sqlite file>
+
+Posted items have their text blanked, and so do queued items that were
+rendered with --render-at-ingest, except their title and link. Items older
+than their feed's retention period are deleted, but stay in the table of seen
+items so they are never posted again. The work is done in small transactions
+and stops when the time budget runs out, so it can run while the feeder is
+using the database. Freed pages are given back to the filesystem with
+incremental vacuuming, which databases created before this version don't
+support yet: run with --full-vacuum once to convert them (this rewrites the
+whole file, and locks it while doing so).
 """
 
-import os.path, sqlite3, sys
+import argparse, os.path, sys, time
+
+try:
+    from sh_feeder.sh_feeder import connect_db, seen_key, simhash_bands
+except ImportError:
+    from sh_feeder import connect_db, seen_key, simhash_bands
+
+
+def out_of_time(deadline):
+    return deadline is not None and time.monotonic() > deadline
+
+
+def expire_items(
+    conn, retention=None, feed_retention={}, batch_size=500, deadline=None
+):
+    """
+    delete items older than their feed's retention period in days, the
+    feed_retention dict overriding retention, which may be None to keep
+    items of the other feeds. they stay in seen_items, so they aren't
+    posted again. returns the number of deleted items
+    """
+    now = time.time()
+    cutoff = "?"
+    params = []
+    if len(feed_retention):
+        cutoff = "CASE feed_id" + " WHEN ? THEN ?" * len(feed_retention) + " ELSE ? END"
+        for feed_id, days in feed_retention.items():
+            params.extend([feed_id, int(now - days * 86400)])
+    params.append(0 if retention is None else int(now - retention * 86400))
+    query = "SELECT rowid, guid, feed_id, simhash FROM feeds WHERE timestamp < %s \
+        LIMIT ?" % cutoff
+    deleted = 0
+    while not out_of_time(deadline):
+        with conn:
+            rows = conn.execute(query, params + [batch_size]).fetchall()
+            # in case an older version of the feeder loaded them
+            conn.executemany(
+                "INSERT OR IGNORE INTO seen_items(key) VALUES(?)",
+                [(seen_key(r[2], r[1]),) for r in rows],
+            )
+            conn.executemany(
+                "DELETE FROM fingerprints WHERE band = ? AND guid = ?",
+                [
+                    (b, r[1])
+                    for r in rows
+                    if r[3] is not None
+                    for b in simhash_bands(r[3])
+                ],
+            )
+            conn.executemany(
+                "DELETE FROM feeds WHERE rowid = ?", [(r[0],) for r in rows]
+            )
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            break
+    return deleted
+
+
+def blank_posted(conn, batch_size=500, deadline=None):
+    """
+    blank the text of posted and duplicate items, which is no longer needed.
+    returns the number of blanked items
+    """
+    blanked = 0
+    last = 0
+    while not out_of_time(deadline):
+        with conn:
+            rows = conn.execute(
+                "SELECT rowid FROM feeds WHERE rowid > ? AND posted > 0 \
+                AND (title != '' OR link != '' OR body != '' OR summary != '' \
+                OR image != '' OR image_title != '' OR hashtags != '' \
+                OR rendered IS NOT NULL) ORDER BY rowid LIMIT ?",
+                (last, batch_size),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE feeds SET body = '', summary = '', title = '', link = '', \
+                image = '', image_title = '', hashtags = '', rendered = NULL, \
+                compression = 0 WHERE rowid = ?",
+                [(r[0],) for r in rows],
+            )
+        blanked += len(rows)
+        if len(rows) < batch_size:
+            break
+        last = rows[-1][0]
+    return blanked
+
+
+def blank_rendered(conn, batch_size=500, deadline=None):
+    """
+    blank the text that queued and dead-lettered items were rendered from,
+    they are posted from their rendered text. the title and link are kept to
+    list them by. returns the number of blanked items
+    """
+    blanked = 0
+    last = 0
+    while not out_of_time(deadline):
+        with conn:
+            rows = conn.execute(
+                "SELECT rowid FROM feeds WHERE rowid > ? AND posted <= 0 \
+                AND rendered IS NOT NULL AND (body != '' OR summary != '' \
+                OR image != '' OR image_title != '' OR hashtags != '') \
+                ORDER BY rowid LIMIT ?",
+                (last, batch_size),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE feeds SET body = '', summary = '', image = '', \
+                image_title = '', hashtags = '' WHERE rowid = ?",
+                [(r[0],) for r in rows],
+            )
+        blanked += len(rows)
+        if len(rows) < batch_size:
+            break
+        last = rows[-1][0]
+    return blanked
+
+
+def incremental_vacuum(conn, pages=1000, deadline=None):
+    """
+    give free pages back to the filesystem, pages at a time.
+    returns the number of freed pages
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    freed = 0
+    while not out_of_time(deadline):
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free == 0:
+            break
+        # each step of the pragma frees one page, execute() would only take
+        # the first step
+        conn.executescript("PRAGMA incremental_vacuum(%d)" % pages)
+        freed += free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return freed
+
+
+def full_vacuum(conn):
+    """
+    rebuild the whole database, switching it to incremental vacuuming
+    """
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def feed_retention(value):
+    """
+    parse a FEED_ID=DAYS argument
+    """
+    feed_id, sep, days = value.rpartition("=")
+    if not sep or not feed_id:
+        raise argparse.ArgumentTypeError("expected FEED_ID=DAYS, got '%s'" % value)
+    return feed_id, float(days)
+
+
+def parse_args(argv=None):
+    """
+    proccess command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "database",
+        help="The feed database (default: 'feed.db')",
+        nargs="?",
+        default="feed.db",
+    )
+    parser.add_argument(
+        "--retention",
+        help="Delete items older than this many days (default: keep them)",
+        type=float,
+    )
+    parser.add_argument(
+        "--feed-retention",
+        help="Retention in days for one feed, as FEED_ID=DAYS. \
+            May be specified multiple times",
+        type=feed_retention,
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="How many items to change per transaction (default 500)",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "--time-budget",
+        help="Stop after about this many seconds, 0 for no limit (default 60)",
+        type=float,
+        default=60,
+    )
+    parser.add_argument(
+        "--vacuum-pages",
+        help="How many pages to free per transaction (default 1000)",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--full-vacuum",
+        help="Rebuild the whole database with VACUUM instead, and convert it \
+            to incremental vacuuming. Locks the database while it runs",
+        action="store_true",
+        default=False,
+    )
+    return parser.parse_args(argv)
 
 
 def main():
-    if len(sys.argv) > 1:
-        file = sys.argv[1]
-    else:
-        file = "feed.db"
+    args = parse_args()
+    file = args.database
+    if not os.path.isfile(file):
+        sys.exit("%s not found" % file)
     old_size = os.path.getsize(file)
-    print("Vacuuming %s..." % file)
+    print("Cleaning %s..." % file)
     print("Starting size:\t%s bytes" % old_size)
-    conn = sqlite3.connect(file)
-    conn.execute(
-        "UPDATE feeds SET body = '', summary = '', title = '', link = '', \
-        image = '', image_title = '', hashtags = '' WHERE posted = 1"
+    conn = connect_db(file)
+    deadline = None
+    if args.time_budget > 0:
+        deadline = time.monotonic() + args.time_budget
+    deleted = expire_items(
+        conn, args.retention, dict(args.feed_retention), args.batch_size, deadline
     )
-    conn.commit()
-    conn.execute("VACUUM")
+    print("Deleted:\t%s items" % deleted)
+    print("Blanked:\t%s items" % blank_posted(conn, args.batch_size, deadline))
+    rendered = blank_rendered(conn, args.batch_size, deadline)
+    print("Blanked:\t%s rendered items" % rendered)
+    if args.full_vacuum:
+        print("Vacuuming...")
+        full_vacuum(conn)
+    else:
+        freed = incremental_vacuum(conn, args.vacuum_pages, deadline)
+        print("Freed:\t\t%s pages" % freed)
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print("Run with --full-vacuum once to enable incremental vacuuming")
+    if out_of_time(deadline):
+        print("Out of time, run again to continue")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
     new_size = os.path.getsize(file)
     percent = ((old_size - new_size) / old_size) * 100.0
     print("New size:\t%s bytes" % new_size)
     print("Recovered:\t%.2f%%" % percent)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+List the items that failed to post --max-attempts times, and put them back
+in the publishing queue
+usage: ./dead_letters.py [--feed-id FEED_ID] [--requeue] <sqlite file> [guid ...]
+"""
+
+import argparse, sqlite3, time
+
+
+def dead_letters(conn, feed_id=None, guids=[]):
+    """
+    returns the dead-lettered items, oldest first
+    """
+    query = "SELECT feed_id, guid, title, attempts, last_error, timestamp \
+        FROM feeds WHERE posted = -1"
+    params = []
+    if feed_id is not None:
+        query = query + " AND feed_id = ?"
+        params.append(feed_id)
+    if len(guids):
+        query = query + " AND guid IN (%s)" % ",".join("?" * len(guids))
+        params.extend(guids)
+    return conn.execute(query + " ORDER BY timestamp", params).fetchall()
+
+
+def requeue(conn, rows):
+    """
+    reset the given items so they are posted on the next run,
+    returns the number of requeued items
+    """
+    with conn:
+        conn.executemany(
+            "UPDATE feeds SET posted = 0, attempts = 0, last_error = NULL, \
+            next_attempt_at = 0 WHERE guid = ? AND posted = -1",
+            [(r["guid"],) for r in rows],
+        )
+    return len(rows)
+
+
+def parse_args(argv=None):
+    """
+    proccess command line args
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database", help="The feed database")
+    parser.add_argument("guid", help="Only these items", nargs="*")
+    parser.add_argument("--feed-id", help="Only items from this feed")
+    parser.add_argument(
+        "--requeue",
+        help="Queue the items for publishing again. Items older than the \
+            feed's --timeout are still skipped",
+        action="store_true",
+        default=False,
+    )
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    conn = sqlite3.connect(args.database)
+    conn.row_factory = sqlite3.Row
+    rows = dead_letters(conn, args.feed_id, args.guid)
+    for r in rows:
+        print(
+            "%s\t%s\t%s\t%s attempts\t%s"
+            % (
+                r["feed_id"],
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(r["timestamp"])),
+                r["guid"],
+                r["attempts"],
+                r["last_error"],
+            )
+        )
+    if args.requeue:
+        print("Requeued %s items" % requeue(conn, rows))
+    else:
+        print("%s dead-lettered items" % len(rows))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,66 @@
 #!/usr/bin/env python3
 
-import argparse, diaspy, feedparser, html2text, os.path, re, sqlite3, time
-import urllib.parse
+import argparse, bisect, collections, contextlib, gzip, hashlib, itertools, json
+import math, os.path
+import random, re, sqlite3, sys, tempfile
+import threading, time, uuid, zlib
+import http.client, urllib.error, urllib.parse, urllib.request
+import xml.etree.ElementTree as ElementTree
 #import os
-import shcli
+
+# feedparser, html2text, requests and shcli are slow to import, and are
+# imported where they are used: fetch-only runs never post, and publish-only
+# runs never fetch
+
+
+WORD = re.compile(r"\w+")
+# texts with fewer words aren't fingerprinted, too many short ones look alike
+SIMHASH_MIN_WORDS = 8
+# how many bits the fingerprints of near-duplicates may differ in
+SIMHASH_DISTANCE = 3
+# bit i of SIMHASH_SPREAD[byte] is moved up to bit 32 * i, so summing them
+# counts how many bytes have each bit set
+SIMHASH_SPREAD = [sum((b >> i & 1) << (32 * i) for i in range(8)) for b in range(256)]
+# how much each new gap between updates counts in a feed's update_interval
+UPDATE_WEIGHT = 0.25
+# seconds in each sy:updatePeriod
+UPDATE_PERIODS = {
+    "hourly": 3600,
+    "daily": 86400,
+    "weekly": 604800,
+    "monthly": 2592000,
+    "yearly": 31536000,
+}
+# how an item's body, summary and rendered post are stored, in its compression
+# column. items loaded before it existed are plain text
+TEXT_PLAIN = 0
+TEXT_ZLIB = 1
+# with --compress, items with less text than this are still stored as plain
+# text, compressing them saves next to nothing
+COMPRESS_MIN_LENGTH = 512
+# sent when downloading feeds
+USER_AGENT = "sh_feeder (+https://github.com/norayr/sh_feeder)"
+# seconds to wait for a feed's server to connect or to send more data, and
+# for the whole download
+FETCH_TIMEOUT = (30, 300)
+# what a failed download raises: HTTP errors, unreachable servers, timeouts
+DOWNLOAD_ERRORS = (OSError, http.client.HTTPException)
+# what each of the metrics counts, see Metrics
+METRICS_HELP = {
+    "fetch_seconds": "Time to download a feed",
+    "fetch_bytes_total": "Bytes of feeds downloaded",
+    "fetch_responses_total": "Feed downloads by HTTP status",
+    "fetch_unchanged_total": "Downloads that were the same as the last one",
+    "parse_seconds": "Time to parse a downloaded feed, without --streaming",
+    "item_build_seconds": "Time to convert an entry into an item",
+    "ingest_seconds": "Time to load a feed's new items into the database",
+    "items_total": "Entries by whether they were new or already known",
+    "publish_seconds": "Time to publish a post",
+    "posts_total": "Publishing attempts by result",
+    "publish_retries_total": "Posts that had failed before",
+    "dead_letters_total": "Items given up on after --max-attempts failures",
+    "errors_total": "Feeds that failed, by stage",
+}
 
 
 class Feed:
@@ -19,213 +76,728 @@ class Feed:
         category_tags=False,
         ignore_tags=[],
         debug=False,
+        parsed=None,
+        etag=None,
+        modified=None,
+        digest=None,
+        db=None,
+        stop_at_known=False,
+        streaming=False,
+        seen=None,
+        render=None,
+        compress=False,
     ):
         self.auto_tags = auto_tags
         self.category_tags = category_tags
+        self.db = db
+        # an optional BloomFilter of seen_items, checked instead of the db
+        self.seen = seen
+        # the PodClient.format_post() options to render each item's post
+        # with as it is loaded, see post_options()
+        self.render = render
+        # store the text of large items compressed, see TEXT_ZLIB
+        self.compress = compress
+        self.stop_at_known = stop_at_known
+        self.streaming = streaming
         self.debug = debug
         self.ignore_tags = ignore_tags
         self.feed_id = feed_id
         self.url = url
-        self.feed = self.fetch(self.url)
-        self.entries = self.feed.get("entries", [])
-        self.items = self.get_items()
+        # the number of new items load_db() has committed so far
+        self.loaded = 0
+        # the feed may already have been fetched, e.g. by the batch runner
+        if parsed is None:
+            parsed = self.fetch(self.url, etag=etag, modified=modified, digest=digest)
+        self.feed = parsed
+        self.status = self.feed.get("status")
+        # nothing to do if the server says the feed hasn't changed, or it is
+        # the same download as last time
+        self.not_modified = self.status == 304 or self.feed.get("unchanged", False)
+        # the rest of the parsed feed is small, and kept for save_state()
+        self.entries = self.feed.pop("entries", [])
+        if self.not_modified:
+            self.items = []
+        elif self.streaming:
+            # entries and items are produced one at a time as load_db()
+            # consumes them
+            self.items = self.iter_items()
+        else:
+            self.items = self.get_items()
+            # the raw entries are much larger than the items
+            self.entries = []
 
     def get_items(self):
         """
-        returns a list of FeedItems
+        returns a list of FeedItems for the entries that aren't in the db yet
+        """
+        return list(self.iter_items())
+
+    def iter_items(self, chunk_size=500):
+        """
+        yields FeedItems for the entries that aren't in the db yet
+        """
+        entries = iter(self.entries)
+        skipped = 0
+        stop = False
+        while not stop:
+            chunk = list(itertools.islice(entries, chunk_size))
+            if not len(chunk):
+                break
+            known = self.known_guids(chunk)
+            for e in chunk:
+                # don't bother converting entries that load_db() would ignore
+                if known and entry_guid(e) in known:
+                    skipped += 1
+                    METRICS.inc("items_total", self.feed_id, result="known")
+                    if self.stop_at_known:
+                        stop = True
+                        break
+                    continue
+                yield self.get_item(e)
+        if self.debug and skipped:
+            print("skipped %s known items" % skipped)
+
+    def get_item(self, e):
         """
-        items = []
-        for e in self.entries:
+        returns a FeedItem for a single entry
+        """
+        with METRICS.timer("item_build_seconds", self.feed_id):
             item = FeedItem(e, category_tags=self.category_tags)
             item.add_tags(self.auto_tags)
             item.remove_tags(self.ignore_tags)
-            items.append(item)
-            if self.debug:
-                print()
-                print("guid\t: %s" % item.guid)
-                print("title\t: %s" % item.title)
-                print("link\t: %s" % item.link)
-                print("image\t: %s" % item.image)
-                print("tags\t: %s" % ", ".join(item.tags))
-                print("time\t: %s" % item.timestamp)
-                # print('body\t: %s' % item.body)
-                # print('summary\t: %s' % item.summary)
-                print()
-        return items
-
-    def fetch(self, url=None):
-        """
-        returns a parsed feed from feedparser
-        """
-        if url is None:
-            f = feedparser.parse(self.url)
-        else:
-            f = feedparser.parse(url)
-        return f
+        if self.debug:
+            print()
+            print("guid\t: %s" % item.guid)
+            print("title\t: %s" % item.title)
+            print("link\t: %s" % item.link)
+            print("image\t: %s" % item.image)
+            print("tags\t: %s" % ", ".join(item.tags))
+            print("time\t: %s" % item.timestamp)
+            # print('body\t: %s' % item.body)
+            # print('summary\t: %s' % item.summary)
+            print()
+        return item
+
+    def known_guids(self, entries):
+        """
+        returns the set of entry ids that have been seen in this feed before,
+        according to the seen filter if there is one, or else the db.
+        keep entries below sqlite's limit on the number of bound parameters
+        """
+        if self.seen is None and self.db is None:
+            return set()
+        keys = {}
+        for guid in map(entry_guid, entries):
+            keys[seen_key(self.feed_id, guid)] = guid
+        if self.seen is not None:
+            return set(guid for key, guid in keys.items() if key in self.seen)
+        rows = self.db.execute(
+            "SELECT key FROM seen_items WHERE key IN (%s)" % ", ".join("?" * len(keys)),
+            list(keys),
+        )
+        return set(keys[r[0]] for r in rows)
+
+    def fetch(self, url=None, etag=None, modified=None, digest=None):
+        """
+        returns a parsed feed from feedparser, or the streaming parser
+        """
+        return fetch_feed(
+            self.url if url is None else url,
+            etag,
+            modified,
+            streaming=self.streaming,
+            digest=digest,
+        )
 
-    def load_db(self, conn):
+    def save_state(self, conn, new=0):
         """
-        updates feeds table with new items
+        remember the feed's HTTP validators for the next conditional GET and
+        its hints on how often to fetch it (see feed_hints()). if new items
+        were loaded, count this as an update of the feed in its
+        update_interval, a moving average of the time between updates
         """
-        for i in self.items:
-            # check to see if the item is already in the db
-            row = conn.execute(
-                "SELECT guid FROM feeds WHERE guid = ?", (i.guid,)
+        now = int(time.time())
+        if self.not_modified:
+            conn.execute(
+                "UPDATE feed_state SET checked = ? WHERE feed_id = ?",
+                (now, self.feed_id),
+            )
+        else:
+            length = self.feed.get("headers", {}).get("content-length")
+            wait, skip_hours = feed_hints(self.feed.get("feed", {}))
+            conn.execute(
+                "INSERT INTO feed_state(feed_id, url, etag, modified, length, \
+                fetch_time, checked, hint_wait, skip_hours, digest) \
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(feed_id) DO UPDATE \
+                SET url = excluded.url, etag = excluded.etag, \
+                modified = excluded.modified, length = excluded.length, \
+                fetch_time = excluded.fetch_time, checked = excluded.checked, \
+                hint_wait = excluded.hint_wait, skip_hours = excluded.skip_hours, \
+                digest = excluded.digest",
+                (
+                    self.feed_id,
+                    self.url,
+                    self.feed.get("etag"),
+                    self.feed.get("modified"),
+                    int(length) if length is not None else None,
+                    self.feed.get("elapsed"),
+                    now,
+                    wait,
+                    ",".join(str(h) for h in skip_hours),
+                    self.feed.get("digest"),
+                ),
+            )
+        if new:
+            last_update, interval = conn.execute(
+                "SELECT last_update, update_interval FROM feed_state \
+                WHERE feed_id = ?",
+                (self.feed_id,),
             ).fetchone()
-            if row is None:
-                hashtags = " ".join(i.tags)
-                # if not, insert it
-                conn.execute(
-                    "INSERT INTO feeds(guid, feed_id, title, body, summary, \
-                    link, image, image_title, hashtags, posted, timestamp) \
-                    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            if last_update is not None and now > last_update:
+                if interval is None:
+                    interval = now - last_update
+                else:
+                    interval += UPDATE_WEIGHT * (now - last_update - interval)
+            conn.execute(
+                "UPDATE feed_state SET last_update = ?, update_interval = ? \
+                WHERE feed_id = ?",
+                (now, interval, self.feed_id),
+            )
+        conn.commit()
+
+    def load_db(self, conn, chunk_size=500):
+        """
+        updates feeds table with new items, returns the number of new items.
+        each chunk of items is read before its transaction starts, so with
+        --streaming the feed isn't parsed while the database is locked
+        """
+        client = PodClient()
+        items = iter(self.items)
+        self.loaded = 0
+        try:
+            while True:
+                chunk = list(itertools.islice(items, chunk_size))
+                if not len(chunk):
+                    break
+                self.loaded += retry_locked(conn, self.load_chunk, conn, chunk, client)
+        finally:
+            # with --streaming, the chunks before a parse error are kept
+            METRICS.inc("items_total", self.feed_id, self.loaded, result="new")
+        return self.loaded
+
+    def load_chunk(self, conn, items, client):
+        """
+        inserts some of the items in a single transaction,
+        returns the number of new items
+        """
+        added = []
+        known = 0
+        with conn:
+            for i in items:
+                # items that have been seen before are skipped, even if
+                # clean_db has since deleted them from the feeds table
+                key = seen_key(self.feed_id, i.guid)
+                if not conn.execute(
+                    "INSERT OR IGNORE INTO seen_items(key) VALUES(?)", (key,)
+                ).rowcount:
+                    known += 1
+                    continue
+                content = {
+                    "title": i.title,
+                    "body": i.body,
+                    "summary": i.summary,
+                    "link": i.link,
+                    "image": i.image,
+                    "image_title": "image",
+                    "hashtags": " ".join(i.tags),
+                }
+                rendered = None
+                if self.render is not None:
+                    rendered = render_post(client, content, self.render)
+                body, summary = i.body, i.summary
+                compression = TEXT_PLAIN
+                length = len(body or "") + len(summary or "")
+                if self.compress and length >= COMPRESS_MIN_LENGTH:
+                    compression = TEXT_ZLIB
+                    body, summary = compress_text(body), compress_text(summary)
+                    rendered = compress_text(rendered)
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO feeds(guid, feed_id, title, body, summary, \
+                    link, image, image_title, hashtags, posted, timestamp, simhash, \
+                    rendered, compression) \
+                    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                     (
                         i.guid,
                         self.feed_id,
-                        i.title,
-                        i.body,
-                        i.summary,
-                        i.link,
-                        i.image,
-                        "image",
-                        hashtags,
-                        "0",
+                        content["title"],
+                        body,
+                        summary,
+                        content["link"],
+                        content["image"],
+                        content["image_title"],
+                        content["hashtags"],
+                        0,
                         i.timestamp,
+                        i.simhash,
+                        rendered,
+                        compression,
                     ),
                 )
-                conn.commit()
+                if cursor.rowcount and i.simhash is not None:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO fingerprints(band, guid) VALUES(?, ?)",
+                        [(band, i.guid) for band in simhash_bands(i.simhash)],
+                    )
+                added.append((key, cursor.rowcount))
+        if known:
+            METRICS.inc("items_total", self.feed_id, known, result="known")
+        if self.seen is not None:
+            for key, new in added:
+                self.seen.add(key)
+        return sum(new for key, new in added)
 
 
-class FeedItem:
+class StreamingParser:
     """
-    relevant fields extracted from a feed entry
+    a minimal, incremental RSS/Atom parser for very large feeds.
+    only the fields FeedItem uses are extracted, in the same shape as
+    feedparser's entries, and each entry is discarded as soon as it has
+    been read. unlike feedparser, HTML is not sanitized and relative links
+    are not resolved
     """
 
-    def __init__(self, entry, category_tags=False):
-        self.posted = False
-        self.guid = self.get_id(entry)
-        self.image = self.get_image(entry)
-        self.title = entry.get("title")
-        self.link = entry.get("link")
-        self.timestamp = int(time.time())
-        self.body = self.get_body(entry.get("content"))
-        self.summary = self.get_summary(entry.get("summary_detail"))
-        self.tags = []
-        if category_tags:
-            self.get_tags(entry.get("tags", []))
+    ATOM = "http://www.w3.org/2005/Atom"
+    CONTENT = "http://purl.org/rss/1.0/modules/content/"
+    DC = "http://purl.org/dc/elements/1.1/"
+    MEDIA = "http://search.yahoo.com/mrss/"
+    RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+    RSS1 = "http://purl.org/rss/1.0/"
+    SY = "http://purl.org/rss/1.0/modules/syndication/"
 
-    def get_id(self, entry):
+    ENTRY_TAGS = ("item", "{%s}entry" % ATOM, "{%s}item" % RSS1)
+    CHANNEL_TAGS = ("channel", "{%s}channel" % RSS1)
+
+    # atom text construct types, as reported by feedparser
+    TEXT_TYPES = {
+        "text": "text/plain",
+        "html": "text/html",
+        "xhtml": "application/xhtml+xml",
+    }
+
+    def parse(self, source, feed=None):
         """
-        some feeds don't have an id-element.
-        use the hashed link in that case.
+        yields an entry dict for every item in a file-like object. the
+        channel's hints on how often to fetch it are added to the feed dict
+        as they are read, if there is one
         """
-        if entry.get("id") is not None:
-            return entry.get("id")
+        parents = []
+        for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+            if event == "start":
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag in self.ENTRY_TAGS:
+                yield self.get_entry(elem)
+                # drop the entry so memory use doesn't grow with the feed
+                elem.clear()
+                if len(parents):
+                    parents[-1].remove(elem)
+            elif feed is not None and len(parents):
+                if parents[-1].tag in self.CHANNEL_TAGS:
+                    self.get_hint(elem, feed)
+
+    def get_entry(self, elem):
+        """
+        returns the feedparser-style fields of a single item
+        """
+        entry = {"links": [], "tags": [], "media_content": [], "media_thumbnail": []}
+        if elem.get("{%s}about" % self.RDF) is not None:
+            entry["id"] = elem.get("{%s}about" % self.RDF)
+        for child in elem:
+            ns, name = self.split_tag(child.tag)
+            text = (child.text or "").strip()
+            if name == "guid" or (ns == self.ATOM and name == "id"):
+                entry["id"] = text
+                # an rss guid may double as the item's link
+                if child.get("isPermaLink", "true") == "true" and ns != self.ATOM:
+                    if text.startswith(("http://", "https://")):
+                        entry.setdefault("link", text)
+            elif name == "title":
+                entry["title"] = text
+            elif name == "link" and ns == self.ATOM:
+                link = {
+                    "rel": child.get("rel", "alternate"),
+                    "type": child.get("type", ""),
+                    "href": child.get("href"),
+                }
+                entry["links"].append(link)
+                if link["rel"] == "alternate":
+                    entry["link"] = link["href"]
+            elif name == "link":
+                entry["link"] = text
+            elif name == "enclosure":
+                entry["links"].append(
+                    {
+                        "rel": "enclosure",
+                        "type": child.get("type", ""),
+                        "href": child.get("url"),
+                    }
+                )
+            elif name == "description" or (ns == self.ATOM and name == "summary"):
+                entry["summary_detail"] = self.get_text(child)
+                entry["summary"] = entry["summary_detail"]["value"]
+            elif (ns == self.CONTENT and name == "encoded") or (
+                ns == self.ATOM and name == "content"
+            ):
+                entry["content"] = [self.get_text(child)]
+            elif name == "category":
+                entry["tags"].append({"term": child.get("term", text)})
+            elif ns == self.DC and name == "subject":
+                entry["tags"].append({"term": text})
+            elif ns == self.MEDIA:
+                self.get_media(child, entry)
+        return entry
+
+    def get_hint(self, elem, feed):
+        """
+        store <ttl>, <sy:updatePeriod>, <sy:updateFrequency> and <skipHours>
+        under the same keys as feedparser, except for skipHours which
+        feedparser doesn't keep
+        """
+        ns, name = self.split_tag(elem.tag)
+        if name == "ttl":
+            feed["ttl"] = (elem.text or "").strip()
+        elif ns == self.SY and name in ("updatePeriod", "updateFrequency"):
+            feed["sy_" + name.lower()] = (elem.text or "").strip()
+        elif name == "skipHours":
+            feed["skip_hours"] = [(h.text or "").strip() for h in elem]
+
+    def get_media(self, elem, entry):
+        """
+        collect media:content and media:thumbnail urls, including the ones
+        nested in media:group or media:content
+        """
+        ns, name = self.split_tag(elem.tag)
+        if name == "content" and elem.get("url") is not None:
+            entry["media_content"].append({"url": elem.get("url")})
+        elif name == "thumbnail" and elem.get("url") is not None:
+            entry["media_thumbnail"].append({"url": elem.get("url")})
+        for child in elem:
+            if self.split_tag(child.tag)[0] == self.MEDIA:
+                self.get_media(child, entry)
+
+    def get_text(self, elem):
+        """
+        returns a feedparser-style {"type", "value"} dict
+        """
+        ns, name = self.split_tag(elem.tag)
+        if ns != self.ATOM:
+            return {"type": "text/html", "value": elem.text or ""}
+        content_type = elem.get("type", "text")
+        content_type = self.TEXT_TYPES.get(content_type, content_type)
+        if content_type == "application/xhtml+xml":
+            # the content is the markup inside the element
+            value = (elem.text or "") + "".join(
+                ElementTree.tostring(c, encoding="unicode") for c in elem
+            )
         else:
-            return hash(entry.get("link"))
+            value = elem.text or ""
+        return {"type": content_type, "value": value}
 
-    def get_body(self, content):
+    def split_tag(self, tag):
         """
-        convert the first item in the 'content' list
+        split '{namespace}name' into its parts
         """
-        if content is not None:
-            for c in content:
-                return self.html2markdown(c).strip()
-                break
+        if tag[:1] == "{":
+            ns, name = tag[1:].split("}", 1)
+            return ns, name
+        return "", tag
 
-    def get_image(self, entry):
+
+class ImageExtractor:
+    """
+    finds a "cover" image for a feed entry.
+    strategies are tried in order until one returns an image link. each one
+    is either the name of a built-in strategy (see STRATEGIES) or a callable
+    taking the entry and a scan function, which returns the best image link
+    in a string of text or HTML
+    """
+
+    STRATEGIES = (
+        "media_content",
+        "media_thumbnail",
+        "links",
+        "content",
+        "summary_detail",
+        "summary",
+    )
+
+    # candidates in HTML, in order of preference: <img src>, og:image or
+    # twitter:image <meta> tags, then bare links to image files.
+    # each pattern starts with a literal, so re can skip ahead to possible
+    # matches instead of trying an alternation at every position
+    IMG_TAG = re.compile(r"<img\s[^>]*>", re.IGNORECASE)
+    IMG_SRC = re.compile(r"\bsrc\s*=\s*[\"']?(https?://[^\"'\s>]+)", re.IGNORECASE)
+    # tracking pixels, e.g. feedburner's /~r/.../~4/... ones at the end of
+    # each entry, are <img> tags with a width or height of 0 or 1
+    PIXEL = re.compile(
+        r"\b(?:width|height)\s*=\s*[\"']?[01](?:px)?(?![\w.%])", re.IGNORECASE
+    )
+    META_TAG = re.compile(
+        r"<meta\s[^>]*?\b(?:property|name)\s*=\s*[\"']?(?:og|twitter):image[\"'\s]"
+        r"[^>]*?\bcontent\s*=\s*[\"']?(https?://[^\"'\s>]+)",
+        re.IGNORECASE,
+    )
+    # unlike [^'"]*, this can't run past the end of the url and backtrack
+    IMAGE_LINK = re.compile(
+        r"https?://[^\s'\"<>]*\.(?:gif|jpe?g|png|tiff?|webp)", re.IGNORECASE
+    )
+
+    def __init__(self, strategies=None):
+        self.strategies = []
+        for strategy in strategies or self.STRATEGIES:
+            if isinstance(strategy, str):
+                strategy = getattr(self, "from_" + strategy)
+            self.strategies.append(strategy)
+
+    def extract(self, entry):
         """
-        try to find a "cover" image for the entry, wherever it may be hiding
+        returns the first image link found by the strategies, or None
         """
-        media_content = self.get_image_from_media_content(
-            entry.get("media_content", {})
-        )
-        if media_content is not None:
-            return media_content
-        media_thumbnail = self.get_image_from_media_thumbnail(
-            entry.get("media_thumbnail", {})
-        )
-        if media_thumbnail is not None:
-            return media_thumbnail
-        links = self.get_image_from_links(entry.get("links", {}))
-        if links is not None:
-            return links
-        content = self.get_image_from_content(entry.get("content", []))
-        if content is not None:
-            return content
-        summary_detail = self.get_image_from_summary_detail(
-            entry.get("summary_detail", {})
-        )
-        if summary_detail is not None:
-            return summary_detail
-        summary = self.get_image_from_summary(entry.get("summary", ""))
-        if summary is not None:
-            return summary
+        # content, summary_detail and summary are often the same text,
+        # only scan each one once
+        scanned = {}
+
+        def scan(text):
+            if text not in scanned:
+                scanned[text] = self.find_image_link(text)
+            return scanned[text]
+
+        for strategy in self.strategies:
+            image = strategy(entry, scan)
+            if image is not None:
+                return image
 
-    def get_image_from_media_content(self, media_content):
+    def find_image_link(self, text):
         """
-        tries to get an image link from the "media_content" data
+        search a string for the best embedded image link
         """
-        if isinstance(media_content, list) and len(media_content):
-            for media in media_content:
-                m = self.find_image_link(media.get("url", ""))
+        if not text:
+            return None
+        pixels = []
+        if "<" in text:
+            for tag in self.IMG_TAG.finditer(text):
+                if self.PIXEL.search(tag.group(0)):
+                    pixels.append(tag.span())
+                    continue
+                m = self.IMG_SRC.search(tag.group(0))
                 if m is not None:
-                    return m
+                    return m.group(1)
+            m = self.META_TAG.search(text)
+            if m is not None:
+                return m.group(1)
+        for m in self.IMAGE_LINK.finditer(text):
+            # the pixels are skipped even if their links look like image files
+            if not any(start <= m.start() < end for start, end in pixels):
+                return m.group(0)
+
+    def from_media_content(self, entry, scan):
+        """
+        tries to get an image link from the "media_content" data
+        """
+        return self.from_media(entry.get("media_content"))
 
-    def get_image_from_media_thumbnail(self, media_thumbnail):
+    def from_media_thumbnail(self, entry, scan):
         """
         tries to get an image link from the "media_thumbnail" data
         """
-        if isinstance(media_thumbnail, list) and len(media_thumbnail):
-            for media in media_thumbnail:
-                m = self.find_image_link(media.get("url", ""))
+        return self.from_media(entry.get("media_thumbnail"))
+
+    def from_media(self, media_list):
+        if isinstance(media_list, list):
+            for media in media_list:
+                m = self.IMAGE_LINK.search(media.get("url", ""))
                 if m is not None:
-                    return m
+                    return m.group(0)
 
-    def get_image_from_links(self, links):
+    def from_links(self, entry, scan):
         """
         tries to get an image link from the "links" data
         """
-        if isinstance(links, list) and len(links):
+        links = entry.get("links")
+        if isinstance(links, list):
             for link in links:
-                if re.match("image\/", link.get("type", "")):
+                if link.get("type", "").startswith("image/"):
                     return link.get("href")
 
-    def get_image_from_content(self, content):
+    def from_content(self, entry, scan):
         """
         tries to get an image link from the "content" data
         """
-        if isinstance(content, list) and len(content):
+        content = entry.get("content")
+        if isinstance(content, list):
             for c in content:
-                m = self.find_image_link(c.get("value", ""))
+                m = scan(c.get("value", ""))
                 if m is not None:
                     return m
 
-    def get_image_from_summary_detail(self, summary_detail):
+    def from_summary_detail(self, entry, scan):
         """
         tries to get an image link from the "summary_detail" data
         """
-        m = self.find_image_link(summary_detail.get("value", ""))
-        if m is not None:
-            return m
+        return scan(entry.get("summary_detail", {}).get("value", ""))
 
-    def get_image_from_summary(self, summary):
+    def from_summary(self, entry, scan):
         """
         tries to get an image link from the "summary" text
         """
-        m = self.find_image_link(summary)
-        if m is not None:
-            return m
+        return scan(entry.get("summary", ""))
 
-    def find_image_link(self, content):
+
+class HtmlConverter:
+    """
+    converts HTML to Markdown. one configured instance is shared by every
+    FeedItem; subclass it and override handle() to use another backend
+    """
+
+    # appended to the output when the input was cut short
+    TRUNCATED = "\n\n[…]"
+
+    def __init__(self, max_length=262144, cache_size=8):
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    def convert(self, html):
+        """
+        returns the Markdown for a string of HTML
+        """
+        # an entry's content and summary are often the same document
+        if html in self.cache:
+            self.cache.move_to_end(html)
+            return self.cache[html]
+        truncated = self.max_length and len(html) > self.max_length
+        if truncated:
+            text = self.handle(self.truncate(html)).rstrip() + self.TRUNCATED
+        else:
+            text = self.handle(html)
+        if self.cache_size:
+            self.cache[html] = text
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return text
+
+    def truncate(self, html):
+        """
+        cut html down to max_length, without splitting a tag
+        """
+        cut = html.rfind("<", 0, self.max_length)
+        return html[: cut if cut > 0 else self.max_length]
+
+    def handle(self, html):
         """
-        search a string for an embedded image link
+        convert with html2text. its parser keeps state from the document it
+        last handled, so it is cheaper to make a new one than to reset it
         """
-        m = re.search(
-            "(https?:\/\/[^'\"]*\.(gif|jpe?g|png|tiff?|webp))", content, re.IGNORECASE
+        import html2text
+
+        text_maker = html2text.HTML2Text(bodywidth=0)
+        return text_maker.handle(html)
+
+
+class Tags:
+    """
+    an ordered set of hashtags, in the order they were added
+    """
+
+    __slots__ = ("tags",)
+
+    def __init__(self, tags=()):
+        self.tags = dict.fromkeys(tags)
+
+    def add(self, tag):
+        self.tags[tag] = None
+
+    def remove(self, tag):
+        del self.tags[tag]
+
+    def __contains__(self, tag):
+        return tag in self.tags
+
+    def __iter__(self):
+        return iter(self.tags)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __eq__(self, other):
+        try:
+            return list(self.tags) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return "Tags(%r)" % list(self.tags)
+
+
+class FeedItem:
+    """
+    relevant fields extracted from a feed entry. there may be many of them
+    at once, so they have no per-instance __dict__
+    """
+
+    __slots__ = (
+        "posted",
+        "guid",
+        "image",
+        "title",
+        "link",
+        "timestamp",
+        "body",
+        "summary",
+        "simhash",
+        "tags",
+    )
+    image_extractor = ImageExtractor()
+    converter = HtmlConverter()
+
+    def __init__(self, entry, category_tags=False):
+        self.posted = False
+        self.guid = self.get_id(entry)
+        self.image = self.get_image(entry)
+        self.title = entry.get("title")
+        self.link = entry.get("link")
+        self.timestamp = int(time.time())
+        self.body = self.get_body(entry.get("content"))
+        self.summary = self.get_summary(entry.get("summary_detail"))
+        self.simhash = simhash(
+            "%s\n%s" % (self.title or "", self.body or self.summary or "")
         )
-        if m:
-            return m.group(1)
+        self.tags = Tags()
+        if category_tags:
+            self.get_tags(entry.get("tags", []))
+
+    def get_id(self, entry):
+        """
+        some feeds don't have an id-element.
+        use a digest of the link in that case.
+        """
+        return entry_guid(entry)
+
+    def get_body(self, content):
+        """
+        convert the first item in the 'content' list
+        """
+        if content is not None:
+            for c in content:
+                return self.html2markdown(c).strip()
+                break
+
+    def get_image(self, entry):
+        """
+        try to find a "cover" image for the entry, wherever it may be hiding
+        """
+        return self.image_extractor.extract(entry)
 
     def get_summary(self, summary):
         """
@@ -250,9 +822,7 @@ class FeedItem:
         text = None
         if text_obj is not None:
             if text_obj.get("type") == "text/html":
-                text_maker = html2text.HTML2Text()
-                text_maker.body_width = 0
-                text = text_maker.handle(text_obj.get("value"))
+                text = self.converter.convert(text_obj.get("value"))
             else:
                 text = text_obj.get("value")
         return text.rstrip()
@@ -270,7 +840,7 @@ class FeedItem:
         for tag in tags:
             t = self.sanitize_tag(tag)
             if len(t) and t not in self.tags:
-                self.tags.append(t)
+                self.tags.add(t)
 
     def remove_tags(self, tags):
         """
@@ -287,8 +857,42 @@ class PodClient:
     handle interactions with the pod
     """
 
-    def __init__(self, url=None, token=None):
+    # seconds to wait for a connection and for the response
+    TIMEOUT = (10, 60)
+
+    def __init__(self, url=None, token=None, backend="api", session=None):
         self.url = url
+        self.token = token
+        self.backend = backend
+        # clients may share a session, to reuse its connections
+        self.session = session
+
+    @staticmethod
+    def new_session(pool_size=4):
+        """
+        returns a requests session which keeps up to pool_size connections
+        per host open between posts
+        """
+        import requests, requests.adapters
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(
+            {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+        )
+        return session
+
+    def get_api_url(self):
+        """
+        returns the content API endpoint, the pod URL may omit the scheme
+        """
+        if urllib.parse.urlsplit(self.url).scheme in ("http", "https"):
+            return "%s/api/content/" % self.url.rstrip("/")
+        return "https://%s/api/content/" % self.url.strip("/")
 
     def post(self, message, via=None):
         """
@@ -297,12 +901,20 @@ class PodClient:
         #if len(aspect_ids) == 0:
         #    aspect_ids.append("public")
         #self.stream.post(text=message, provider_display_name=via, token)
-        print (self.token)
-        print (message)
-        print (self.url)
-        #cmd = "~/.local/bin/shcli create " + self.url + " " + self.token + " -t '" + message + "' -v public"
-        #os.system(cmd)
-        shcli.create(self.url, self.token, message, "public")
+        if self.backend == "shcli":
+            import shcli
+
+            return shcli.create(self.url, self.token, message, "public")
+        if self.session is None:
+            self.session = self.new_session()
+        response = self.session.post(
+            self.get_api_url(),
+            headers={"Authorization": "Token %s" % self.token},
+            data={"text": message, "visibility": "public"},
+            timeout=self.TIMEOUT,
+        )
+        response.raise_for_status()
+        return response.json()
 
     def format_post(
         self,
@@ -345,87 +957,1052 @@ class PodClient:
 
     def publish(self, content, args):
         """
-        generate message text and post it to D*
+        generate message text and post it to D*. items rendered when they
+        were loaded are posted as they are, see --render-at-ingest
         """
-        message = self.format_post(
-            content,
-            body=args.full,
-            embed_image=args.embed_image,
-            post_raw_link=args.post_raw_link,
-            summary=args.summary,
-            no_branding=args.no_branding,
-        )
-        self.token=args.token
+        message = decompress_text(content["rendered"], content["compression"])
+        if message is None:
+            message = self.format_post(decompress_item(content), **post_options(args))
         self.post(message, via=args.via)
         return True
 
 
-def initialize_db(conn):
-    # create the feeds table
-    conn.execute(
-        "CREATE TABLE feeds(guid VARCHAR(255) PRIMARY KEY, \
-        feed_id VARCHAR(127), title VARCHAR(255), link VARCHAR(255), \
-        image VARCHAR(255), image_title VARCHAR(255), \
-        hashtags VARCHAR(255), timestamp INTEGER(10), posted INTEGER(1), \
-        body VARCHAR(10240), summary VARCHAR(2048))"
-    )
+class TokenBucket:
+    """
+    a thread-safe token bucket rate limiter: allows rate actions per second
+    on average, with bursts of up to burst actions. a rate of 0 means no limit
+    """
 
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-def alter_db(conn):
-    # check to see if this is a v1 database schema
-    summary_exists = False
-    rows = conn.execute("PRAGMA table_info('feeds')").fetchall()
-    for r in rows:
-        if "summary" in r:
-            summary_exists = True
-            break
-    if summary_exists == False:
-        # if the summary column doesn't exist, add it
-        conn.execute("ALTER TABLE feeds ADD COLUMN summary VARCHAR(2048)")
+    def acquire(self):
+        """
+        take a token, waiting for one to become available if necessary
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BloomFilter:
+    """
+    a set of seen_items keys that may wrongly claim to contain a key, with
+    a probability of about error_rate while it holds up to capacity keys,
+    but never misses one. uses a few bytes per key
+    """
+
+    def __init__(self, capacity, error_rate=1e-6):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = int(-self.capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def from_db(cls, conn, error_rate=1e-6, headroom=2):
+        """
+        returns a filter of every key in seen_items, with room for the table
+        to grow headroom times before the error rate goes up
+        """
+        count = conn.execute("SELECT COUNT(*) FROM seen_items").fetchone()[0]
+        bloom = cls(count * headroom + 10000, error_rate)
+        for row in conn.execute("SELECT key FROM seen_items"):
+            bloom.add(row[0])
+        return bloom
+
+    def positions(self, key):
+        """
+        the keys are already uniformly distributed hashes, so the bit
+        positions are derived from the key itself by double hashing
+        """
+        h1 = int.from_bytes(key[:8], "little")
+        h2 = int.from_bytes(key[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class Metrics:
+    """
+    thread-safe counters and histograms of the stages of a run, labelled by
+    feed_id and any other labels, see METRICS_HELP. they only ever go up, as
+    Prometheus expects, so in a daemon they cover its whole lifetime
+    """
+
+    # upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # {name: {labels: value}}, labels being a tuple of (name, value) pairs
+        self.counters = {}
+        # {name: {labels: [count in each bucket, ..., count over them, sum]}}
+        self.histograms = {}
+
+    def labels(self, feed_id, labels):
+        return (("feed_id", feed_id),) + tuple(sorted(labels.items()))
+
+    def inc(self, name, feed_id, value=1, **labels):
+        """
+        add value to a counter
+        """
+        key = self.labels(feed_id, labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, feed_id, seconds, **labels):
+        """
+        add a duration to a histogram
+        """
+        key = self.labels(feed_id, labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            series[key][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            series[key][-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, feed_id, **labels):
+        """
+        add the time spent in the with block to a histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, feed_id, time.perf_counter() - start, **labels)
+
+    def summary(self):
+        """
+        returns a dict of each feed's counters, and the count and sum of its
+        histograms. counters with more labels than feed_id are dicts keyed
+        by the other labels' values
+        """
+        feeds = {}
+        with self.lock:
+            values = [(n, k, v) for n, s in self.counters.items() for k, v in s.items()]
+            for name, series in self.histograms.items():
+                for key, h in series.items():
+                    values.append(
+                        (name, key, {"count": sum(h[:-1]), "sum": round(h[-1], 6)})
+                    )
+        for name, key, value in sorted(values, key=lambda v: v[:2]):
+            stats = feeds.setdefault(key[0][1], {})
+            if len(key) == 1:
+                stats[name] = value
+            else:
+                stats.setdefault(name, {})[",".join(str(v) for k, v in key[1:])] = value
+        return {"started": int(self.started), "time": int(time.time()), "feeds": feeds}
+
+    def prometheus(self, prefix="sh_feeder_"):
+        """
+        returns the metrics in the Prometheus text format
+        """
+
+        def labels(key, extra=()):
+            pairs = []
+            for k, v in key + extra:
+                v = str(v).replace("\\", "\\\\").replace('"', '\\"')
+                pairs.append('%s="%s"' % (k, v.replace("\n", "\\n")))
+            return "{%s}" % ",".join(pairs)
+
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append("# HELP %s%s %s" % (prefix, name, METRICS_HELP[name]))
+                lines.append("# TYPE %s%s counter" % (prefix, name))
+                for key, value in sorted(series.items()):
+                    lines.append("%s%s%s %s" % (prefix, name, labels(key), value))
+            for name, series in sorted(self.histograms.items()):
+                lines.append("# HELP %s%s %s" % (prefix, name, METRICS_HELP[name]))
+                lines.append("# TYPE %s%s histogram" % (prefix, name))
+                for key, h in sorted(series.items()):
+                    count = 0
+                    for le, n in zip(self.BUCKETS + ("+Inf",), h):
+                        count += n
+                        lines.append(
+                            "%s%s_bucket%s %s"
+                            % (prefix, name, labels(key, (("le", le),)), count)
+                        )
+                    lines.append("%s%s_sum%s %r" % (prefix, name, labels(key), h[-1]))
+                    lines.append("%s%s_count%s %s" % (prefix, name, labels(key), count))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, file):
+        """
+        save the summary(), as a JSON run summary
+        """
+        write_file(file, json.dumps(self.summary(), indent=2, sort_keys=True) + "\n")
+
+    def write_prometheus(self, file):
+        """
+        save the metrics for node_exporter's textfile collector, which
+        expects the file to be replaced at once
+        """
+        write_file(file, self.prometheus())
+
+
+# the metrics of this process
+METRICS = Metrics()
+
+
+def write_file(file, text):
+    """
+    replace a file atomically, so readers never see half of it
+    """
+    directory, name = os.path.split(os.path.abspath(file))
+    fd, temp = tempfile.mkstemp(prefix="." + name, dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(text)
+        # mkstemp() makes it private, the collector may run as another user
+        os.chmod(temp, 0o644)
+        os.replace(temp, file)
+    except BaseException:
+        os.unlink(temp)
+        raise
 
 
-def connect_db(file):
+def seen_key(feed_id, guid):
     """
-    connect to the database and initialize if necessary
+    returns the fixed-width key of an item in the seen_items table
     """
-    # check to see if a new database needs to be initialized
-    init_db = False if os.path.isfile(file) else True
-    conn = sqlite3.connect(file)
-    if init_db:
-        initialize_db(conn)
+    return hashlib.blake2b(
+        ("%s\n%s" % (feed_id, guid)).encode("utf-8"), digest_size=12
+    ).digest()
+
+
+def entry_guid(entry):
+    """
+    returns the id of a feed entry, or a digest of its link (or title) if it
+    has none
+    """
+    if entry.get("id") is not None:
+        return entry.get("id")
     else:
-        alter_db(conn)
-    conn.row_factory = sqlite3.Row
-    return conn
+        # not hash(), which differs from one run to the next
+        text = entry.get("link") or entry.get("title") or ""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
-def publish_items(db, client, args=None):
+def simhash(text):
     """
-    find queued items in the database and publish them
+    returns the 64-bit SimHash fingerprint of the words in a text, as a
+    signed integer like sqlite stores it, or None if the text is too short
+    to tell it apart from unrelated ones. the more alike two texts are, the
+    fewer bits their fingerprints differ in
     """
-    query = "SELECT guid, title, link, image, image_title, hashtags, body, \
-        summary FROM feeds WHERE feed_id == ? AND posted == 0 \
-        AND timestamp > ? ORDER BY timestamp"
-    if args.limit > 0:
-        query = query + " LIMIT %s" % args.limit
-    timeout = int(time.time() - args.timeout * 3600)
-    for row in db.execute(query, (args.feed_id, timeout)):
-        if not args.quiet:
-            print("Publishing %s\t%s" % (args.feed_id, row["guid"]))
-        if client.publish(row, args):
-            db.execute("UPDATE feeds SET posted = 1 WHERE guid = ?", (row["guid"],))
-            db.commit()
+    words = WORD.findall(text.lower())
+    if len(words) < SIMHASH_MIN_WORDS:
+        return None
+    digests = b"".join(
+        hashlib.blake2b(w.encode("utf-8"), digest_size=8).digest() for w in words
+    )
+    fingerprint = 0
+    for j in range(8):
+        # count how often each bit of the j-th byte of the digests is set,
+        # see SIMHASH_SPREAD
+        lanes = 0
+        for byte, count in collections.Counter(digests[j::8]).items():
+            lanes += SIMHASH_SPREAD[byte] * count
+        for i in range(8):
+            if (lanes >> (32 * i) & 0xFFFFFFFF) * 2 > len(words):
+                fingerprint |= 1 << (8 * j + i)
+    return fingerprint - (1 << 64) if fingerprint >> 63 else fingerprint
 
 
-def parse_args():
+def simhash_bands(fingerprint):
     """
-    proccess command line args
+    returns the fingerprints table keys of a fingerprint: each of its four
+    16-bit bands, tagged with the band's number. fingerprints that differ in
+    at most SIMHASH_DISTANCE bits have at least one of them in common
     """
-    parser = argparse.ArgumentParser()
-    #parser.add_argument(
-    #    "--aspect-id",
-    #    help="Numerical aspect ID to share with. \
-    #        May be specified multiple times (default: 'public')",
+    return [i << 16 | fingerprint >> (16 * i) & 0xFFFF for i in range(4)]
+
+
+def simhash_distance(a, b):
+    """
+    returns the number of bits two fingerprints differ in
+    """
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def compress_text(text):
+    """
+    returns a body, summary or post zlib-compressed, see TEXT_ZLIB. None
+    stays None
+    """
+    return None if text is None else zlib.compress(text.encode("utf-8"))
+
+
+def decompress_text(value, compression):
+    """
+    returns the text of a body, summary or post stored with compression
+    """
+    if compression == TEXT_ZLIB and isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+
+def decompress_item(row):
+    """
+    returns a stored item with its body and summary as text, or the row
+    itself if they are stored as plain text
+    """
+    if row["compression"] != TEXT_ZLIB:
+        return row
+    item = dict(row)
+    for column in ("body", "summary"):
+        item[column] = decompress_text(item[column], TEXT_ZLIB)
+    return item
+
+
+def fetch_feed(url, etag=None, modified=None, streaming=False, digest=None):
+    """
+    download and parse a feed, sending the validators from the last fetch if
+    there are any. safe to call from worker threads.
+    with streaming, the feed is only downloaded here. its entries are a
+    generator which parses the download as it is consumed.
+    the download's digest is returned as "digest". if it is the same as
+    digest, the one of the last download, the feed isn't parsed again and
+    "unchanged" is set instead, for servers that don't send validators
+    """
+    start = time.time()
+    f = download_feed(url, etag, modified)
+    if "stream" in f:
+        f["digest"] = feed_digest(f["stream"])
+        if digest is not None and f["digest"] == digest:
+            f.pop("stream").close()
+            f["unchanged"] = True
+    if "stream" in f and streaming:
+        f["feed"] = {}
+        f["entries"] = stream_entries(f.pop("stream"), f["feed"])
+    elif "stream" in f:
+        import feedparser
+
+        parse_start = time.time()
+        headers = dict(f["headers"])
+        if "href" in f:
+            # what feedparser resolves relative links against
+            headers["content-location"] = urllib.parse.urljoin(
+                f["href"], headers.get("content-location", "")
+            )
+        with f.pop("stream") as stream:
+            parsed = feedparser.parse(stream, response_headers=headers)
+        # keep the response fields of the download
+        parsed.update(f)
+        f = parsed
+        f["parse_time"] = time.time() - parse_start
+    f["elapsed"] = time.time() - start
+    return f
+
+
+def download_feed(url, etag=None, modified=None, timeout=None):
+    """
+    download a feed into a temporary file, which is only kept in memory if
+    it's small. returns a dict of the response fields feedparser would set,
+    plus the file as "stream" unless the feed wasn't modified. timeout is a
+    (connect and read, total) tuple of seconds, FETCH_TIMEOUT by default
+    """
+    if timeout is None:
+        timeout = FETCH_TIMEOUT
+    f = {"headers": {}}
+    if not urllib.parse.urlsplit(url).scheme:
+        # a local file
+        f["stream"] = open(url, "rb")
+        f["length"] = os.path.getsize(url)
+        return f
+    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    request.add_header("Accept-Encoding", "gzip")
+    if etag is not None:
+        request.add_header("If-None-Match", etag)
+    if modified is not None:
+        request.add_header("If-Modified-Since", modified)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout[0])
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            f.update(status=304, headers=dict(e.headers.items()))
+            return f
+        raise
+    with response:
+        f["status"] = response.status
+        f["href"] = response.url
+        f["headers"] = {k.lower(): v for k, v in response.headers.items()}
+        f["etag"] = response.headers.get("ETag")
+        f["modified"] = response.headers.get("Last-Modified")
+        body = response
+        if response.headers.get("Content-Encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=response)
+        f["stream"] = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        # a server may keep sending a little at a time, never timing out
+        deadline = time.monotonic() + timeout[1]
+        for chunk in iter(lambda: body.read(65536), b""):
+            if time.monotonic() > deadline:
+                f["stream"].close()
+                raise TimeoutError("download took longer than %ss" % timeout[1])
+            f["stream"].write(chunk)
+        # the content-length may be missing, or that of the compressed feed
+        f["length"] = f["stream"].tell()
+    f["stream"].seek(0)
+    return f
+
+
+def feed_digest(stream):
+    """
+    returns a digest of a downloaded feed, and rewinds it
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: stream.read(65536), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def stream_entries(stream, feed=None):
+    """
+    yields the entries of a downloaded feed, then closes it
+    """
+    with stream:
+        yield from StreamingParser().parse(stream, feed)
+
+
+def feed_hints(feed):
+    """
+    returns what a feed's channel says about how often to fetch it: the
+    seconds to wait at least, from <ttl> and the sy:updatePeriod and
+    sy:updateFrequency it is updated at, and the hours of the day (GMT) not
+    to fetch it in, from <skipHours>. invalid values are ignored
+    """
+    wait = 0
+    try:
+        wait = max(int(feed.get("ttl")) * 60, 0)
+    except (TypeError, ValueError):
+        pass
+    period = UPDATE_PERIODS.get(str(feed.get("sy_updateperiod", "")).strip().lower())
+    if period is not None:
+        try:
+            frequency = max(int(feed.get("sy_updatefrequency", 1)), 1)
+        except (TypeError, ValueError):
+            frequency = 1
+        wait = max(wait, period // frequency)
+    skip_hours = set()
+    for hour in feed.get("skip_hours", []):
+        if str(hour).isdigit() and int(hour) < 24:
+            skip_hours.add(int(hour))
+    return wait, sorted(skip_hours)
+
+
+def next_poll(
+    state, interval=3600, min_interval=300, max_interval=86400, adaptive=True, now=None
+):
+    """
+    returns when to fetch a feed next, as a unix time. with adaptive, and
+    once the feed has been updated twice, the wait is half its usual time
+    between updates, or half the time since its last update if that has been
+    longer, so quiet feeds are fetched less and less often. otherwise it is
+    interval seconds. the wait is kept between min_interval and max_interval,
+    and is no shorter than the feed asks for unless that is more than
+    max_interval. the fetch is moved out of the hours the feed asks to skip
+    """
+    now = time.time() if now is None else now
+    wait = interval
+    if state is not None and adaptive and state["update_interval"] is not None:
+        wait = max(state["update_interval"], now - state["last_update"]) / 2
+    if state is not None and state["hint_wait"]:
+        wait = max(wait, state["hint_wait"])
+    when = now + min(max(wait, min_interval), max_interval)
+    skip_hours = []
+    if state is not None and state["skip_hours"]:
+        skip_hours = [int(h) for h in state["skip_hours"].split(",")]
+    # at the start of the next hour that isn't skipped
+    for n in range(24):
+        if time.gmtime(when).tm_hour not in skip_hours:
+            break
+        when = when - when % 3600 + 3600
+    return int(when)
+
+
+def schedule_feed(conn, feed, args):
+    """
+    work out when to fetch a feed next, see next_poll(), and save it as its
+    next_check. returns the feed's state
+    """
+    state = get_feed_state(conn, feed.feed_id)
+    if state is None:
+        return None
+    conn.execute(
+        "UPDATE feed_state SET next_check = ? WHERE feed_id = ?",
+        (
+            next_poll(
+                state,
+                args.interval * 60,
+                args.min_interval * 60,
+                args.max_interval * 60,
+                not args.fixed_interval,
+            ),
+            feed.feed_id,
+        ),
+    )
+    conn.commit()
+    return get_feed_state(conn, feed.feed_id)
+
+
+def get_feed_state(conn, feed_id, url=None):
+    """
+    returns the saved HTTP validators for a feed, or None.
+    validators saved for a different url are ignored
+    """
+    row = conn.execute(
+        "SELECT * FROM feed_state WHERE feed_id = ?", (feed_id,)
+    ).fetchone()
+    if row is not None and (url is None or row["url"] == url):
+        return row
+
+
+def initialize_db(conn):
+    # create the feeds table
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS feeds(guid VARCHAR(255) PRIMARY KEY, \
+        feed_id VARCHAR(127), title VARCHAR(255), link VARCHAR(255), \
+        image VARCHAR(255), image_title VARCHAR(255), \
+        hashtags VARCHAR(255), timestamp INTEGER(10), posted INTEGER(1), \
+        body VARCHAR(10240), summary VARCHAR(2048), attempts INTEGER DEFAULT 0, \
+        last_error VARCHAR(1024), next_attempt_at INTEGER(10) DEFAULT 0, \
+        simhash INTEGER, rendered TEXT, compression INTEGER DEFAULT 0)"
+    )
+    initialize_feed_state(conn)
+    add_queue_index(conn)
+    add_publish_leases(conn)
+    add_seen_items(conn)
+    add_fingerprints(conn)
+    add_update_history(conn)
+
+
+def initialize_feed_state(conn):
+    # create the table of per-feed HTTP validators
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS feed_state(feed_id VARCHAR(127) PRIMARY KEY, \
+        url VARCHAR(255), etag VARCHAR(255), modified VARCHAR(255), \
+        length INTEGER, fetch_time REAL, checked INTEGER(10), \
+        last_update INTEGER(10), update_interval REAL, next_check INTEGER(10), \
+        hint_wait INTEGER, skip_hours VARCHAR(72), digest VARCHAR(32))"
+    )
+
+
+def add_columns(conn):
+    # add any columns that older databases are missing: summary is new since
+    # v1, the rest keep track of failed posts
+    columns = [r[1] for r in conn.execute("PRAGMA table_info('feeds')").fetchall()]
+    for column, definition in (
+        ("summary", "VARCHAR(2048)"),
+        ("attempts", "INTEGER DEFAULT 0"),
+        ("last_error", "VARCHAR(1024)"),
+        ("next_attempt_at", "INTEGER(10) DEFAULT 0"),
+    ):
+        if column not in columns:
+            conn.execute("ALTER TABLE feeds ADD COLUMN %s %s" % (column, definition))
+    # databases from before conditional GET support have no feed_state table
+    initialize_feed_state(conn)
+
+
+def add_queue_index(conn):
+    # index the publish queue, only unpublished items need to be in it
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS feeds_queue ON feeds(feed_id, timestamp) \
+        WHERE posted = 0"
+    )
+
+
+def add_publish_leases(conn):
+    # which process is publishing each feed, see claim_feed()
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS publish_leases(feed_id VARCHAR(127) \
+        PRIMARY KEY, owner VARCHAR(32), expires INTEGER(10))"
+    )
+
+
+def add_archived_guids(conn):
+    # the ids of items clean_db has deleted, so they are never posted again
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS archived_guids(guid VARCHAR(255) PRIMARY KEY, \
+        feed_id VARCHAR(127)) WITHOUT ROWID"
+    )
+
+
+def add_seen_items(conn):
+    # everything ever loaded into the feeds table, by seen_key(). this
+    # replaces archived_guids, and is kept when clean_db deletes the items
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS seen_items(key BLOB PRIMARY KEY) WITHOUT ROWID"
+    )
+    tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master")]
+    query = "SELECT feed_id, guid FROM feeds"
+    if "archived_guids" in tables:
+        query = query + " UNION ALL SELECT feed_id, guid FROM archived_guids"
+    conn.executemany(
+        "INSERT OR IGNORE INTO seen_items(key) VALUES(?)",
+        ((seen_key(r[0], r[1]),) for r in conn.execute(query).fetchall()),
+    )
+    conn.execute("DROP TABLE IF EXISTS archived_guids")
+
+
+def add_fingerprints(conn):
+    # the SimHash of each item's text, and an index of its bands to find
+    # near-duplicates with, see find_duplicate(). items loaded before this
+    # have no fingerprint
+    columns = [r[1] for r in conn.execute("PRAGMA table_info('feeds')").fetchall()]
+    if "simhash" not in columns:
+        conn.execute("ALTER TABLE feeds ADD COLUMN simhash INTEGER")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS fingerprints(band INTEGER, guid VARCHAR(255), \
+        PRIMARY KEY(band, guid)) WITHOUT ROWID"
+    )
+
+
+def add_update_history(conn):
+    # when feeds were last updated and how often, and their hints, to work
+    # out when to fetch them next, see next_poll()
+    columns = [r[1] for r in conn.execute("PRAGMA table_info('feed_state')")]
+    for column, definition in (
+        ("last_update", "INTEGER(10)"),
+        ("update_interval", "REAL"),
+        ("next_check", "INTEGER(10)"),
+        ("hint_wait", "INTEGER"),
+        ("skip_hours", "VARCHAR(72)"),
+    ):
+        if column not in columns:
+            conn.execute(
+                "ALTER TABLE feed_state ADD COLUMN %s %s" % (column, definition)
+            )
+
+
+def add_rendered(conn):
+    # the finished post of items rendered as they were loaded, with
+    # --render-at-ingest
+    columns = [r[1] for r in conn.execute("PRAGMA table_info('feeds')").fetchall()]
+    if "rendered" not in columns:
+        conn.execute("ALTER TABLE feeds ADD COLUMN rendered TEXT")
+
+
+def add_compression(conn):
+    # how each item's text is stored, items loaded before this are plain text
+    columns = [r[1] for r in conn.execute("PRAGMA table_info('feeds')").fetchall()]
+    if "compression" not in columns:
+        conn.execute("ALTER TABLE feeds ADD COLUMN compression INTEGER DEFAULT 0")
+
+
+def add_feed_digest(conn):
+    # a digest of each feed's last download, to tell when it hasn't changed
+    # without validators, see fetch_feed()
+    columns = [r[1] for r in conn.execute("PRAGMA table_info('feed_state')")]
+    if "digest" not in columns:
+        conn.execute("ALTER TABLE feed_state ADD COLUMN digest VARCHAR(32)")
+
+
+# schema migrations, oldest first. a database's user_version is the number of
+# migrations it has had. databases from before user_version was used are at 0,
+# so the migrations must cope with the changes already being there
+MIGRATIONS = [
+    add_columns,
+    add_queue_index,
+    add_publish_leases,
+    add_archived_guids,
+    add_seen_items,
+    add_fingerprints,
+    add_update_history,
+    add_rendered,
+    add_compression,
+    add_feed_digest,
+]
+
+
+def user_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def alter_db(conn):
+    """
+    bring the database schema up to date, applying each migration it hasn't
+    had yet in its own transaction. creates the tables of a new database
+    """
+    while user_version(conn) < len(MIGRATIONS):
+        # take the write lock before reading the version, so that processes
+        # starting at the same time don't apply the same migration twice
+        begin = not conn.in_transaction
+        if begin:
+            conn.execute("BEGIN IMMEDIATE")
+        # a savepoint nests in the caller's transaction, if there is one
+        conn.execute("SAVEPOINT migration")
+        try:
+            version = user_version(conn)
+            if not conn.execute(
+                "SELECT name FROM sqlite_master WHERE name = 'feeds'"
+            ).fetchone():
+                # a new database starts out with the current schema
+                initialize_db(conn)
+                conn.execute("PRAGMA user_version = %d" % len(MIGRATIONS))
+            elif version < len(MIGRATIONS):
+                MIGRATIONS[version](conn)
+                conn.execute("PRAGMA user_version = %d" % (version + 1))
+        except BaseException:
+            conn.execute("ROLLBACK TO migration")
+            raise
+        finally:
+            conn.execute("RELEASE migration")
+            if begin:
+                conn.commit()
+
+
+def connect_db(file, timeout=30, wal=True):
+    """
+    connect to the database and initialize if necessary. other processes may
+    share the file: waits up to timeout seconds for their locks, and with wal
+    uses write-ahead logging so readers and a writer don't block each other
+    """
+    conn = sqlite3.connect(file, timeout=timeout)
+    # lets clean_db give space back a little at a time. this only has an
+    # effect on new databases, clean_db --full-vacuum converts old ones
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    if wal:
+        conn.execute("PRAGMA journal_mode = WAL")
+        # only the last transactions can be lost on power failure, not the file
+        conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = -16384")
+    conn.execute("PRAGMA mmap_size = 268435456")
+    # initialize or upgrade the database if necessary
+    alter_db(conn)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def retry_locked(db, func, *args, retries=5):
+    """
+    call func(*args), rolling back and trying again a few times if another
+    process kept the database locked for longer than the busy timeout
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            if attempt == retries or "locked" not in str(e) and "busy" not in str(e):
+                raise
+            db.rollback()
+            time.sleep(random.uniform(0.5, 1.5) * 2**attempt)
+
+
+def post_options(args):
+    """
+    returns the PodClient.format_post() options of a feed's posts
+    """
+    return {
+        "body": args.full,
+        "embed_image": args.embed_image,
+        "no_branding": args.no_branding,
+        "post_raw_link": args.post_raw_link,
+        "summary": args.summary,
+    }
+
+
+def render_post(client, content, options):
+    """
+    returns an item's post, or None if it can't be rendered, e.g. because it
+    has no link. the item then fails when it is published, like it would have
+    """
+    try:
+        return client.format_post(content, **options)
+    except TypeError:
+        return None
+
+
+def render_queued(db, args):
+    """
+    render the posts of the feed's queued items that were loaded without
+    --render-at-ingest, so they can be published from queued_items() too.
+    returns the number of rendered items
+    """
+    client = PodClient()
+    options = post_options(args)
+    rows = db.execute(
+        "SELECT guid, title, link, image, image_title, hashtags, body, summary, \
+        compression FROM feeds WHERE feed_id == ? AND posted == 0 \
+        AND rendered IS NULL",
+        (args.feed_id,),
+    ).fetchall()
+    rendered = []
+    for r in rows:
+        post = render_post(client, decompress_item(r), options)
+        if post is not None and r["compression"] == TEXT_ZLIB:
+            post = compress_text(post)
+        if post is not None:
+            rendered.append((post, r["guid"]))
+    db.executemany("UPDATE feeds SET rendered = ? WHERE guid = ?", rendered)
+    db.commit()
+    return len(rendered)
+
+
+def queued_items(db, args):
+    """
+    returns the feed's unpublished items that are due to be posted, in the
+    order they should be posted. the queue stops at the first item that is
+    waiting for a retry, including the items loaded after it failed. with
+    --render-at-ingest only the rendered posts are read, not the text they
+    were made from
+    """
+    columns = "title, link, image, image_title, hashtags, body, summary, rendered"
+    if args.render_at_ingest:
+        columns = "rendered"
+    query = "SELECT guid, %s, compression, attempts, simhash FROM feeds \
+        WHERE feed_id == ? AND posted == 0 AND timestamp > ? \
+        AND NOT EXISTS (SELECT 1 FROM feeds AS waiting \
+        WHERE waiting.feed_id == feeds.feed_id AND waiting.posted == 0 \
+        AND waiting.timestamp > ? AND waiting.timestamp <= feeds.timestamp \
+        AND waiting.next_attempt_at > ?) ORDER BY timestamp" % columns
+    if args.limit > 0:
+        query = query + " LIMIT %s" % args.limit
+    now = int(time.time())
+    timeout = int(now - args.timeout * 3600)
+    return db.execute(query, (args.feed_id, timeout, timeout, now)).fetchall()
+
+
+def mark_posted(db, guid):
+    """
+    flag an item as published
+    """
+    db.execute("UPDATE feeds SET posted = 1 WHERE guid = ?", (guid,))
+    db.commit()
+
+
+def find_duplicate(db, feed_id, fingerprint, window, queued=()):
+    """
+    returns the guid of a near-duplicate of the fingerprint from another
+    feed: an item that was loaded in the last window hours and posted, or
+    one of the queued (guid, feed_id, fingerprint) tuples. returns None if
+    there is none
+    """
+    if fingerprint is None:
+        return None
+    rows = db.execute(
+        "SELECT feeds.guid, feeds.simhash FROM fingerprints \
+        JOIN feeds ON feeds.guid = fingerprints.guid \
+        WHERE fingerprints.band IN (?, ?, ?, ?) AND feeds.feed_id != ? \
+        AND feeds.posted = 1 AND feeds.timestamp > ?",
+        simhash_bands(fingerprint) + [feed_id, int(time.time() - window * 3600)],
+    )
+    for guid, other in rows:
+        if simhash_distance(fingerprint, other) <= SIMHASH_DISTANCE:
+            return guid
+    for guid, other_feed_id, other in queued:
+        if other_feed_id != feed_id and other is not None:
+            if simhash_distance(fingerprint, other) <= SIMHASH_DISTANCE:
+                return guid
+
+
+def mark_duplicate(db, guid):
+    """
+    flag an item as a duplicate that won't be published (posted = 2)
+    """
+    db.execute("UPDATE feeds SET posted = 2 WHERE guid = ?", (guid,))
+    db.commit()
+
+
+def skip_duplicate(db, args, row, queued=()):
+    """
+    with --duplicate-window, check whether another feed already posted the
+    item, see find_duplicate(), and flag it if so. returns True if the item
+    should be skipped
+    """
+    if not args.duplicate_window:
+        return False
+    duplicate = find_duplicate(
+        db, args.feed_id, row["simhash"], args.duplicate_window, queued
+    )
+    if duplicate is None:
+        return False
+    retry_locked(db, mark_duplicate, db, row["guid"])
+    METRICS.inc("posts_total", args.feed_id, result="duplicate")
+    if not args.quiet:
+        print(
+            "Skipping %s\t%s\tduplicate of %s" % (args.feed_id, row["guid"], duplicate)
+        )
+    return True
+
+
+def retry_delay(attempts, delay=5, max_delay=720):
+    """
+    returns how many seconds to wait before the next attempt after a number
+    of failed attempts: delay minutes, doubling after each failure, up to
+    max_delay minutes
+    """
+    return int(min(delay * 2 ** (attempts - 1), max_delay) * 60)
+
+
+def mark_failed(db, args, row, error):
+    """
+    record a failed post and schedule the next attempt. once an item has
+    failed --max-attempts times it is dead-lettered (posted = -1) instead.
+    the rest of the feed's queue waits for the retry, to keep it in order.
+    returns True if the item was dead-lettered
+    """
+    attempts = (row["attempts"] or 0) + 1
+    dead = attempts >= args.max_attempts
+    next_attempt = int(time.time()) + retry_delay(attempts, args.retry_delay)
+    db.execute(
+        "UPDATE feeds SET attempts = ?, last_error = ?, next_attempt_at = ?, \
+        posted = ? WHERE guid = ?",
+        (attempts, str(error)[:1024], next_attempt, -1 if dead else 0, row["guid"]),
+    )
+    if not dead:
+        db.execute(
+            "UPDATE feeds SET next_attempt_at = MAX(next_attempt_at, ?) \
+            WHERE feed_id = ? AND posted = 0",
+            (next_attempt, args.feed_id),
+        )
+    db.commit()
+    return dead
+
+
+def record_failure(args, dead):
+    """
+    count a failed post in the METRICS, dead if mark_failed() gave up on it
+    """
+    METRICS.inc("posts_total", args.feed_id, result="failed")
+    if dead:
+        METRICS.inc("dead_letters_total", args.feed_id)
+
+
+def claim_feed(db, feed_id, owner, lease=600):
+    """
+    take, or renew, the right to publish a feed for lease seconds. this
+    keeps processes sharing the database from posting the same items, or a
+    feed's items out of order. returns False if another owner holds it
+    """
+    now = int(time.time())
+    cursor = db.execute(
+        "INSERT INTO publish_leases(feed_id, owner, expires) VALUES(?, ?, ?) \
+        ON CONFLICT(feed_id) DO UPDATE SET owner = excluded.owner, \
+        expires = excluded.expires WHERE owner = excluded.owner OR expires < ?",
+        (feed_id, owner, now + lease, now),
+    )
+    db.commit()
+    return cursor.rowcount == 1
+
+
+def confirm_claim(db, feed_id, owner, guid):
+    """
+    renew the right to publish a feed right before posting one of its items,
+    see claim_feed(). returns False if another owner holds it, or if the item
+    isn't queued anymore, e.g. because another owner posted it after our
+    lease ran out
+    """
+    if not claim_feed(db, feed_id, owner):
+        return False
+    row = db.execute("SELECT posted FROM feeds WHERE guid = ?", (guid,)).fetchone()
+    return row is not None and row[0] == 0
+
+
+def release_feed(db, feed_id, owner):
+    """
+    give up the right to publish a feed, see claim_feed()
+    """
+    db.execute(
+        "DELETE FROM publish_leases WHERE feed_id = ? AND owner = ?", (feed_id, owner)
+    )
+    db.commit()
+
+
+def publish_items(db, client, args=None, bucket=None):
+    """
+    find queued items in the database and publish them, waiting on the
+    bucket (a TokenBucket) before each post if there is one. stops at the
+    first failed post, see mark_failed(), and skips the feed if another
+    process is publishing it.
+    returns the number of published items
+    """
+    owner = uuid.uuid4().hex
+    if not retry_locked(db, claim_feed, db, args.feed_id, owner):
+        if args.debug:
+            print("%s is being published by another process" % args.feed_id)
+        return 0
+    published = 0
+    try:
+        if args.render_at_ingest:
+            retry_locked(db, render_queued, db, args)
+        for row in queued_items(db, args):
+            if skip_duplicate(db, args, row):
+                continue
+            if not args.quiet:
+                print("Publishing %s\t%s" % (args.feed_id, row["guid"]))
+            if bucket is not None:
+                bucket.acquire()
+            # the wait may have been long, make sure the feed is still ours
+            if not retry_locked(
+                db, confirm_claim, db, args.feed_id, owner, row["guid"]
+            ):
+                break
+            if row["attempts"]:
+                METRICS.inc("publish_retries_total", args.feed_id)
+            with METRICS.timer("publish_seconds", args.feed_id):
+                try:
+                    error = None if client.publish(row, args) else "not published"
+                except Exception as e:
+                    error = e
+            if error is None:
+                retry_locked(db, mark_posted, db, row["guid"])
+                METRICS.inc("posts_total", args.feed_id, result="published")
+                published += 1
+            else:
+                dead = retry_locked(db, mark_failed, db, args, row, error)
+                record_failure(args, dead)
+                if not args.quiet:
+                    print(
+                        "Failed %s\t%s\t%s" % (args.feed_id, row["guid"], error),
+                        file=sys.stderr,
+                    )
+                break
+    finally:
+        retry_locked(db, release_feed, db, args.feed_id, owner)
+    return published
+
+
+def build_parser():
+    """
+    returns the command line parser, shared with the batch runner
+    """
+    parser = argparse.ArgumentParser()
+    #parser.add_argument(
+    #    "--aspect-id",
+    #    help="Numerical aspect ID to share with. \
+    #        May be specified multiple times (default: 'public')",
     #    action="append",
     #    default=[],
     #)
@@ -435,17 +2012,61 @@ def parse_args():
         action="append",
         default=[],
     )
+    parser.add_argument(
+        "--backend",
+        help="How to post to the pod: 'api' talks to the SocialHome content API \
+            directly, 'shcli' goes through the shcli package (default: 'api')",
+        choices=["api", "shcli"],
+        default="api",
+    )
+    parser.add_argument(
+        "--busy-timeout",
+        help="Seconds to wait for other processes using the database before \
+            giving up (default 30)",
+        type=float,
+        default=30,
+    )
+    parser.add_argument(
+        "--bloom-filter",
+        help="Load a compact in-memory filter of every item seen so far, and \
+            check it instead of the database. Very rarely (about one in a \
+            million) a new item is mistaken for a seen one and skipped",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--burst",
+        help="How many posts may be published at once before --rate applies \
+            (default 1)",
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         "--category-tags",
         help="Automatically hashtagify RSS item 'categories' if any",
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--compress",
+        help="Store the text of new items compressed with zlib, to keep the \
+            database small. Items stored either way can be published",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "--database",
         help="The file to store feed data (default: 'feed.db')",
         default="feed.db",
     )
+    parser.add_argument(
+        "--duplicate-window",
+        help="Skip items that are the same as, or nearly the same as, an item \
+            another feed posted in the last this many hours. 0 to post them \
+            anyway (default 0)",
+        type=float,
+        default=0,
+    )
     parser.add_argument(
         "--embed-image",
         help="Embed an image in the post if a link exists",
@@ -456,23 +2077,82 @@ def parse_args():
         "--feed-id", help="An arbitrary label for this feed", required=True
     )
     parser.add_argument("--feed-url", help="The feed URL", required=True)
+    parser.add_argument(
+        "--fixed-interval",
+        help="Always wait --interval minutes between fetches in \
+            sh-feeder-batch --daemon, instead of learning how often the feed \
+            is updated",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "--ignore-tag",
         help="Hashtag to filter out. May be specified multiple times",
         action="append",
         default=[],
     )
+    parser.add_argument(
+        "--interval",
+        help="Minutes between fetches in sh-feeder-batch --daemon, until it \
+            has learned how often the feed is updated (default 60)",
+        type=float,
+        default=60,
+    )
     parser.add_argument(
         "--limit",
         help="Only post n items per script run, to prevent post-spamming",
         type=int,
         default=-1,
     )
+    parser.add_argument(
+        "--max-attempts",
+        help="Give up on an item after this many failed posts. It is kept in \
+            the database for pf-dead-letters to inspect and requeue (default 8)",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--max-html-size",
+        help="Truncate HTML bodies longer than this many characters before \
+            converting them to Markdown, 0 for no limit (default 262144)",
+        type=int,
+        default=262144,
+    )
+    parser.add_argument(
+        "--max-interval",
+        help="Never wait longer than this many minutes between fetches \
+            (default 1440)",
+        type=float,
+        default=1440,
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Save a JSON summary of each stage's counts and timings to this \
+            file",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="Save the metrics to this file in the Prometheus text format, \
+            for node_exporter's textfile collector (name it *.prom)",
+    )
+    parser.add_argument(
+        "--min-interval",
+        help="Never fetch more often than every this many minutes (default 5)",
+        type=float,
+        default=5,
+    )
     parser.add_argument(
         "--no-branding",
         help="Do not include 'via socialhome feeder' footer to posts",
         action="store_true",
         default=False)
+    parser.add_argument(
+        "--no-wal",
+        help="Don't switch the database to write-ahead logging, e.g. if it is \
+            on a network filesystem",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument("--pod-url", help="The instance URL", required=True)
     parser.add_argument(
         "--post-raw-link",
@@ -480,6 +2160,49 @@ def parse_args():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--publish-only",
+        help="Don't fetch the feed, publish the items queued by earlier \
+            --fetch-only runs",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--rate",
+        help="Publish at most this many posts per second, 0 for no limit \
+            (default 0)",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--render-at-ingest",
+        help="Render each item's post as it is queued and store it, so \
+            publishing only reads and sends it. Queued items keep the post \
+            options they were rendered with",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--retry-delay",
+        help="Minutes to wait before retrying a failed post, doubled after \
+            each failure up to 12 hours (default 5)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--stop-at-known",
+        help="Stop reading the feed at the first item that is already in the \
+            database. Only use this for feeds that list the newest items first",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--streaming",
+        help="Read the feed a little at a time with a minimal built-in parser \
+            instead of feedparser. Uses less memory for very large feeds",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "--timeout",
         help="How many hours to keep re-trying failed posts (default 72)",
@@ -524,30 +2247,171 @@ def parse_args():
     verbosity.add_argument(
         "--quiet", help="Suppress normal output", action="store_true", default=False
     )
-    return parser.parse_args()
+    return parser
+
+
+def parse_args(argv=None):
+    """
+    proccess command line args
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.publish_only and args.fetch_only:
+        parser.error("argument --publish-only: not allowed with argument --fetch-only")
+    return args
+
+
+def print_not_modified(feed, state):
+    """
+    debug output for a feed that the server reported as unchanged
+    """
+    if feed.status != 304:
+        print("%s is the same as the last download, not parsed" % feed.feed_id)
+        return
+    print("%s not modified (HTTP 304)" % feed.feed_id)
+    if state is not None and state["length"] is not None:
+        print("bytes saved\t: %s" % state["length"])
+    if state is not None and state["fetch_time"] is not None:
+        saved = state["fetch_time"] - feed.feed.get("elapsed", 0)
+        print("time saved\t: %.3fs" % max(saved, 0))
+
+
+def print_schedule(state):
+    """
+    debug output for when a feed is fetched next, and why
+    """
+    if state["update_interval"] is not None:
+        print("updated every\t: %.0f minutes" % (state["update_interval"] / 60))
+    if state["last_update"] is not None:
+        print("last update\t: %s" % time.ctime(state["last_update"]))
+    if state["hint_wait"]:
+        print("feed asks\t: %.0f minutes" % (state["hint_wait"] / 60))
+    if state["skip_hours"]:
+        print("skip hours\t: %s" % state["skip_hours"])
+    print("next fetch\t: %s" % time.ctime(state["next_check"]))
+
+
+def record_fetch(feed_id, f):
+    """
+    add a fetched feed's download and parse times, size and HTTP status to
+    the METRICS
+    """
+    elapsed = f.get("elapsed")
+    if elapsed is not None:
+        METRICS.observe("fetch_seconds", feed_id, elapsed - f.get("parse_time", 0))
+    if f.get("parse_time") is not None:
+        METRICS.observe("parse_seconds", feed_id, f["parse_time"])
+    if f.get("length") is not None:
+        METRICS.inc("fetch_bytes_total", feed_id, f["length"])
+    if f.get("status") is not None:
+        METRICS.inc("fetch_responses_total", feed_id, status=f["status"])
+    if f.get("unchanged"):
+        METRICS.inc("fetch_unchanged_total", feed_id)
+
+
+def write_metrics(json_file=None, textfile=None):
+    """
+    save the METRICS as a JSON run summary and/or a Prometheus textfile
+    """
+    if json_file:
+        METRICS.write_json(json_file)
+    if textfile:
+        METRICS.write_prometheus(textfile)
+
+
+def ingest_feed(db, args, parsed=None, seen=None):
+    """
+    fetch a single feed (unless it was already parsed) and queue its new
+    items. seen is an optional BloomFilter of the seen_items table. a feed
+    that can't be downloaded is counted in errors_total and has no new items.
+    so is a --streaming feed that turns out to be malformed, except for the
+    chunks of items load_db() committed before the error.
+    returns the number of new items
+    """
+    state = get_feed_state(db, args.feed_id, args.feed_url)
+    try:
+        # slurp the feed
+        feed = Feed(
+            auto_tags=args.auto_tag,
+            category_tags=args.category_tags,
+            feed_id=args.feed_id,
+            ignore_tags=args.ignore_tag,
+            url=args.feed_url,
+            debug=args.debug,
+            parsed=parsed,
+            etag=state["etag"] if state else None,
+            modified=state["modified"] if state else None,
+            digest=state["digest"] if state else None,
+            db=db,
+            stop_at_known=args.stop_at_known,
+            streaming=args.streaming,
+            seen=seen,
+            render=post_options(args) if args.render_at_ingest else None,
+            compress=args.compress,
+        )
+    except DOWNLOAD_ERRORS as e:
+        if isinstance(e, urllib.error.HTTPError):
+            METRICS.inc("fetch_responses_total", args.feed_id, status=e.code)
+        METRICS.inc("errors_total", args.feed_id, stage="fetch")
+        if not args.quiet:
+            print("Failed %s\t%s" % (args.feed_id, e), file=sys.stderr)
+        return 0
+    record_fetch(args.feed_id, feed.feed)
+    new = 0
+    if feed.not_modified:
+        if args.debug:
+            print_not_modified(feed, state)
+    else:
+        # load the feed items into the database. with --streaming this
+        # includes parsing the feed and converting its items
+        with METRICS.timer("ingest_seconds", args.feed_id):
+            try:
+                new = feed.load_db(db)
+            except ElementTree.ParseError as e:
+                # like a bozo feed from feedparser, the queue is still
+                # published. the state isn't saved, so it's read again next time
+                METRICS.inc("errors_total", args.feed_id, stage="parse")
+                if not args.quiet:
+                    print("Failed %s\t%s" % (args.feed_id, e), file=sys.stderr)
+                return feed.loaded
+    retry_locked(db, feed.save_state, db, new)
+    state = retry_locked(db, schedule_feed, db, feed, args)
+    if args.debug and state is not None:
+        print_schedule(state)
+    return new
+
+
+def process_feed(db, args, parsed=None, publish=True, seen=None):
+    """
+    fetch a single feed and queue its new items, see ingest_feed(), unless
+    --publish-only is used. then publish the queued items unless publish is
+    false or --fetch-only is used.
+    returns a (new items, published items) tuple
+    """
+    new = 0
+    if not args.publish_only:
+        new = ingest_feed(db, args, parsed, seen)
+    published = 0
+    # skip pusblishing if --fetch-only is used
+    if publish and not args.fetch_only:
+        client = PodClient(url=args.pod_url, token=args.token, backend=args.backend)
+        bucket = TokenBucket(args.rate, args.burst)
+        published = publish_items(db, client, args=args, bucket=bucket)
+    return new, published
 
 
 def main():
     args = parse_args()
-    # slurp the feed
-    feed = Feed(
-        auto_tags=args.auto_tag,
-        category_tags=args.category_tags,
-        feed_id=args.feed_id,
-        ignore_tags=args.ignore_tag,
-        url=args.feed_url,
-        debug=args.debug,
-    )
+    FeedItem.converter = HtmlConverter(max_length=args.max_html_size)
     # establish a database connection
-    db = connect_db(args.database)
-    # load the feed items into the database
-    feed.load_db(db)
-    # skip pusblishing if --fetch-only is used
-    if not args.fetch_only:
-        client = PodClient(
-            url=args.pod_url, token=args.token
-        )
-        publish_items(db, client, args=args)
+    db = connect_db(args.database, timeout=args.busy_timeout, wal=not args.no_wal)
+    seen = None
+    if args.bloom_filter and not args.publish_only:
+        seen = BloomFilter.from_db(db)
+    try:
+        process_feed(db, args, seen=seen)
+    finally:
+        write_metrics(args.metrics_json, args.metrics_textfile)
     db.close()
 
 
@@ -0,0 +1,581 @@
+import json, os, signal, sqlite3, tempfile, threading, time, unittest, urllib.error
+from unittest import mock
+from sh_feeder import batch
+from sh_feeder.batch import *
+from sh_feeder.sh_feeder import Metrics, simhash
+
+
+class TestConfig(unittest.TestCase):
+    def write(self, suffix, text):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, "w") as fh:
+            fh.write(text)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_load_config_json(self):
+        path = self.write(".json", json.dumps({"feeds": [{"feed_id": "a"}]}))
+        self.assertEqual(load_config(path), {"feeds": [{"feed_id": "a"}]})
+
+    def test_load_config_toml(self):
+        path = self.write(
+            ".toml",
+            'database = "x.db"\n[defaults]\nlimit = 2\n\n[[feeds]]\nfeed-id = "a"\n',
+        )
+        self.assertEqual(
+            load_config(path),
+            {"database": "x.db", "defaults": {"limit": 2}, "feeds": [{"feed-id": "a"}]},
+        )
+
+    def test_load_config_invalid(self):
+        with self.assertRaises(ValueError):
+            load_config(self.write(".json", json.dumps({"feed": []})))
+        with self.assertRaises(ValueError):
+            load_config(self.write(".ini", ""))
+
+    def test_feed_args(self):
+        config = {
+            "database": "x.db",
+            "defaults": {"pod-url": "pod", "token": "TOKEN", "limit": 1},
+            "feeds": [],
+        }
+        args = feed_args(
+            config, {"feed_id": "a", "feed_url": "URL", "limit": 5, "auto_tag": "t"}
+        )
+        self.assertEqual(args.feed_id, "a")
+        self.assertEqual(args.feed_url, "URL")
+        self.assertEqual(args.pod_url, "pod")
+        self.assertEqual(args.token, "TOKEN")
+        self.assertEqual(args.limit, 5)
+        self.assertEqual(args.auto_tag, ["t"])
+        self.assertEqual(args.ignore_tag, [])
+        self.assertEqual(args.timeout, 72)
+        self.assertEqual(args.database, "x.db")
+        self.assertFalse(args.fetch_only)
+        # command line overrides win
+        args = feed_args(
+            config, {"feed_id": "a", "feed_url": "URL"}, {"fetch_only": True}
+        )
+        self.assertTrue(args.fetch_only)
+
+    def test_feed_args_invalid(self):
+        feed = {"feed_id": "a", "feed_url": "URL", "fetch_only": True}
+        with self.assertRaises(ValueError):
+            feed_args({}, dict(feed, bogus=1))
+        with self.assertRaises(ValueError):
+            feed_args({}, dict(feed, database="x.db"))
+        with self.assertRaises(ValueError):
+            feed_args({}, dict(feed, summary=True, full=True))
+        with self.assertRaises(ValueError):
+            feed_args({}, {"feed_id": "a", "feed_url": "URL"})
+        with self.assertRaises(ValueError):
+            feed_args({}, {"feed_id": "a", "fetch_only": True})
+        with self.assertRaises(ValueError):
+            feed_args({}, dict(feed, publish_only=True))
+
+    def test_load_feeds(self):
+        config = {
+            "defaults": {"fetch_only": True},
+            "feeds": [
+                {"feed_id": "a", "feed_url": "A"},
+                {"feed_id": "b", "feed_url": "B"},
+            ],
+        }
+        self.assertEqual([f.feed_id for f in load_feeds(config)], ["a", "b"])
+        config["feeds"].append({"feed_id": "a", "feed_url": "C"})
+        with self.assertRaises(ValueError):
+            load_feeds(config)
+
+
+class TestRun(unittest.TestCase):
+    def feeds(self, *urls):
+        config = {
+            "defaults": {"fetch_only": True, "quiet": True},
+            "feeds": [{"feed_id": str(i), "feed_url": u} for i, u in enumerate(urls)],
+        }
+        return load_feeds(config)
+
+    def test_interleave_hosts(self):
+        feeds = self.feeds("http://a/1", "http://a/2", "http://a/3", "http://b/1")
+        self.assertEqual(
+            [f.feed_url for f in interleave_hosts(feeds)],
+            ["http://a/1", "http://b/1", "http://a/2", "http://a/3"],
+        )
+
+    @mock.patch.object(batch, "fetch_feed")
+    def test_fetch_feeds(self, mock_fetch_feed):
+        lock = threading.Lock()
+        active = {}
+        peak = {}
+
+        def fetch(url, streaming=False):
+            host = url.split("/")[2]
+            with lock:
+                active[host] = active.get(host, 0) + 1
+                peak[host] = max(peak.get(host, 0), active[host])
+            time.sleep(0.02)
+            with lock:
+                active[host] -= 1
+            if url.endswith("bad"):
+                raise IOError("unreachable")
+            return {"entries": [url]}
+
+        mock_fetch_feed.side_effect = fetch
+        urls = ["http://a/%s" % i for i in range(6)] + ["http://b/1", "http://b/bad"]
+        results = list(fetch_feeds(self.feeds(*urls), workers=8, per_host=2))
+        self.assertEqual(len(results), 8)
+        self.assertEqual(peak["a"], 2)
+        self.assertLessEqual(peak["b"], 2)
+        for args, parsed, error in results:
+            if args.feed_url.endswith("bad"):
+                self.assertIsNone(parsed)
+                self.assertIsInstance(error, IOError)
+            else:
+                self.assertEqual(parsed, {"entries": [args.feed_url]})
+                self.assertIsNone(error)
+
+    @mock.patch.object(batch, "fetch_feed")
+    @mock.patch.object(batch, "process_feed")
+    def test_run(self, mock_process_feed, mock_fetch_feed):
+        def process(db, args, parsed=None, publish=True, seen=None):
+            if args.feed_id == "bad":
+                raise IOError("unreachable")
+            return 3, 0
+
+        mock_fetch_feed.return_value = {"entries": []}
+        mock_process_feed.side_effect = process
+        config = {
+            "defaults": {"fetch_only": True, "quiet": True},
+            "feeds": [
+                {"feed_id": "good", "feed_url": "A"},
+                {"feed_id": "bad", "feed_url": "B"},
+            ],
+        }
+        db = connect_db(":memory:")
+        metrics = Metrics()
+        with mock.patch.object(batch, "METRICS", metrics):
+            results = run(db, load_feeds(config), workers=2)
+        self.assertEqual(
+            metrics.summary()["feeds"]["bad"]["errors_total"], {"ingest": 1}
+        )
+        self.assertEqual(results[0], ("good", 3, 0, None))
+        self.assertEqual(results[1][:3], ("bad", 0, 0))
+        self.assertIsInstance(results[1][3], IOError)
+        for call in mock_process_feed.call_args_list:
+            self.assertIs(call[0][0], db)
+            self.assertEqual(call[1]["parsed"], {"entries": []})
+            self.assertFalse(call[1]["publish"])
+
+    @mock.patch.object(batch, "publish_feeds")
+    @mock.patch.object(batch, "fetch_feed")
+    def test_run_publish_only(self, mock_fetch_feed, mock_publish_feeds):
+        mock_fetch_feed.return_value = {"entries": []}
+        mock_publish_feeds.side_effect = lambda db, feeds, *a: {
+            args.feed_id: (1, None) for args in feeds
+        }
+        config = {
+            "defaults": {"pod_url": "pod", "token": "TOKEN", "quiet": True},
+            "feeds": [
+                {"feed_id": "fetched", "feed_url": "http://a/"},
+                {"feed_id": "queued", "feed_url": "http://b/", "publish_only": True},
+            ],
+        }
+        db = connect_db(":memory:")
+        results = run(db, load_feeds(config))
+        # only the other feed is fetched, both are published
+        mock_fetch_feed.assert_called_once_with("http://a/", streaming=False)
+        self.assertEqual(results, [("fetched", 0, 1, None), ("queued", 0, 1, None)])
+
+    @mock.patch.object(batch, "publish_feeds")
+    @mock.patch.object(batch, "fetch_feed")
+    def test_run_unreachable(self, mock_fetch_feed, mock_publish_feeds):
+        mock_fetch_feed.side_effect = IOError("unreachable")
+        mock_publish_feeds.side_effect = lambda db, feeds, *a: {
+            args.feed_id: (1, None) for args in feeds
+        }
+        config = {
+            "defaults": {"pod_url": "pod", "token": "TOKEN", "quiet": True},
+            "feeds": [
+                {"feed_id": "down", "feed_url": "http://a/"},
+                {"feed_id": "queued", "feed_url": "http://b/", "fetch_only": True},
+            ],
+        }
+        db = connect_db(":memory:")
+        metrics = Metrics()
+        with mock.patch.object(batch, "METRICS", metrics):
+            results = run(db, load_feeds(config))
+        # the queue of a feed that is down is still published
+        self.assertEqual(
+            [args.feed_id for args in mock_publish_feeds.call_args[0][1]], ["down"]
+        )
+        self.assertEqual(results[0][:3], ("down", 0, 1))
+        self.assertIsInstance(results[0][3], IOError)
+        self.assertEqual(results[1][:3], ("queued", 0, 0))
+        self.assertEqual(
+            metrics.summary()["feeds"]["down"]["errors_total"], {"fetch": 1}
+        )
+
+    @mock.patch.object(batch, "publish_feeds")
+    @mock.patch.object(batch, "fetch_feed")
+    def test_run_http_error(self, mock_fetch_feed, mock_publish_feeds):
+        mock_fetch_feed.side_effect = urllib.error.HTTPError(
+            "http://a/", 500, "Internal Server Error", {}, None
+        )
+        mock_publish_feeds.return_value = {"down": (0, None)}
+        config = {
+            "defaults": {"pod_url": "pod", "token": "TOKEN", "quiet": True},
+            "feeds": [{"feed_id": "down", "feed_url": "http://a/"}],
+        }
+        db = connect_db(":memory:")
+        metrics = Metrics()
+        with mock.patch.object(batch, "METRICS", metrics):
+            run(db, load_feeds(config))
+        stats = metrics.summary()["feeds"]["down"]
+        # counted like a single feed run counts it
+        self.assertEqual(stats["fetch_responses_total"], {"500": 1})
+        self.assertEqual(stats["errors_total"], {"fetch": 1})
+
+    @mock.patch.object(batch, "fetch_feed")
+    def test_fetch_feeds_validators(self, mock_fetch_feed):
+        mock_fetch_feed.return_value = {"status": 304}
+        feeds = self.feeds("http://a/1", "http://a/2")
+        states = {
+            "0": {"etag": "ETAG", "modified": "MODIFIED", "digest": "DIGEST"},
+            "1": None,
+        }
+        list(fetch_feeds(feeds, states=states))
+        mock_fetch_feed.assert_any_call(
+            "http://a/1", "ETAG", "MODIFIED", streaming=False, digest="DIGEST"
+        )
+        mock_fetch_feed.assert_any_call("http://a/2", streaming=False)
+
+
+class TestPublish(unittest.TestCase):
+    def setUp(self):
+        self.db = connect_db(":memory:")
+        self.addCleanup(self.db.close)
+        self.fill()
+        self.feeds = load_feeds(
+            {
+                "defaults": {"pod_url": "pod", "token": "TOKEN", "quiet": True},
+                "feeds": [{"feed_id": f, "feed_url": "http://%s/" % f} for f in "abc"],
+            }
+        )
+
+    def fill(self):
+        now = time.time()
+        for feed_id in ("a", "b", "c"):
+            for i in range(4):
+                self.db.execute(
+                    "INSERT INTO feeds(guid, feed_id, title, body, summary, link, \
+                    image, image_title, hashtags, posted, timestamp) \
+                    VALUES(?, ?, '', '', '', '', '', '', '', 0, ?)",
+                    ("%s%s" % (feed_id, i), feed_id, now - 10 + i),
+                )
+        self.db.commit()
+
+    def posted(self):
+        return [
+            r["guid"]
+            for r in self.db.execute("SELECT guid FROM feeds WHERE posted = 1")
+        ]
+
+    @mock.patch.object(batch, "PodClient")
+    def test_publish_feeds(self, mock_client):
+        lock = threading.Lock()
+        order = {}
+        active = [0, 0]
+
+        def publish(row, args):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+                order.setdefault(args.feed_id, []).append(row["guid"])
+            if row["guid"] == "b2":
+                raise IOError("throttled")
+            return row["guid"] != "c1"
+
+        mock_client.return_value.publish.side_effect = publish
+        metrics = Metrics()
+        with mock.patch.object(batch, "METRICS", metrics):
+            with mock.patch("sh_feeder.sh_feeder.METRICS", metrics):
+                results = publish_feeds(self.db, self.feeds, workers=3)
+        # the feeds were published side by side, each in timestamp order
+        self.assertEqual(active[1], 3)
+        self.assertEqual(order["a"], ["a0", "a1", "a2", "a3"])
+        self.assertEqual(order["b"], ["b0", "b1", "b2"])
+        self.assertEqual(order["c"], ["c0", "c1"])
+        # only successful posts are marked, a failure stops its feed
+        self.assertEqual(
+            sorted(self.posted()), ["a0", "a1", "a2", "a3", "b0", "b1", "c0"]
+        )
+        self.assertEqual(results["a"], (4, None))
+        self.assertEqual(results["b"][0], 2)
+        self.assertIsInstance(results["b"][1], IOError)
+        self.assertEqual(results["c"], (1, "not published"))
+        stats = metrics.summary()["feeds"]
+        self.assertEqual(stats["a"]["posts_total"], {"published": 4})
+        self.assertEqual(stats["b"]["posts_total"], {"failed": 1, "published": 2})
+        self.assertEqual(stats["b"]["publish_seconds"]["count"], 3)
+        # and schedules a retry
+        row = self.db.execute(
+            "SELECT attempts, last_error, next_attempt_at FROM feeds WHERE guid = 'b2'"
+        ).fetchone()
+        self.assertEqual(row["attempts"], 1)
+        self.assertEqual(row["last_error"], "throttled")
+        self.assertGreater(row["next_attempt_at"], time.time())
+        self.assertEqual(queued_items(self.db, self.feeds[1]), [])
+
+    @mock.patch.object(batch, "PodClient")
+    def test_publish_feeds_rate(self, mock_client):
+        mock_client.return_value.publish.return_value = True
+        bucket = TokenBucket(rate=100, burst=2)
+        start = time.monotonic()
+        publish_feeds(self.db, self.feeds, workers=3, buckets={"pod": bucket})
+        # 12 posts, 2 right away and 10 more at 100 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(len(self.posted()), 12)
+
+    @mock.patch.object(batch, "PodClient")
+    def test_publish_feeds_lease(self, mock_client):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        file = os.path.join(directory.name, "feed.db")
+        self.db = connect_db(file)
+        self.addCleanup(self.db.close)
+        self.fill()
+        order = []
+
+        def publish(row, args):
+            if row["guid"] == "a0":
+                # b waits in the pool past its lease, and another process
+                # publishes its first item meanwhile
+                other = connect_db(file)
+                other.execute("UPDATE publish_leases SET expires = 0")
+                self.assertTrue(claim_feed(other, "b", "OTHER"))
+                mark_posted(other, "b0")
+                release_feed(other, "b", "OTHER")
+                other.close()
+            order.append(row["guid"])
+            return True
+
+        mock_client.return_value.publish.side_effect = publish
+        results = publish_feeds(self.db, self.feeds[:2], workers=1)
+        self.assertEqual(order, ["a0", "a1", "a2", "a3"])
+        self.assertEqual(results["b"], (0, None))
+
+    @mock.patch.object(batch, "PodClient")
+    def test_publish_feeds_error(self, mock_client):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        file = os.path.join(directory.name, "feed.db")
+        self.db = connect_db(file)
+        self.addCleanup(self.db.close)
+        self.fill()
+        mock_client.return_value.publish.return_value = True
+        errors = []
+
+        def target():
+            # on a thread of its own, so that a hang fails the test
+            db = connect_db(file)
+            try:
+                publish_feeds(db, self.feeds, workers=2)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+            finally:
+                db.close()
+
+        with mock.patch.object(
+            batch, "mark_posted", side_effect=sqlite3.OperationalError("disk I/O error")
+        ):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            thread.join(10)
+        # the workers were stopped and the error was raised, without hanging
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([str(e) for e in errors], ["disk I/O error"])
+        self.assertLessEqual(mock_client.return_value.publish.call_count, 2)
+
+    @mock.patch.object(batch, "PodClient")
+    def test_publish_feeds_rendered(self, mock_client):
+        mock_client.return_value.publish.return_value = True
+        for args in self.feeds:
+            args.render_at_ingest = True
+            args.no_branding = True
+        publish_feeds(self.db, self.feeds)
+        # the items queued without a rendered post were given one
+        rows = [c.args[0] for c in mock_client.return_value.publish.call_args_list]
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(set(r["rendered"] for r in rows), {"### []()\n\n"})
+
+    @mock.patch.object(batch, "PodClient")
+    def test_publish_feeds_stop(self, mock_client):
+        stop = threading.Event()
+
+        def publish(row, args):
+            stop.set()
+            return True
+
+        mock_client.return_value.publish.side_effect = publish
+        sessions = {}
+        results = publish_feeds(self.db, self.feeds, 1, sessions=sessions, stop=stop)
+        # the post in flight was finished and marked
+        self.assertEqual(self.posted(), ["a0"])
+        self.assertEqual(results["a"], (1, None))
+        self.assertEqual(list(sessions), ["pod"])
+        self.assertEqual(
+            self.db.execute("SELECT COUNT(*) FROM publish_leases").fetchone()[0], 0
+        )
+
+    @mock.patch.object(batch, "PodClient")
+    def test_publish_feeds_claimed(self, mock_client):
+        mock_client.return_value.publish.return_value = True
+        claim_feed(self.db, "b", "another process")
+        results = publish_feeds(self.db, self.feeds)
+        self.assertEqual(results["b"], (0, None))
+        self.assertEqual(len(self.posted()), 8)
+        # the other feeds' leases were released
+        self.assertEqual(
+            [r["feed_id"] for r in self.db.execute("SELECT * FROM publish_leases")],
+            ["b"],
+        )
+
+    @mock.patch.object(batch, "PodClient")
+    def test_publish_feeds_duplicates(self, mock_client):
+        mock_client.return_value.publish.return_value = True
+        # a0 and b0 are the same article
+        fingerprint = simhash(" ".join("word%s" % n for n in range(100)))
+        for guid in ("a0", "b0"):
+            self.db.execute(
+                "UPDATE feeds SET simhash = ? WHERE guid = ?", (fingerprint, guid)
+            )
+        for args in self.feeds:
+            args.duplicate_window = 1
+        results = publish_feeds(self.db, self.feeds)
+        self.assertEqual(results["b"], (3, None))
+        self.assertEqual(len(self.posted()), 11)
+        self.assertEqual(
+            self.db.execute("SELECT posted FROM feeds WHERE guid = 'b0'").fetchone()[0],
+            2,
+        )
+
+
+class Clock:
+    """
+    a stand-in for time.monotonic() and time.sleep()
+    """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.config = {
+            "jitter": 0,
+            "defaults": {"pod_url": "pod", "token": "TOKEN", "quiet": True},
+            "feeds": [
+                {"feed_id": "a", "feed_url": "http://a/", "interval": 1},
+                {"feed_id": "b", "feed_url": "http://b/", "interval": 2},
+            ],
+        }
+        self.runs = []
+        self.db = connect_db(":memory:")
+        self.addCleanup(self.db.close)
+
+    def load(self):
+        return dict(self.config), load_feeds(self.config)
+
+    def scheduler(self, until):
+        scheduler = Scheduler(
+            self.db, self.load, clock=self.clock, sleep=self.clock.sleep
+        )
+
+        def run(db, feeds, **kwargs):
+            self.runs.append((self.clock.now, sorted(args.feed_id for args in feeds)))
+            self.assertIs(kwargs["sessions"], scheduler.sessions)
+            if self.clock.now >= until:
+                scheduler.stop.set()
+
+        patcher = mock.patch.object(batch, "run", side_effect=run)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return scheduler
+
+    def test_run(self):
+        self.scheduler(until=240).run()
+        self.assertEqual(
+            self.runs,
+            [
+                (0, ["a", "b"]),
+                (60, ["a"]),
+                (120, ["a", "b"]),
+                (180, ["a"]),
+                (240, ["a", "b"]),
+            ],
+        )
+
+    def test_run_learned(self):
+        scheduler = self.scheduler(until=600)
+        now = int(time.time())
+        # a is due 5 minutes after each run, see next_poll()
+        self.db.execute(
+            "INSERT INTO feed_state(feed_id, next_check) VALUES('a', ?)", (now + 300,)
+        )
+        with mock.patch.object(time, "time", return_value=now):
+            scheduler.run()
+        self.assertEqual(
+            self.runs,
+            [
+                (0, ["a", "b"]),
+                (120, ["b"]),
+                (240, ["b"]),
+                (300, ["a"]),
+                (360, ["b"]),
+                (480, ["b"]),
+                (600, ["a", "b"]),
+            ],
+        )
+
+    def test_jitter(self):
+        self.config["jitter"] = 0.5
+        scheduler = self.scheduler(until=3600)
+        scheduler.run()
+        times = [t for t, feeds in self.runs if "b" in feeds]
+        waits = [b - a for a, b in zip(times, times[1:])]
+        self.assertTrue(all(60 <= w <= 180 for w in waits))
+        self.assertGreater(len(set(waits)), 1)
+
+    def test_reload(self):
+        scheduler = self.scheduler(until=120)
+        self.clock.sleep(30)
+        self.config["feeds"] = self.config["feeds"][1:] + [
+            {"feed_id": "c", "feed_url": "http://c/", "interval": 1}
+        ]
+        scheduler.handle_signal(signal.SIGHUP, None)
+        scheduler.run()
+        # a is gone, b kept its place and c runs right away
+        self.assertEqual(self.runs, [(30, ["b", "c"]), (90, ["c"]), (150, ["b", "c"])])
+
+    def test_reload_broken(self):
+        scheduler = self.scheduler(until=0)
+        self.config["feeds"] = [{"feed_id": "a"}]
+        with mock.patch("sys.stderr"):
+            scheduler.reload()
+        self.assertEqual(sorted(scheduler.feeds), ["a", "b"])
+
+    def test_stop(self):
+        scheduler = self.scheduler(until=0)
+        scheduler.handle_signal(signal.SIGTERM, None)
+        scheduler.run()
+        self.assertEqual(self.runs, [])
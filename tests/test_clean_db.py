@@ -0,0 +1,117 @@
+import os, tempfile, time, unittest
+from sh_feeder.sh_feeder import Feed, connect_db, simhash
+from sh_feeder.clean_db import *
+
+DAY = 86400
+
+
+class TestCleanDb(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.conn = connect_db(os.path.join(directory.name, "feed.db"))
+        self.addCleanup(self.conn.close)
+        now = time.time()
+        # one item per feed per day for ten days, the last three unposted
+        for feed_id in ("a", "b"):
+            for age in range(10):
+                self.conn.execute(
+                    "INSERT INTO feeds(guid, feed_id, title, link, image, \
+                    image_title, hashtags, body, summary, posted, timestamp) \
+                    VALUES(?, ?, 'TITLE', 'LINK', '', '', '#tag', ?, 'SUMMARY', \
+                    ?, ?)",
+                    (
+                        "%s%s" % (feed_id, age),
+                        feed_id,
+                        "BODY" * 5000,
+                        int(age > 2),
+                        now - age * DAY - 60,
+                    ),
+                )
+        self.conn.commit()
+
+    def guids(self, table="feeds"):
+        return sorted(r[0] for r in self.conn.execute("SELECT guid FROM %s" % table))
+
+    def test_expire_items(self):
+        self.assertEqual(expire_items(self.conn, None, {"a": 7}, batch_size=2), 3)
+        self.assertEqual(len(self.guids()), 17)
+        self.assertEqual(expire_items(self.conn, 5, {"a": 2.5}), 9)
+        self.assertEqual(self.guids(), ["a0", "a1", "a2", "b0", "b1", "b2", "b3", "b4"])
+
+    def test_expire_items_fingerprints(self):
+        fingerprint = simhash(" ".join("word%s" % n for n in range(100)))
+        self.conn.execute("UPDATE feeds SET simhash = ?", (fingerprint,))
+        self.conn.executemany(
+            "INSERT INTO fingerprints(band, guid) VALUES(?, ?)",
+            [(b, g) for g in self.guids() for b in simhash_bands(fingerprint)],
+        )
+        expire_items(self.conn, 5)
+        self.assertEqual(
+            sorted(
+                set(r[0] for r in self.conn.execute("SELECT guid FROM fingerprints"))
+            ),
+            self.guids(),
+        )
+
+    def test_expire_items_deadline(self):
+        self.assertEqual(expire_items(self.conn, 0, batch_size=1, deadline=0), 0)
+        self.assertEqual(len(self.guids()), 20)
+
+    def test_expired_items_are_known(self):
+        expire_items(self.conn, 5)
+        feed = Feed(feed_id="a", db=self.conn, parsed={"entries": []})
+        self.assertEqual(
+            feed.known_guids([{"id": "a9"}, {"id": "new"}]),
+            {"a9"},
+        )
+
+    def test_blank_posted(self):
+        self.assertEqual(blank_posted(self.conn, batch_size=3), 14)
+        self.assertEqual(blank_posted(self.conn), 0)
+        rows = self.conn.execute(
+            "SELECT guid, title, body FROM feeds WHERE title != ''"
+        ).fetchall()
+        self.assertEqual(
+            sorted(r["guid"] for r in rows), ["a0", "a1", "a2", "b0", "b1", "b2"]
+        )
+
+    def test_blank_rendered(self):
+        self.conn.execute("UPDATE feeds SET rendered = 'POST' WHERE guid != 'a0'")
+        self.assertEqual(blank_rendered(self.conn, batch_size=2), 5)
+        self.assertEqual(blank_rendered(self.conn), 0)
+        rows = self.conn.execute("SELECT guid, title, link, rendered FROM feeds \
+            WHERE posted = 0 AND body = '' AND summary = '' AND hashtags = '' \
+            ORDER BY guid").fetchall()
+        self.assertEqual(
+            [tuple(r) for r in rows],
+            [(g, "TITLE", "LINK", "POST") for g in ("a1", "a2", "b0", "b1", "b2")],
+        )
+        # posted items don't keep their rendered text either
+        blank_posted(self.conn)
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT COUNT(*) FROM feeds WHERE rendered IS NOT NULL"
+            ).fetchone()[0],
+            5,
+        )
+
+    def test_incremental_vacuum(self):
+        self.assertEqual(self.conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        blank_posted(self.conn)
+        self.assertGreater(self.conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+        self.assertGreater(incremental_vacuum(self.conn, pages=2), 0)
+        self.assertEqual(self.conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+
+    def test_full_vacuum(self):
+        self.conn.execute("PRAGMA auto_vacuum = NONE")
+        self.conn.execute("VACUUM")
+        self.assertEqual(incremental_vacuum(self.conn), 0)
+        full_vacuum(self.conn)
+        self.assertEqual(self.conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+    def test_parse_args(self):
+        args = parse_args(["--feed-retention", "a=b=3", "--retention", "30", "x.db"])
+        self.assertEqual(args.feed_retention, [("a=b", 3)])
+        self.assertEqual(args.retention, 30)
+        self.assertEqual(args.database, "x.db")
@@ -0,0 +1,93 @@
+import multiprocessing, os, random, tempfile, time, unittest
+from sh_feeder.sh_feeder import *
+
+FEEDS = ["feed%s" % n for n in range(6)]
+ITEMS = 40
+PROCESSES = 8
+
+
+class RecordingPod:
+    """
+    stands in for PodClient, appending each post to a shared log file.
+    every fifth item fails the first time it is posted
+    """
+
+    def __init__(self, log):
+        self.log = log
+
+    def publish(self, row, args):
+        time.sleep(0.002)
+        if int(row["guid"].rsplit("-", 1)[1]) % 5 == 0 and row["attempts"] == 0:
+            raise IOError("HTTP 503")
+        fd = os.open(self.log, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        os.write(fd, ("%s\t%s\n" % (args.feed_id, row["guid"])).encode())
+        os.close(fd)
+        return True
+
+
+def feed_args(feed_id):
+    return parse_args(
+        [
+            "--feed-id", feed_id, "--feed-url", "URL", "--pod-url", "POD",
+            "--token", "TOKEN", "--retry-delay", "0", "--max-attempts", "100",
+            "--quiet",
+        ]
+    )  # fmt: skip
+
+
+def run_feeder(database, log, seed):
+    """
+    what one cron job does: ingest every feed, then publish its queue
+    """
+    rng = random.Random(seed)
+    db = connect_db(database)
+    client = RecordingPod(log)
+    feeds = list(FEEDS)
+    rng.shuffle(feeds)
+    for feed_id in feeds:
+        entries = [
+            {"id": "%s-%s" % (feed_id, n), "link": "https://example.com/%s" % n}
+            for n in range(ITEMS)
+        ]
+        args = feed_args(feed_id)
+        process_feed(db, args, parsed={"entries": entries}, publish=False)
+        # a few rounds, to retry the failures
+        for round in range(3):
+            publish_items(db, client, args)
+            time.sleep(rng.uniform(0, 0.01))
+    db.close()
+
+
+class TestConcurrency(unittest.TestCase):
+    def test_many_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, "feed.db")
+        log = os.path.join(directory.name, "posts.log")
+        processes = [
+            multiprocessing.Process(target=run_feeder, args=(database, log, n))
+            for n in range(PROCESSES)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join(120)
+            self.assertEqual(p.exitcode, 0)
+        # publish whatever is still waiting for a retry
+        db = connect_db(database)
+        self.addCleanup(db.close)
+        for feed_id in FEEDS:
+            while publish_items(db, RecordingPod(log), feed_args(feed_id)):
+                pass
+        with open(log) as fh:
+            posts = [line.rstrip("\n").split("\t") for line in fh]
+        # every item was posted exactly once, in order, and marked as posted
+        for feed_id in FEEDS:
+            self.assertEqual(
+                [guid for f, guid in posts if f == feed_id],
+                ["%s-%s" % (feed_id, n) for n in range(ITEMS)],
+            )
+        self.assertEqual(len(posts), len(FEEDS) * ITEMS)
+        counts = db.execute("SELECT posted, COUNT(*) FROM feeds GROUP BY posted")
+        self.assertEqual([tuple(r) for r in counts], [(1, len(FEEDS) * ITEMS)])
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
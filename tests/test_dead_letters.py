@@ -0,0 +1,33 @@
+import time, unittest
+from sh_feeder.sh_feeder import connect_db
+from sh_feeder.dead_letters import *
+
+
+class TestDeadLetters(unittest.TestCase):
+    def setUp(self):
+        self.conn = connect_db(":memory:")
+        self.addCleanup(self.conn.close)
+        for n, (feed_id, posted) in enumerate(
+            [("a", -1), ("a", 0), ("b", -1), ("b", 1), ("a", -1)]
+        ):
+            self.conn.execute(
+                "INSERT INTO feeds(guid, feed_id, title, posted, attempts, \
+                last_error, next_attempt_at, timestamp) \
+                VALUES(?, ?, '', ?, 8, 'HTTP 500', ?, ?)",
+                ("GUID%s" % n, feed_id, posted, time.time() + 3600, n),
+            )
+
+    def test_dead_letters(self):
+        guids = lambda rows: [r["guid"] for r in rows]
+        self.assertEqual(guids(dead_letters(self.conn)), ["GUID0", "GUID2", "GUID4"])
+        self.assertEqual(guids(dead_letters(self.conn, "a")), ["GUID0", "GUID4"])
+        self.assertEqual(guids(dead_letters(self.conn, guids=["GUID2"])), ["GUID2"])
+
+    def test_requeue(self):
+        self.assertEqual(requeue(self.conn, dead_letters(self.conn, "a")), 2)
+        row = self.conn.execute("SELECT * FROM feeds WHERE guid = 'GUID4'").fetchone()
+        self.assertEqual(row["posted"], 0)
+        self.assertEqual(row["attempts"], 0)
+        self.assertIsNone(row["last_error"])
+        self.assertEqual(row["next_attempt_at"], 0)
+        self.assertEqual([r["guid"] for r in dead_letters(self.conn)], ["GUID2"])
@@ -1,13 +1,16 @@
-import sqlite3, time, unittest
+import feedparser, glob, http.server, io, json, os, requests, sqlite3, subprocess, sys
+import tempfile, threading, time, tracemalloc, unittest, urllib.error, urllib.parse
 from unittest import mock
-from pod_feeder_v2.pod_feeder import *
+from sh_feeder.sh_feeder import *
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
 
 
 class TestFeed(unittest.TestCase):
     @mock.patch.object(Feed, "get_items")
     @mock.patch.object(Feed, "fetch")
     def test___init__(self, mock_fetch, mock_get_items):
-        mock_fetch.return_value = {"entries": ["entry"]}
+        mock_fetch.side_effect = lambda *args, **kwargs: {"entries": ["entry"]}
         mock_get_items.return_value = ["item"]
         # check defaults
         default = Feed()
@@ -32,16 +35,33 @@ class TestFeed(unittest.TestCase):
         self.assertTrue(custom.category_tags)
         self.assertEqual(custom.ignore_tags, ["ignore"])
         self.assertTrue(custom.debug)
-        self.assertEqual(custom.feed, {"entries": ["entry"]})
-        self.assertEqual(custom.entries, ["entry"])
         self.assertEqual(custom.items, ["item"])
-        mock_fetch.assert_called_with("https://example.com")
+        # the raw entries are let go once they are converted
+        self.assertEqual(custom.feed, {})
+        self.assertEqual(custom.entries, [])
+        mock_fetch.assert_called_with(
+            "https://example.com", etag=None, modified=None, digest=None
+        )
+        self.assertFalse(custom.not_modified)
+        # a 304 response skips building the items
+        mock_get_items.reset_mock()
+        mock_fetch.side_effect = None
+        mock_fetch.return_value = {"status": 304, "entries": []}
+        not_modified = Feed(url="https://example.com", etag="ETAG")
+        mock_fetch.assert_called_with(
+            "https://example.com", etag="ETAG", modified=None, digest=None
+        )
+        self.assertTrue(not_modified.not_modified)
+        self.assertEqual(not_modified.items, [])
+        mock_get_items.assert_not_called()
 
+    @mock.patch.object(Feed, "fetch")
     @mock.patch.object(FeedItem, "remove_tags")
     @mock.patch.object(FeedItem, "add_tags")
     @mock.patch.object(FeedItem, "__init__")
-    def test_get_items(self, mock_init, mock_add_tags, mock_remove_tags):
+    def test_get_items(self, mock_init, mock_add_tags, mock_remove_tags, mock_fetch):
         mock_init.return_value = None
+        mock_fetch.return_value = {"entries": []}
         feed = Feed(
             auto_tags=["auto"], ignore_tags=["ignore"], url="https://example.com"
         )
@@ -54,22 +74,248 @@ class TestFeed(unittest.TestCase):
         mock_add_tags.assert_called_with(["auto"])
         mock_remove_tags.assert_called_with(["ignore"])
 
+    @mock.patch.object(FeedItem, "__init__")
+    def test_get_items_known(self, mock_init):
+        mock_init.return_value = None
+        conn = connect_db(":memory:")
+        conn.execute(
+            "INSERT INTO seen_items(key) VALUES(?)", (seen_key("FEED_ID", "B"),)
+        )
+        feed = Feed(feed_id="FEED_ID", db=conn, parsed={"entries": []})
+        feed.entries = [{"id": "A"}, {"id": "B"}, {"id": "C"}]
+        self.assertEqual(feed.known_guids(feed.entries), {"B"})
+        self.assertEqual(len(feed.get_items()), 2)
+        mock_init.assert_any_call({"id": "A"}, category_tags=False)
+        mock_init.assert_called_with({"id": "C"}, category_tags=False)
+        # entries are looked up a chunk at a time
+        mock_init.reset_mock()
+        self.assertEqual(len(list(feed.iter_items(chunk_size=1))), 2)
+        mock_init.assert_any_call({"id": "A"}, category_tags=False)
+        mock_init.assert_called_with({"id": "C"}, category_tags=False)
+        # stop at the first known entry
+        mock_init.reset_mock()
+        feed.stop_at_known = True
+        self.assertEqual(len(feed.get_items()), 1)
+        mock_init.assert_called_once_with({"id": "A"}, category_tags=False)
+        # the same id in another feed is a different item
+        feed.feed_id = "OTHER_FEED_ID"
+        self.assertEqual(feed.known_guids(feed.entries), set())
+        feed.feed_id = "FEED_ID"
+        # the filter is checked instead of the db
+        feed.seen = BloomFilter(100)
+        feed.seen.add(seen_key("FEED_ID", "C"))
+        self.assertEqual(feed.known_guids(feed.entries), {"C"})
+        feed.seen = None
+        # without a db every entry is converted
+        feed.db = None
+        self.assertEqual(feed.known_guids(feed.entries), set())
+        self.assertEqual(len(feed.get_items()), 3)
+
+    def test_streaming(self):
+        conn = connect_db(":memory:")
+        path = os.path.join(FIXTURES, "feeds", "rss.xml")
+        metrics = Metrics()
+        with mock.patch("sh_feeder.sh_feeder.METRICS", metrics):
+            feed = Feed(feed_id="FEED_ID", url=path, db=conn, streaming=True)
+            self.assertNotIsInstance(feed.items, list)
+            self.assertEqual(feed.load_db(conn), 3)
+            feed = Feed(feed_id="FEED_ID", url=path, db=conn, streaming=True)
+            self.assertEqual(feed.load_db(conn), 0)
+        stats = metrics.summary()["feeds"]["FEED_ID"]
+        self.assertEqual(stats["items_total"], {"known": 3, "new": 3})
+        self.assertEqual(stats["item_build_seconds"]["count"], 3)
+
+    def test_memory(self):
+        # 1000 entries of about 1.2KB of text each, as feedparser returns them
+        def entries():
+            return [
+                {
+                    "id": "https://example.com/%s" % n,
+                    "title": "Article %s" % n,
+                    "link": "https://example.com/%s" % n,
+                    "content": [
+                        {
+                            "type": "text/plain",
+                            "value": " ".join("word%s" % (n + w) for w in range(150)),
+                        }
+                    ],
+                    "summary_detail": {"type": "text/plain", "value": "Summary"},
+                    "tags": [{"term": t} for t in ("Linux", "Privacy", "News")],
+                }
+                for n in range(1000)
+            ]
+
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        start = tracemalloc.get_traced_memory()[0]
+        # fingerprinting is slow to trace, and only adds an int to each item
+        with mock.patch("sh_feeder.sh_feeder.simhash", lambda text: 2**62):
+            feed = Feed(
+                feed_id="FEED_ID", parsed={"entries": entries()}, category_tags=True
+            )
+        retained, peak = [m - start for m in tracemalloc.get_traced_memory()]
+        self.assertEqual(len(feed.items), 1000)
+        self.assertFalse(hasattr(feed.items[0], "__dict__"))
+        # about 3.4MB while both the entries and the items exist
+        self.assertLess(peak, 4.5 * 1024 * 1024)
+        # then the entries are let go. the items share their texts, and take
+        # about 60% of that
+        self.assertLess(retained, peak * 0.75)
+
+    @mock.patch.object(feedparser, "parse")
+    @mock.patch("sh_feeder.sh_feeder.download_feed")
+    def test_fetch(self, mock_download_feed, mock_parse):
+        stream = io.BytesIO(b"<rss/>")
+        mock_download_feed.return_value = {
+            "status": 200,
+            "href": "https://example.com/feed",
+            "headers": {"content-type": "application/rss+xml"},
+            "length": 6,
+            "stream": stream,
+        }
+        mock_parse.return_value = {"entries": []}
+        default = Feed(url="https://example.com", parsed={"entries": []})
+        f = default.fetch()
+        mock_download_feed.assert_called_with("https://example.com", None, None)
+        # the download is parsed, with relative links resolved against its url
+        mock_parse.assert_called_with(
+            stream,
+            response_headers={
+                "content-type": "application/rss+xml",
+                "content-location": "https://example.com/feed",
+            },
+        )
+        self.assertTrue(stream.closed)
+        self.assertEqual(f["status"], 200)
+        self.assertEqual(f["length"], 6)
+        self.assertIn("parse_time", f)
+        self.assertIn("elapsed", f)
+        # nothing to parse if the feed hasn't changed
+        mock_parse.reset_mock()
+        mock_download_feed.return_value = {"status": 304, "headers": {}}
+        f = default.fetch(
+            "https://custom.example.com", etag="ETAG", modified="MODIFIED"
+        )
+        mock_download_feed.assert_called_with(
+            "https://custom.example.com", "ETAG", "MODIFIED"
+        )
+        mock_parse.assert_not_called()
+        self.assertEqual(f["status"], 304)
+
     @mock.patch.object(feedparser, "parse")
-    def test_fetch(self, mock_parse):
-        mock_parse.return_value = {}
-        default = Feed.__new__(Feed)
-        default.url = "https://example.com"
-        default.fetch()
-        mock_parse.assert_called_with("https://example.com")
-        with_url = Feed.__new__(Feed)
-        with_url.url = "https://example.com"
-        default.fetch("https://custom.example.com")
-        mock_parse.assert_called_with("https://custom.example.com")
+    @mock.patch("sh_feeder.sh_feeder.download_feed")
+    def test_fetch_unchanged(self, mock_download_feed, mock_parse):
+        mock_parse.return_value = {"entries": []}
+        mock_download_feed.side_effect = lambda url, etag, modified: {
+            "status": 200,
+            "headers": {},
+            "stream": io.BytesIO(b"<rss/>"),
+        }
+        digest = fetch_feed("https://example.com")["digest"]
+        self.assertEqual(mock_parse.call_count, 1)
+        self.assertEqual(
+            fetch_feed("https://example.com", digest="OTHER")["digest"], digest
+        )
+        self.assertEqual(mock_parse.call_count, 2)
+        # the same download as last time isn't parsed
+        f = fetch_feed("https://example.com", digest=digest)
+        self.assertEqual(mock_parse.call_count, 2)
+        self.assertTrue(f["unchanged"])
+        self.assertNotIn("stream", f)
+        self.assertEqual(f["status"], 200)
+
+    def test_download_feed_timeout(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowFeed)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:%s/feed" % server.server_port
+        server.delay, server.chunks = 0, 2
+        self.assertEqual(download_feed(url, timeout=(1, 5))["length"], 2)
+        # a server that doesn't answer
+        server.delay = 0.5
+        with self.assertRaises(DOWNLOAD_ERRORS):
+            download_feed(url, timeout=(0.1, 5))
+        # or that sends a little at a time for too long
+        server.delay, server.chunks = 0, 20
+        with self.assertRaises(TimeoutError):
+            download_feed(url, timeout=(1, 0.2))
+
+    def test_ingest_unchanged(self):
+        args = parse_args(
+            [
+                "--feed-id", "FEED_ID", "--feed-url",
+                os.path.join(FIXTURES, "feeds", "rss.xml"), "--pod-url", "POD",
+                "--fetch-only", "--quiet",
+            ]
+        )  # fmt: skip
+        conn = connect_db(":memory:")
+        metrics = Metrics()
+        with mock.patch("sh_feeder.sh_feeder.METRICS", metrics):
+            self.assertEqual(ingest_feed(conn, args), 3)
+            with mock.patch.object(Feed, "get_items") as mock_get_items:
+                self.assertEqual(ingest_feed(conn, args), 0)
+            mock_get_items.assert_not_called()
+        stats = metrics.summary()["feeds"]["FEED_ID"]
+        self.assertEqual(stats["fetch_unchanged_total"], 1)
+        self.assertEqual(stats["parse_seconds"]["count"], 1)
+        self.assertIsNotNone(get_feed_state(conn, "FEED_ID")["digest"])
+
+    @mock.patch.object(Feed, "fetch")
+    def test_save_state(self, mock_fetch):
+        mock_fetch.return_value = {
+            "status": 200,
+            "etag": "ETAG",
+            "modified": "MODIFIED",
+            "headers": {"content-length": "1234"},
+            "elapsed": 0.5,
+            "entries": [],
+        }
+        conn = connect_db(":memory:")
+        Feed(feed_id="FEED_ID", url="FEED_URL").save_state(conn)
+        state = get_feed_state(conn, "FEED_ID")
+        self.assertEqual(state["etag"], "ETAG")
+        self.assertEqual(state["modified"], "MODIFIED")
+        self.assertEqual(state["length"], 1234)
+        self.assertEqual(state["fetch_time"], 0.5)
+        self.assertIsNone(get_feed_state(conn, "FEED_ID", "OTHER_URL"))
+        self.assertIsNone(get_feed_state(conn, "OTHER_ID"))
+        # a 304 keeps the validators from the last full fetch
+        mock_fetch.return_value = {"status": 304, "entries": []}
+        Feed(feed_id="FEED_ID", url="FEED_URL").save_state(conn)
+        self.assertEqual(get_feed_state(conn, "FEED_ID", "FEED_URL")["etag"], "ETAG")
+
+    @mock.patch.object(time, "time")
+    @mock.patch.object(Feed, "fetch")
+    def test_save_state_history(self, mock_fetch, mock_time):
+        mock_fetch.return_value = {
+            "status": 200,
+            "feed": {"ttl": "30", "skip_hours": ["3"]},
+            "entries": [],
+        }
+        conn = connect_db(":memory:")
+        feed = Feed(feed_id="FEED_ID", url="FEED_URL")
+        for now, new, interval in (
+            (1000, 5, None),
+            (2000, 0, None),
+            (4600, 1, 3600),
+            (5000, 0, 3600),
+            (8000, 2, 3600 + (3400 - 3600) * UPDATE_WEIGHT),
+        ):
+            mock_time.return_value = now
+            feed.save_state(conn, new)
+            state = get_feed_state(conn, "FEED_ID")
+            self.assertEqual(state["update_interval"], interval)
+        self.assertEqual(state["last_update"], 8000)
+        self.assertEqual(state["hint_wait"], 1800)
+        self.assertEqual(state["skip_hours"], "3")
 
+    @mock.patch.object(Feed, "fetch")
     @mock.patch.object(FeedItem, "get_summary")
     @mock.patch.object(FeedItem, "get_body")
     @mock.patch.object(FeedItem, "get_image")
-    def test_load_db(self, mock_get_image, mock_get_body, mock_get_summary):
+    def test_load_db(self, mock_get_image, mock_get_body, mock_get_summary, mock_fetch):
+        mock_fetch.return_value = {"entries": []}
         mock_get_image.return_value = "IMAGE"
         mock_get_body.return_value = "BODY"
         mock_get_summary.return_value = "SUMMARY"
@@ -90,171 +336,399 @@ class TestFeed(unittest.TestCase):
         self.assertEqual(row["hashtags"], "")
         self.assertEqual(row["posted"], 0)
         self.assertRegex(str(row["timestamp"]), r"[0-9]{10}")
+        # too short to fingerprint
+        self.assertIsNone(row["simhash"])
 
-
-class TestFeedItem(unittest.TestCase):
-    @mock.patch.object(FeedItem, "get_tags")
     @mock.patch.object(FeedItem, "get_summary")
     @mock.patch.object(FeedItem, "get_body")
     @mock.patch.object(FeedItem, "get_image")
-    def test___init__(
-        self, mock_get_image, mock_get_body, mock_get_summary, mock_get_tags
-    ):
-        mock_get_image.return_value = "IMAGE"
+    def test_load_db_duplicates(self, mock_get_image, mock_get_body, mock_get_summary):
+        mock_get_image.return_value = None
         mock_get_body.return_value = "BODY"
         mock_get_summary.return_value = "SUMMARY"
-        item = FeedItem(
-            {"id": "ID", "title": "TITLE", "link": "LINK", "tags": ["tag"]},
-            category_tags=True,
+        feed = Feed(feed_id="FEED_ID", parsed={"entries": []}, seen=BloomFilter(100))
+        conn = connect_db(":memory:")
+        feed.items = [FeedItem({"id": "A", "title": "FIRST"}), FeedItem({"id": "B"})]
+        self.assertEqual(feed.load_db(conn), 2)
+        # known items are left alone, duplicates within the feed are ignored
+        feed.items = [
+            FeedItem({"id": "A", "title": "CHANGED"}),
+            FeedItem({"id": "C"}),
+            FeedItem({"id": "C"}),
+        ]
+        self.assertEqual(feed.load_db(conn), 1)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM feeds").fetchone()[0], 3)
+        self.assertEqual(
+            conn.execute("SELECT title FROM feeds WHERE guid = 'A'").fetchone()[0],
+            "FIRST",
         )
-        self.assertFalse(item.posted)
-        self.assertEqual(item.guid, "ID")
-        self.assertEqual(item.image, "IMAGE")
-        self.assertEqual(item.title, "TITLE")
-        self.assertEqual(item.link, "LINK")
-        self.assertRegex(str(item.timestamp), r"[0-9]{10}")
-        self.assertEqual(item.body, "BODY")
-        self.assertEqual(item.summary, "SUMMARY")
-        self.assertEqual(item.tags, [])
-        mock_get_tags.assert_called_with(["tag"])
+        feed.items = []
+        self.assertEqual(feed.load_db(conn), 0)
+        # seen items stay seen once they are deleted
+        conn.execute("DELETE FROM feeds")
+        feed.items = [FeedItem({"id": "A"}), FeedItem({"id": "D"})]
+        self.assertEqual(feed.load_db(conn), 1)
+        self.assertEqual([r[0] for r in conn.execute("SELECT guid FROM feeds")], ["D"])
+        # the new keys were added to the filter
+        for guid in "ABCD":
+            self.assertIn(seen_key("FEED_ID", guid), feed.seen)
 
-    def test_get_id(self):
-        self.assertEqual(FeedItem.get_id(FeedItem, {"id": "ID"}), "ID")
-        self.assertEqual(FeedItem.get_id(FeedItem, {"link": "LINK"}), hash("LINK"))
+    def test_load_db_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, "feed.db")
+            conn = connect_db(file)
+            other = connect_db(file, timeout=0)
 
-    @mock.patch.object(FeedItem, "html2markdown")
-    def test_get_body(self, mock_html2markdown):
-        mock_html2markdown.return_value = "markdown\n"
-        self.assertIsNone(FeedItem.get_body(FeedItem, None))
-        body = FeedItem.get_body(FeedItem, ["test"])
-        self.assertEqual(body, "markdown")
-        mock_html2markdown.assert_called_with("test")
+            def items():
+                for n in range(5):
+                    # fails if the database is still locked while the next
+                    # item is converted
+                    other.execute("INSERT INTO seen_items(key) VALUES(?)", (n,))
+                    other.commit()
+                    yield FeedItem({"id": str(n)})
 
-    @mock.patch.object(FeedItem, "get_image_from_summary")
-    @mock.patch.object(FeedItem, "get_image_from_summary_detail")
-    @mock.patch.object(FeedItem, "get_image_from_content")
-    @mock.patch.object(FeedItem, "get_image_from_links")
-    @mock.patch.object(FeedItem, "get_image_from_media_thumbnail")
-    @mock.patch.object(FeedItem, "get_image_from_media_content")
-    def test_get_image(
-        self,
-        mock_get_image_from_media_content,
-        mock_get_image_from_media_thumbnail,
-        mock_get_image_from_links,
-        mock_get_image_from_content,
-        mock_get_image_from_summary_detail,
-        mock_get_image_from_summary,
-    ):
-        mock_get_image_from_media_content.return_value = None
-        mock_get_image_from_media_thumbnail.return_value = None
-        mock_get_image_from_links.return_value = None
-        mock_get_image_from_content.return_value = None
-        mock_get_image_from_summary_detail.return_value = None
-        mock_get_image_from_summary.return_value = None
-        FeedItem.get_image(FeedItem, {})
-        mock_get_image_from_media_content.assert_called()
-        mock_get_image_from_media_thumbnail.assert_called()
-        mock_get_image_from_links.assert_called()
-        mock_get_image_from_content.assert_called()
-        mock_get_image_from_summary_detail.assert_called()
-        mock_get_image_from_summary.assert_called()
-
-    @mock.patch.object(FeedItem, "find_image_link")
-    def test_get_image_from_media_content(self, mock_find_image_link):
-        mock_find_image_link.return_value = "IMAGE"
-        self.assertEqual(
-            FeedItem.get_image_from_media_content(FeedItem, [{"url": ""}]), "IMAGE"
-        )
-        self.assertIsNone(FeedItem.get_image_from_media_content(FeedItem, []))
-        self.assertIsNone(FeedItem.get_image_from_media_content(FeedItem, {}))
-
-    @mock.patch.object(FeedItem, "find_image_link")
-    def test_get_image_from_media_thumbnail(self, mock_find_image_link):
-        mock_find_image_link.return_value = "IMAGE"
-        self.assertEqual(
-            FeedItem.get_image_from_media_thumbnail(FeedItem, [{"url": ""}]), "IMAGE"
-        )
-        self.assertIsNone(FeedItem.get_image_from_media_thumbnail(FeedItem, []))
-        self.assertIsNone(FeedItem.get_image_from_media_thumbnail(FeedItem, {}))
-
-    def test_get_image_from_links(self):
-        self.assertEqual(
-            FeedItem.get_image_from_links(
-                FeedItem, [{"type": "image/png", "href": "IMAGE"}]
-            ),
-            "IMAGE",
+            load_chunk = Feed.load_chunk
+            chunks = []
+
+            def locked_once(self, conn, items, client):
+                chunks.append(len(items))
+                if len(chunks) == 1:
+                    raise sqlite3.OperationalError("database is locked")
+                return load_chunk(self, conn, items, client)
+
+            feed = Feed(feed_id="FEED_ID", parsed={"entries": []})
+            feed.items = items()
+            with mock.patch("time.sleep"):
+                with mock.patch.object(Feed, "load_chunk", locked_once):
+                    self.assertEqual(feed.load_db(conn, chunk_size=2), 5)
+            # each chunk is a transaction, the locked one was tried again
+            self.assertEqual(chunks, [2, 2, 2, 1])
+            self.assertEqual(
+                conn.execute("SELECT COUNT(*) FROM feeds").fetchone()[0], 5
+            )
+            other.close()
+            conn.close()
+
+
+class TestStreamingParser(unittest.TestCase):
+    def test_parse(self):
+        # the items should come out the same as with feedparser
+        for name in ("rss.xml", "atom.xml"):
+            path = os.path.join(FIXTURES, "feeds", name)
+            expected = feedparser.parse(path).entries
+            with open(path, "rb") as fh:
+                entries = list(StreamingParser().parse(fh))
+            self.assertEqual(len(entries), len(expected))
+            for a, b in zip(expected, entries):
+                a = FeedItem(a, category_tags=True)
+                b = FeedItem(b, category_tags=True)
+                for field in ("guid", "title", "link", "image", "body", "summary"):
+                    self.assertEqual(getattr(a, field), getattr(b, field))
+                self.assertEqual(a.tags, b.tags)
+
+    def test_get_hint(self):
+        xml = b"""<?xml version="1.0"?>
+            <rss version="2.0"
+                xmlns:sy="http://purl.org/rss/1.0/modules/syndication/">
+            <channel><title>TITLE</title><ttl>90</ttl>
+            <sy:updatePeriod>daily</sy:updatePeriod>
+            <sy:updateFrequency>2</sy:updateFrequency>
+            <skipHours><hour>1</hour><hour>2</hour></skipHours>
+            <item><guid>GUID</guid><ttl>5</ttl></item>
+            </channel></rss>"""
+        feed = {}
+        entries = list(StreamingParser().parse(io.BytesIO(xml), feed))
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(
+            feed,
+            {
+                "ttl": "90",
+                "sy_updateperiod": "daily",
+                "sy_updatefrequency": "2",
+                "skip_hours": ["1", "2"],
+            },
+        )
+
+    def test_get_entry(self):
+        with open(os.path.join(FIXTURES, "feeds", "rss.xml"), "rb") as fh:
+            entries = list(StreamingParser().parse(fh))
+        self.assertEqual(entries[0]["id"], "example-post-101")
+        self.assertEqual(
+            entries[0]["tags"], [{"term": "Privacy"}, {"term": "Free Speech"}]
+        )
+        self.assertEqual(entries[1]["link"], "https://example.com/podcast/12")
+        self.assertEqual(
+            entries[1]["links"],
+            [
+                {
+                    "rel": "enclosure",
+                    "type": "audio/mpeg",
+                    "href": "https://example.com/ep12.mp3",
+                }
+            ],
+        )
+        # no <link>, so the permalink guid is used
+        self.assertEqual(entries[2]["link"], "https://example.com/photos/1")
+        self.assertEqual(
+            entries[2]["media_content"],
+            [{"url": "https://example.com/photos/1-large.jpg"}],
         )
 
-    @mock.patch.object(FeedItem, "find_image_link")
-    def test_get_image_from_content(self, mock_find_image_link):
-        mock_find_image_link.return_value = "IMAGE"
+    def test_get_text(self):
+        parser = StreamingParser()
+        elem = ElementTree.fromstring(
+            '<content xmlns="http://www.w3.org/2005/Atom" type="xhtml">'
+            '<div xmlns="http://www.w3.org/1999/xhtml">Hi</div></content>'
+        )
+        self.assertEqual(parser.get_text(elem)["type"], "application/xhtml+xml")
+        self.assertIn("Hi</html:div>", parser.get_text(elem)["value"])
+        elem = ElementTree.fromstring("<description>&lt;b&gt;x&lt;/b&gt;</description>")
         self.assertEqual(
-            FeedItem.get_image_from_content(FeedItem, [{"value": ""}]), "IMAGE"
+            parser.get_text(elem), {"type": "text/html", "value": "<b>x</b>"}
+        )
+
+
+class TestImageExtractor(unittest.TestCase):
+    def test_extract(self):
+        extractor = ImageExtractor()
+        entry = {
+            "media_content": [{"url": "https://example.com/content.jpg"}],
+            "media_thumbnail": [{"url": "https://example.com/thumbnail.jpg"}],
+            "links": [{"type": "image/png", "href": "https://example.com/link"}],
+            "content": [{"value": "https://example.com/body.png"}],
+            "summary_detail": {"value": "https://example.com/detail.png"},
+            "summary": "https://example.com/summary.png",
+        }
+        # the strategies are tried in order
+        expected = [
+            "https://example.com/content.jpg",
+            "https://example.com/thumbnail.jpg",
+            "https://example.com/link",
+            "https://example.com/body.png",
+            "https://example.com/detail.png",
+            "https://example.com/summary.png",
+        ]
+        for name, image in zip(ImageExtractor.STRATEGIES, expected):
+            self.assertEqual(extractor.extract(entry), image)
+            del entry[name]
+        self.assertIsNone(extractor.extract(entry))
+        self.assertIsNone(extractor.extract({}))
+
+    def test_extract_strategies(self):
+        entry = {
+            "media_content": [{"url": "https://example.com/content.jpg"}],
+            "summary": "https://example.com/summary.png",
+        }
+        custom = ImageExtractor(strategies=["summary", "media_content"])
+        self.assertEqual(custom.extract(entry), "https://example.com/summary.png")
+        custom = ImageExtractor(strategies=[lambda entry, scan: "CUSTOM"])
+        self.assertEqual(custom.extract(entry), "CUSTOM")
+
+    @mock.patch.object(ImageExtractor, "find_image_link")
+    def test_extract_scans_once(self, mock_find_image_link):
+        mock_find_image_link.return_value = None
+        text = "<p>no image here</p>"
+        ImageExtractor().extract(
+            {
+                "content": [{"value": text}],
+                "summary_detail": {"value": text},
+                "summary": text,
+            }
         )
-        self.assertIsNone(FeedItem.get_image_from_media_content(FeedItem, []))
-        self.assertIsNone(FeedItem.get_image_from_media_content(FeedItem, {}))
+        mock_find_image_link.assert_called_once_with(text)
 
-    @mock.patch.object(FeedItem, "find_image_link")
-    def test_get_image_from_summary_detail(self, mock_find_image_link):
-        mock_find_image_link.return_value = "IMAGE"
+    def test_from_media(self):
+        extractor = ImageExtractor()
         self.assertEqual(
-            FeedItem.get_image_from_summary_detail(FeedItem, {"value": ""}), "IMAGE"
+            extractor.from_media_content(
+                {"media_content": [{"url": "x"}, {"url": "https://a.com/b.gif"}]},
+                None,
+            ),
+            "https://a.com/b.gif",
         )
+        self.assertIsNone(extractor.from_media_content({"media_content": []}, None))
+        self.assertIsNone(extractor.from_media_thumbnail({"media_thumbnail": {}}, None))
 
-    @mock.patch.object(FeedItem, "find_image_link")
-    def test_get_image_from_summary(self, mock_find_image_link):
-        mock_find_image_link.return_value = "IMAGE"
-        self.assertEqual(FeedItem.get_image_from_summary(FeedItem, "summary"), "IMAGE")
+    def test_from_links(self):
+        self.assertEqual(
+            ImageExtractor().from_links(
+                {"links": [{"type": "text/html"}, {"type": "image/png", "href": "X"}]},
+                None,
+            ),
+            "X",
+        )
 
     def test_find_image_link(self):
         self.assertEqual(
-            FeedItem.find_image_link(
-                FeedItem,
+            ImageExtractor().find_image_link(
                 "This is a link -->https://example.com/test.PNG<-- This is a link",
             ),
             "https://example.com/test.PNG",
         )
         self.assertEqual(
-            FeedItem.find_image_link(
-                FeedItem,
+            ImageExtractor().find_image_link(
                 "This is a link -->https://example.com/test.png<-- This is a link",
             ),
             "https://example.com/test.png",
         )
         self.assertEqual(
-            FeedItem.find_image_link(
-                FeedItem,
+            ImageExtractor().find_image_link(
                 "This is a link -->https://example.com/test.jpg<-- This is a link",
             ),
             "https://example.com/test.jpg",
         )
         self.assertEqual(
-            FeedItem.find_image_link(
-                FeedItem,
+            ImageExtractor().find_image_link(
                 "This is a link -->https://example.com/test.jpeg<-- This is a link",
             ),
             "https://example.com/test.jpeg",
         )
         self.assertEqual(
-            FeedItem.find_image_link(
-                FeedItem,
+            ImageExtractor().find_image_link(
                 "This is a link -->https://example.com/test.tif<-- This is a link",
             ),
             "https://example.com/test.tif",
         )
         self.assertEqual(
-            FeedItem.find_image_link(
-                FeedItem,
+            ImageExtractor().find_image_link(
                 "This is a link -->https://example.com/test.webp<-- This is a link",
             ),
             "https://example.com/test.webp",
         )
         self.assertIsNone(
-            FeedItem.find_image_link(
-                FeedItem, "This is a NOT link -->NOT A LINK<-- This is NOT a link"
+            ImageExtractor().find_image_link(
+                "This is a NOT link -->NOT A LINK<-- This is NOT a link"
             )
         )
 
+    def test_find_image_link_html(self):
+        extractor = ImageExtractor()
+        # <img src> wins over earlier bare links and og:image
+        self.assertEqual(
+            extractor.find_image_link(
+                '<meta property="og:image" content="https://a.com/og">'
+                "<p>https://a.com/bare.png</p>"
+                '<img alt="x" src="https://a.com/img?w=300">'
+            ),
+            "https://a.com/img?w=300",
+        )
+        self.assertEqual(
+            extractor.find_image_link(
+                "<p>https://a.com/bare.png</p>"
+                "<meta name='twitter:image' content='https://a.com/tw'>"
+            ),
+            "https://a.com/tw",
+        )
+        # relative images are skipped
+        self.assertEqual(
+            extractor.find_image_link(
+                '<img src="/local.png"><a href="https://a.com/x.jpg">x</a>'
+            ),
+            "https://a.com/x.jpg",
+        )
+        self.assertIsNone(extractor.find_image_link(""))
+        self.assertIsNone(extractor.find_image_link("<p>https://a.com/page</p>"))
+
+    def test_find_image_link_pixel(self):
+        extractor = ImageExtractor()
+        self.assertIsNone(
+            extractor.find_image_link(
+                '<p>Text</p><img src="https://a.com/pixel.gif" width="1" height="1">'
+            )
+        )
+        self.assertEqual(
+            extractor.find_image_link(
+                '<img src="https://a.com/spacer" height=0><img src="https://a.com/x"'
+                ' width="10">'
+            ),
+            "https://a.com/x",
+        )
+        # feedburner adds a tracking pixel to the end of every entry
+        path = os.path.join(FIXTURES, "feeds", "feedburner.xml")
+        items = [FeedItem(e) for e in feedparser.parse(path).entries]
+        self.assertEqual(
+            [i.image for i in items],
+            [None, "https://blog.example.com/photos/stage.jpg"],
+        )
+
+
+class TestHtmlConverter(unittest.TestCase):
+    def test_convert(self):
+        converter = HtmlConverter()
+        self.assertEqual(converter.convert("<strong>Hi</strong>"), "**Hi**\n")
+
+    @mock.patch.object(HtmlConverter, "handle")
+    def test_convert_cache(self, mock_handle):
+        mock_handle.side_effect = lambda html: html.upper()
+        converter = HtmlConverter(cache_size=2)
+        self.assertEqual(converter.convert("a"), "A")
+        self.assertEqual(converter.convert("a"), "A")
+        self.assertEqual(mock_handle.call_count, 1)
+        converter.convert("b")
+        converter.convert("c")
+        self.assertEqual(list(converter.cache), ["b", "c"])
+        converter = HtmlConverter(cache_size=0)
+        converter.convert("a")
+        converter.convert("a")
+        self.assertEqual(converter.cache, {})
+
+    def test_convert_truncate(self):
+        converter = HtmlConverter(max_length=30)
+        html = "<p>first</p><p>second</p><p>third</p>"
+        self.assertEqual(converter.truncate(html), "<p>first</p><p>second</p>")
+        self.assertEqual(converter.convert(html), "first\n\nsecond\n\n[…]")
+        self.assertEqual(converter.truncate("x" * 40), "x" * 30)
+        unlimited = HtmlConverter(max_length=0)
+        self.assertEqual(unlimited.convert(html), "first\n\nsecond\n\nthird\n")
+
+
+class TestFeedItem(unittest.TestCase):
+    @mock.patch.object(FeedItem, "get_tags")
+    @mock.patch.object(FeedItem, "get_summary")
+    @mock.patch.object(FeedItem, "get_body")
+    @mock.patch.object(FeedItem, "get_image")
+    def test___init__(
+        self, mock_get_image, mock_get_body, mock_get_summary, mock_get_tags
+    ):
+        mock_get_image.return_value = "IMAGE"
+        mock_get_body.return_value = "BODY"
+        mock_get_summary.return_value = "SUMMARY"
+        item = FeedItem(
+            {"id": "ID", "title": "TITLE", "link": "LINK", "tags": ["tag"]},
+            category_tags=True,
+        )
+        self.assertFalse(item.posted)
+        self.assertEqual(item.guid, "ID")
+        self.assertEqual(item.image, "IMAGE")
+        self.assertEqual(item.title, "TITLE")
+        self.assertEqual(item.link, "LINK")
+        self.assertRegex(str(item.timestamp), r"[0-9]{10}")
+        self.assertEqual(item.body, "BODY")
+        self.assertEqual(item.summary, "SUMMARY")
+        self.assertEqual(item.tags, [])
+        mock_get_tags.assert_called_with(["tag"])
+
+    def test_get_id(self):
+        self.assertEqual(FeedItem.get_id(FeedItem, {"id": "ID"}), "ID")
+        self.assertEqual(
+            FeedItem.get_id(FeedItem, {"link": "LINK"}),
+            "e26ef19029cc92e234d9457823ca0811b92db9ce9dbf8db99c0fdd75d11338f0",
+        )
+
+    @mock.patch.object(FeedItem, "html2markdown")
+    def test_get_body(self, mock_html2markdown):
+        mock_html2markdown.return_value = "markdown\n"
+        self.assertIsNone(FeedItem.get_body(FeedItem, None))
+        body = FeedItem.get_body(FeedItem, ["test"])
+        self.assertEqual(body, "markdown")
+        mock_html2markdown.assert_called_with("test")
+
+    @mock.patch.object(ImageExtractor, "extract")
+    def test_get_image(self, mock_extract):
+        mock_extract.return_value = "IMAGE"
+        self.assertEqual(FeedItem.get_image(FeedItem, {"id": "ID"}), "IMAGE")
+        mock_extract.assert_called_with({"id": "ID"})
+
     @mock.patch.object(FeedItem, "html2markdown")
     def test_get_summary(self, mock_html2markdown):
         FeedItem.get_summary(FeedItem, "summary")
@@ -284,6 +758,19 @@ class TestFeedItem(unittest.TestCase):
             "Hello world!",
         )
 
+    def test_html2markdown_fixtures(self):
+        # posts shouldn't change when the conversion is reworked
+        for html_file in glob.glob(os.path.join(FIXTURES, "html", "*.html")):
+            with open(html_file) as fh:
+                html = fh.read()
+            with open(html_file[:-5] + ".md") as fh:
+                markdown = fh.read()
+            self.assertEqual(
+                FeedItem.html2markdown(FeedItem, {"type": "text/html", "value": html}),
+                markdown,
+                html_file,
+            )
+
     def test_sanitize_tag(self):
         self.assertEqual(FeedItem.sanitize_tag(FeedItem, "Hashtag. "), "#hashtag")
 
@@ -312,43 +799,125 @@ class TestFeedItem(unittest.TestCase):
         item.remove_tags(["hashtag"])
         self.assertEqual(item.tags, [])
 
+    def test_tags(self):
+        tags = Tags(["#b", "#a"])
+        tags.add("#c")
+        tags.add("#a")
+        self.assertEqual(list(tags), ["#b", "#a", "#c"])
+        self.assertEqual(tags, ["#b", "#a", "#c"])
+        self.assertIn("#c", tags)
+        tags.remove("#a")
+        self.assertNotIn("#a", tags)
+        self.assertEqual(len(tags), 2)
+        self.assertEqual(" ".join(tags), "#b #c")
+
+
+class SlowFeed(http.server.BaseHTTPRequestHandler):
+    """
+    serves a feed after server.delay seconds, server.chunks bytes of it every
+    50ms
+    """
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.end_headers()
+        for n in range(self.server.chunks):
+            self.wfile.write(b" ")
+            self.wfile.flush()
+            time.sleep(0.05)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInPod(http.server.BaseHTTPRequestHandler):
+    """
+    answers content API posts like a pod, recording each request
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    status = 201
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(
+            (self.path, dict(self.headers), urllib.parse.parse_qs(body.decode()))
+        )
+        self.server.clients.add(self.client_address)
+        response = json.dumps({"id": len(self.server.requests)}).encode()
+        self.send_response(self.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
 
 class TestPodClient(unittest.TestCase):
-    @mock.patch.object(PodClient, "connect")
-    @mock.patch("diaspy.connection")
-    def test___init__(self, mock_diaspy, mock_connect):
+    def start_pod(self, handler=StandInPod):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.requests = []
+        server.clients = set()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, "http://127.0.0.1:%s" % server.server_port
+
+    def test___init__(self):
         default = PodClient()
         self.assertIsNone(default.url)
-        self.assertIsNone(default.username)
-        self.assertIsNone(default.password)
-        mock_connect.assert_called()
-        custom = PodClient(url="https://example.com", username="user", password="pass")
-        self.assertEqual(custom.url, "https://example.com")
-        self.assertEqual(custom.username, "user")
-        self.assertEqual(custom.password, "pass")
-
-    @mock.patch("diaspy.connection", autospec=True)
-    def test_connect(self, mock_diaspy):
-        client = PodClient.__new__(PodClient)
-        client.url = "https://example.com"
-        client.username = "user"
-        client.password = "password"
-        self.assertIsInstance(client.connect(), diaspy.streams.Stream)
-        mock_diaspy.Connection.assert_called()
-
-    @mock.patch("diaspy.streams.Stream")
-    @mock.patch("diaspy.connection", autospec=True)
-    def test_post(self, mock_diaspy, mock_stream):
-        client = PodClient()
-        client.post("message")
-        client.stream.post.assert_called_with(
-            aspect_ids=["public"], provider_display_name=None, text="message"
-        )
-        client.post("message", aspect_ids=["1"], via="test")
-        client.stream.post.assert_called_with(
-            aspect_ids=["1"], provider_display_name="test", text="message"
+        self.assertIsNone(default.token)
+        self.assertEqual(default.backend, "api")
+        self.assertIsNone(default.session)
+        custom = PodClient(url="example.com", token="TOKEN", backend="shcli")
+        self.assertEqual(custom.url, "example.com")
+        self.assertEqual(custom.token, "TOKEN")
+        self.assertEqual(custom.backend, "shcli")
+
+    def test_get_api_url(self):
+        self.assertEqual(
+            PodClient(url="example.com").get_api_url(),
+            "https://example.com/api/content/",
+        )
+        self.assertEqual(
+            PodClient(url="http://127.0.0.1:8000/").get_api_url(),
+            "http://127.0.0.1:8000/api/content/",
         )
 
+    def test_post(self):
+        server, url = self.start_pod()
+        client = PodClient(url=url, token="TOKEN")
+        self.assertEqual(client.post("message"), {"id": 1})
+        self.assertEqual(client.post("another message"), {"id": 2})
+        path, headers, data = server.requests[0]
+        self.assertEqual(path, "/api/content/")
+        self.assertEqual(headers["Authorization"], "Token TOKEN")
+        self.assertIn("gzip", headers["Accept-Encoding"])
+        self.assertEqual(data, {"text": ["message"], "visibility": ["public"]})
+        # both posts went over the same connection
+        self.assertEqual(len(server.clients), 1)
+
+    def test_post_error(self):
+        class Throttled(StandInPod):
+            status = 429
+
+        server, url = self.start_pod(Throttled)
+        with self.assertRaises(requests.HTTPError):
+            PodClient(url=url, token="TOKEN").post("message")
+
+    @mock.patch("shcli.create")
+    def test_post_shcli(self, mock_create):
+        mock_create.return_value = {"id": 1}
+        client = PodClient(url="example.com", token="TOKEN", backend="shcli")
+        self.assertEqual(client.post("message"), {"id": 1})
+        mock_create.assert_called_with("example.com", "TOKEN", "message", "public")
+        self.assertIsNone(client.session)
+
     def test_format_post(self):
         content = {
             "title": "TITLE",
@@ -404,16 +973,156 @@ class TestPodClient(unittest.TestCase):
                 self.aspect_id = ["public"]
 
         mock_format_post.return_value = "POST"
-        self.assertTrue(PodClient.publish(PodClient, "content", Args()))
+        content = {"rendered": None, "compression": TEXT_PLAIN}
+        self.assertTrue(PodClient.publish(PodClient, content, Args()))
         mock_format_post.assert_called_with(
-            "content",
+            content,
             body=False,
             embed_image=False,
             no_branding=False,
             post_raw_link=False,
             summary="SUMMARY",
         )
-        mock_post.assert_called_with("POST", aspect_ids=["public"], via="VIA")
+        mock_post.assert_called_with("POST", via="VIA")
+        # a post rendered at ingest is sent as it is
+        mock_format_post.reset_mock()
+        content = {"rendered": "RENDERED", "compression": TEXT_PLAIN}
+        self.assertTrue(PodClient.publish(PodClient, content, Args()))
+        mock_format_post.assert_not_called()
+        mock_post.assert_called_with("RENDERED", via="VIA")
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_acquire_unlimited(self):
+        bucket = TokenBucket()
+        start = time.monotonic()
+        for i in range(1000):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_acquire(self):
+        bucket = TokenBucket(rate=50, burst=3)
+        start = time.monotonic()
+        # the burst goes through at once, the rest at 50 per second
+        for i in range(3):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.01)
+        for i in range(5):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_contains(self):
+        bloom = BloomFilter(1000, error_rate=0.001)
+        keys = [seen_key("FEED_ID", n) for n in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            self.assertIn(key, bloom)
+        others = [seen_key("OTHER_FEED_ID", n) for n in range(10000)]
+        false_positives = len([k for k in others if k in bloom])
+        self.assertLess(false_positives, 40)
+        # about 1.8 bytes per key at 0.1%
+        self.assertLess(len(bloom.bits), 1800)
+
+    def test_from_db(self):
+        conn = connect_db(":memory:")
+        conn.executemany(
+            "INSERT INTO seen_items(key) VALUES(?)",
+            [(seen_key("FEED_ID", n),) for n in range(100)],
+        )
+        bloom = BloomFilter.from_db(conn)
+        self.assertGreaterEqual(bloom.capacity, 200)
+        for n in range(100):
+            self.assertIn(seen_key("FEED_ID", n), bloom)
+        self.assertNotIn(seen_key("FEED_ID", 100), bloom)
+
+    def test_seen_key(self):
+        self.assertEqual(len(seen_key("FEED_ID", "https://example.com/1")), 12)
+        self.assertEqual(seen_key("A", "B"), seen_key("A", "B"))
+        self.assertNotEqual(seen_key("A", "B"), seen_key("B", "A"))
+
+
+class TestMetrics(unittest.TestCase):
+    def metrics(self):
+        metrics = Metrics()
+        metrics.inc("posts_total", "FEED_ID", result="published")
+        metrics.inc("posts_total", "FEED_ID", 2, result="published")
+        metrics.inc("posts_total", "FEED_ID", result="failed")
+        metrics.inc("fetch_bytes_total", "OTHER_FEED_ID", 1234)
+        metrics.observe("fetch_seconds", "FEED_ID", 0.2)
+        metrics.observe("fetch_seconds", "FEED_ID", 100)
+        return metrics
+
+    def test_summary(self):
+        summary = self.metrics().summary()
+        self.assertEqual(
+            summary["feeds"],
+            {
+                "FEED_ID": {
+                    "fetch_seconds": {"count": 2, "sum": 100.2},
+                    "posts_total": {"failed": 1, "published": 3},
+                },
+                "OTHER_FEED_ID": {"fetch_bytes_total": 1234},
+            },
+        )
+        self.assertLessEqual(summary["started"], summary["time"])
+
+    def test_timer(self):
+        metrics = Metrics()
+        with self.assertRaises(IOError):
+            with metrics.timer("publish_seconds", "FEED_ID"):
+                raise IOError("down")
+        self.assertEqual(
+            metrics.summary()["feeds"]["FEED_ID"]["publish_seconds"]["count"], 1
+        )
+
+    def test_prometheus(self):
+        text = self.metrics().prometheus()
+        self.assertIn("# TYPE sh_feeder_posts_total counter\n", text)
+        self.assertIn(
+            'sh_feeder_posts_total{feed_id="FEED_ID",result="published"} 3\n', text
+        )
+        self.assertIn(
+            'sh_feeder_fetch_bytes_total{feed_id="OTHER_FEED_ID"} 1234\n', text
+        )
+        self.assertIn("# TYPE sh_feeder_fetch_seconds histogram\n", text)
+        # the buckets are cumulative
+        self.assertIn(
+            'sh_feeder_fetch_seconds_bucket{feed_id="FEED_ID",le="0.1"} 0\n', text
+        )
+        self.assertIn(
+            'sh_feeder_fetch_seconds_bucket{feed_id="FEED_ID",le="0.5"} 1\n', text
+        )
+        self.assertIn(
+            'sh_feeder_fetch_seconds_bucket{feed_id="FEED_ID",le="+Inf"} 2\n', text
+        )
+        self.assertIn('sh_feeder_fetch_seconds_count{feed_id="FEED_ID"} 2\n', text)
+        # label values are escaped
+        metrics = Metrics()
+        metrics.inc("errors_total", 'a "b"\\c', stage="fetch")
+        self.assertIn(
+            'sh_feeder_errors_total{feed_id="a \\"b\\"\\\\c",stage="fetch"} 1',
+            metrics.prometheus(),
+        )
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            prom = os.path.join(directory, "sh_feeder.prom")
+            summary = os.path.join(directory, "summary.json")
+            metrics = self.metrics()
+            metrics.write_prometheus(prom)
+            metrics.write_json(summary)
+            with open(prom) as fh:
+                self.assertEqual(fh.read(), metrics.prometheus())
+            with open(summary) as fh:
+                self.assertEqual(json.load(fh)["feeds"], metrics.summary()["feeds"])
+            # readable by node_exporter, and no temporary files left over
+            self.assertEqual(os.stat(prom).st_mode & 0o777, 0o644)
+            self.assertEqual(
+                sorted(os.listdir(directory)), ["sh_feeder.prom", "summary.json"]
+            )
 
 
 class FunctionsTestCase(unittest.TestCase):
@@ -434,15 +1143,85 @@ class FunctionsTestCase(unittest.TestCase):
                 (8, "posted", "INTEGER(1)", 0, None, 0),
                 (9, "body", "VARCHAR(10240)", 0, None, 0),
                 (10, "summary", "VARCHAR(2048)", 0, None, 0),
+                (11, "attempts", "INTEGER", 0, "0", 0),
+                (12, "last_error", "VARCHAR(1024)", 0, None, 0),
+                (13, "next_attempt_at", "INTEGER(10)", 0, "0", 0),
+                (14, "simhash", "INTEGER", 0, None, 0),
+                (15, "rendered", "TEXT", 0, None, 0),
+                (16, "compression", "INTEGER", 0, "0", 0),
             ],
         )
 
     def test_alter_db(self):
         conn = sqlite3.connect(":memory:")
-        conn.execute("CREATE TABLE feeds(guid VARCHAR(255) PRIMARY KEY)")
+        # a v1 database
+        conn.execute("CREATE TABLE feeds(guid VARCHAR(255) PRIMARY KEY, \
+            feed_id VARCHAR(127), title VARCHAR(255), link VARCHAR(255), \
+            image VARCHAR(255), image_title VARCHAR(255), \
+            hashtags VARCHAR(255), timestamp INTEGER(10), posted INTEGER(1), \
+            body VARCHAR(10240))")
+        conn.execute("INSERT INTO feeds(guid, feed_id) VALUES('GUID', 'FEED_ID')")
+        alter_db(conn)
         self.assertEqual(
-            conn.execute("PRAGMA table_info('feeds')").fetchall(),
-            [(0, "guid", "VARCHAR(255)", 0, None, 1)],
+            conn.execute("SELECT key FROM seen_items").fetchall(),
+            [(seen_key("FEED_ID", "GUID"),)],
+        )
+        self.assertEqual(
+            [r[1] for r in conn.execute("PRAGMA table_info('feeds')")][-7:],
+            [
+                "summary",
+                "attempts",
+                "last_error",
+                "next_attempt_at",
+                "simhash",
+                "rendered",
+                "compression",
+            ],
+        )
+        self.assertEqual(
+            conn.execute("SELECT attempts, next_attempt_at FROM feeds").fetchone(),
+            (0, 0),
+        )
+        self.assertEqual(
+            conn.execute("PRAGMA user_version").fetchone()[0], len(MIGRATIONS)
+        )
+        # the publish queue query uses the index
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT guid FROM feeds WHERE feed_id == ? \
+            AND posted == 0 AND timestamp > ? \
+            AND NOT EXISTS (SELECT 1 FROM feeds AS waiting \
+            WHERE waiting.feed_id == feeds.feed_id AND waiting.posted == 0 \
+            AND waiting.timestamp > ? AND waiting.timestamp <= feeds.timestamp \
+            AND waiting.next_attempt_at > ?) ORDER BY timestamp",
+            ("FEED_ID", 0, 0, 0),
+        ).fetchall()
+        self.assertIn("USING INDEX feeds_queue", plan[0][3])
+        self.assertIn("USING INDEX feeds_queue", plan[-1][3])
+        # nothing left to do the second time
+        alter_db(conn)
+        self.assertEqual(
+            conn.execute("PRAGMA user_version").fetchone()[0], len(MIGRATIONS)
+        )
+
+    def test_alter_db_rollback(self):
+        def broken(conn):
+            conn.execute("CREATE TABLE broken(id INTEGER)")
+            raise sqlite3.OperationalError("broken")
+
+        conn = connect_db(":memory:")
+        with mock.patch.object(
+            sys.modules[alter_db.__module__], "MIGRATIONS", MIGRATIONS + [broken]
+        ):
+            with self.assertRaises(sqlite3.OperationalError):
+                alter_db(conn)
+        self.assertEqual(
+            conn.execute("PRAGMA user_version").fetchone()[0], len(MIGRATIONS)
+        )
+        self.assertEqual(
+            conn.execute(
+                "SELECT name FROM sqlite_master WHERE name = 'broken'"
+            ).fetchall(),
+            [],
         )
 
     @mock.patch("os.path")
@@ -450,7 +1229,7 @@ class FunctionsTestCase(unittest.TestCase):
         mock_path.isfile.return_value = False
         self.assertIsInstance(connect_db(":memory:"), sqlite3.Connection)
 
-    @mock.patch("pod_feeder_v2.pod_feeder.PodClient")
+    @mock.patch("sh_feeder.sh_feeder.PodClient")
     def test_publish_items(self, mock_client):
         class Args:
             def __init__(self):
@@ -458,6 +1237,8 @@ class FunctionsTestCase(unittest.TestCase):
                 self.limit = 1
                 self.timeout = 1
                 self.quiet = True
+                self.duplicate_window = 0
+                self.render_at_ingest = False
 
         mock_client.publish.return_value = True
         client = mock_client()
@@ -488,3 +1269,453 @@ class FunctionsTestCase(unittest.TestCase):
         ).fetchone()
         self.assertEqual(row["guid"], "GUID")
         client.publish.assert_called()
+
+    ARGS = "--feed-id FEED_ID --feed-url URL --pod-url POD --token TOKEN".split()
+
+    def queue(self, count):
+        conn = connect_db(":memory:")
+        for n in range(count):
+            conn.execute(
+                "INSERT INTO feeds(guid, feed_id, title, body, summary, link, \
+                image, image_title, hashtags, posted, timestamp) \
+                VALUES(?, 'FEED_ID', '', '', '', '', '', '', '', 0, ?)",
+                ("GUID%s" % n, time.time() - 10 + n),
+            )
+        return conn
+
+    def test_connect_db_wal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            conn = connect_db(os.path.join(directory, "feed.db"))
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+            self.assertEqual(
+                conn.execute("PRAGMA user_version").fetchone()[0], len(MIGRATIONS)
+            )
+            conn.close()
+            conn = connect_db(os.path.join(directory, "feed.db"), wal=False)
+            conn.execute("PRAGMA journal_mode = DELETE")
+            conn.close()
+            conn = connect_db(os.path.join(directory, "feed.db"), wal=False)
+            self.assertEqual(
+                conn.execute("PRAGMA journal_mode").fetchone()[0], "delete"
+            )
+            conn.close()
+
+    def test_retry_locked(self):
+        db = mock.Mock()
+        func = mock.Mock(
+            side_effect=[sqlite3.OperationalError("database is locked"), "OK"]
+        )
+        with mock.patch("time.sleep") as mock_sleep:
+            self.assertEqual(retry_locked(db, func, 1, 2), "OK")
+        func.assert_called_with(1, 2)
+        db.rollback.assert_called_once()
+        mock_sleep.assert_called_once()
+        # other errors aren't retried
+        func = mock.Mock(side_effect=sqlite3.OperationalError("no such table"))
+        with self.assertRaises(sqlite3.OperationalError):
+            retry_locked(db, func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_claim_feed(self):
+        conn = connect_db(":memory:")
+        self.assertTrue(claim_feed(conn, "FEED_ID", "a"))
+        self.assertFalse(claim_feed(conn, "FEED_ID", "b"))
+        # renewing
+        self.assertTrue(claim_feed(conn, "FEED_ID", "a"))
+        self.assertTrue(claim_feed(conn, "OTHER_FEED_ID", "b"))
+        release_feed(conn, "FEED_ID", "b")
+        self.assertFalse(claim_feed(conn, "FEED_ID", "b"))
+        release_feed(conn, "FEED_ID", "a")
+        self.assertTrue(claim_feed(conn, "FEED_ID", "b"))
+        # expired leases can be taken over
+        conn.execute("UPDATE publish_leases SET expires = 0")
+        self.assertTrue(claim_feed(conn, "FEED_ID", "a"))
+
+    def test_publish_items_claimed(self):
+        args = parse_args(self.ARGS + ["--quiet"])
+        client = mock.Mock()
+        conn = self.queue(2)
+        claim_feed(conn, "FEED_ID", "another process")
+        self.assertEqual(publish_items(conn, client, args), 0)
+        client.publish.assert_not_called()
+
+    def test_retry_delay(self):
+        self.assertEqual(retry_delay(1), 300)
+        self.assertEqual(retry_delay(2), 600)
+        self.assertEqual(retry_delay(4, delay=1), 480)
+        self.assertEqual(retry_delay(20), 720 * 60)
+
+    def test_mark_failed(self):
+        args = parse_args(self.ARGS + ["--max-attempts", "2"])
+        conn = self.queue(2)
+        row = queued_items(conn, args)[0]
+        self.assertFalse(mark_failed(conn, args, row, IOError("down")))
+        rows = conn.execute("SELECT * FROM feeds ORDER BY timestamp").fetchall()
+        self.assertEqual(rows[0]["attempts"], 1)
+        self.assertEqual(rows[0]["last_error"], "down")
+        self.assertEqual(rows[0]["posted"], 0)
+        self.assertGreaterEqual(rows[0]["next_attempt_at"], time.time() + 299)
+        # the rest of the feed waits for the failed item
+        self.assertEqual(rows[1]["attempts"], 0)
+        self.assertEqual(rows[1]["next_attempt_at"], rows[0]["next_attempt_at"])
+        self.assertEqual(queued_items(conn, args), [])
+        # the second failure is the last one
+        conn.execute("UPDATE feeds SET next_attempt_at = 0")
+        row = queued_items(conn, args)[0]
+        self.assertTrue(mark_failed(conn, args, row, "down"))
+        self.assertEqual(
+            conn.execute(
+                "SELECT posted, attempts FROM feeds WHERE guid = 'GUID0'"
+            ).fetchone()[:],
+            (-1, 2),
+        )
+        self.assertEqual([r["guid"] for r in queued_items(conn, args)], ["GUID1"])
+
+    def test_mark_failed_new_items(self):
+        args = parse_args(self.ARGS + ["--quiet"])
+        client = mock.Mock()
+        client.publish.side_effect = [IOError("down"), True, True]
+        conn = self.queue(1)
+        self.assertEqual(publish_items(conn, client, args), 0)
+        # an item loaded during the backoff waits for the failed one
+        conn.execute(
+            "INSERT INTO feeds(guid, feed_id, title, body, summary, link, \
+            image, image_title, hashtags, posted, timestamp) \
+            VALUES('NEW', 'FEED_ID', '', '', '', '', '', '', '', 0, ?)",
+            (time.time(),),
+        )
+        self.assertEqual(queued_items(conn, args), [])
+        self.assertEqual(publish_items(conn, client, args), 0)
+        conn.execute("UPDATE feeds SET next_attempt_at = 0 WHERE guid = 'GUID0'")
+        self.assertEqual(publish_items(conn, client, args), 2)
+        posted = [c.args[0]["guid"] for c in client.publish.call_args_list]
+        self.assertEqual(posted, ["GUID0", "GUID0", "NEW"])
+
+    def test_publish_items_failure(self):
+        args = parse_args(self.ARGS + ["--quiet"])
+        client = mock.Mock()
+        client.publish.side_effect = [True, IOError("down"), True]
+        conn = self.queue(3)
+        self.assertEqual(publish_items(conn, client, args), 1)
+        self.assertEqual(client.publish.call_count, 2)
+        rows = conn.execute("SELECT * FROM feeds ORDER BY timestamp").fetchall()
+        self.assertEqual([r["posted"] for r in rows], [1, 0, 0])
+        self.assertEqual(rows[1]["last_error"], "down")
+
+    def test_publish_items_metrics(self):
+        args = parse_args(self.ARGS + ["--quiet", "--max-attempts", "2"])
+        client = mock.Mock()
+        client.publish.side_effect = [True, IOError("down"), IOError("down")]
+        conn = self.queue(3)
+        metrics = Metrics()
+        with mock.patch("sh_feeder.sh_feeder.METRICS", metrics):
+            publish_items(conn, client, args)
+            conn.execute("UPDATE feeds SET next_attempt_at = 0")
+            publish_items(conn, client, args)
+        stats = metrics.summary()["feeds"]["FEED_ID"]
+        self.assertEqual(stats["posts_total"], {"published": 1, "failed": 2})
+        self.assertEqual(stats["publish_retries_total"], 1)
+        self.assertEqual(stats["dead_letters_total"], 1)
+        self.assertEqual(stats["publish_seconds"]["count"], 3)
+
+    def test_record_fetch(self):
+        metrics = Metrics()
+        with mock.patch("sh_feeder.sh_feeder.METRICS", metrics):
+            record_fetch(
+                "FEED_ID",
+                {"status": 200, "length": 2048, "elapsed": 0.5, "parse_time": 0.2},
+            )
+            record_fetch("FEED_ID", {"status": 304, "elapsed": 0.1})
+        stats = metrics.summary()["feeds"]["FEED_ID"]
+        self.assertEqual(stats["fetch_bytes_total"], 2048)
+        self.assertEqual(stats["fetch_responses_total"], {"200": 1, "304": 1})
+        self.assertEqual(stats["fetch_seconds"], {"count": 2, "sum": 0.4})
+        self.assertEqual(stats["parse_seconds"], {"count": 1, "sum": 0.2})
+
+    @mock.patch("sh_feeder.sh_feeder.download_feed")
+    @mock.patch("sh_feeder.sh_feeder.PodClient")
+    def test_process_feed_unreachable(self, mock_client, mock_download_feed):
+        mock_client.return_value.publish.return_value = True
+        mock_download_feed.side_effect = urllib.error.HTTPError(
+            "URL", 503, "Service Unavailable", {}, None
+        )
+        args = parse_args(self.ARGS + ["--quiet"])
+        conn = self.queue(1)
+        metrics = Metrics()
+        with mock.patch("sh_feeder.sh_feeder.METRICS", metrics):
+            # the queue is still published while the feed is down
+            self.assertEqual(process_feed(conn, args), (0, 1))
+        stats = metrics.summary()["feeds"]["FEED_ID"]
+        self.assertEqual(stats["errors_total"], {"fetch": 1})
+        self.assertEqual(stats["fetch_responses_total"], {"503": 1})
+
+    @mock.patch("sh_feeder.sh_feeder.PodClient")
+    def test_process_feed_malformed(self, mock_client):
+        mock_client.return_value.publish.return_value = True
+        with open(os.path.join(FIXTURES, "feeds", "rss.xml"), "rb") as fh:
+            xml = fh.read()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "truncated.xml")
+            with open(path, "wb") as fh:
+                fh.write(xml[: xml.index(b"<title>Photo of the day")])
+            args = parse_args(
+                "--feed-id FEED_ID --pod-url POD --token TOKEN --quiet --streaming \
+                --feed-url".split() + [path]
+            )
+            conn = self.queue(1)
+            metrics = Metrics()
+            with mock.patch("sh_feeder.sh_feeder.METRICS", metrics):
+                # the queue is still published
+                self.assertEqual(process_feed(conn, args), (0, 1))
+        stats = metrics.summary()["feeds"]["FEED_ID"]
+        self.assertEqual(stats["errors_total"], {"parse": 1})
+        self.assertIsNone(get_feed_state(conn, "FEED_ID"))
+
+    @mock.patch("sh_feeder.sh_feeder.Feed")
+    @mock.patch("sh_feeder.sh_feeder.PodClient")
+    def test_process_feed_publish_only(self, mock_client, mock_feed):
+        mock_client.return_value.publish.return_value = True
+        args = parse_args(self.ARGS + ["--quiet", "--publish-only"])
+        conn = self.queue(2)
+        self.assertEqual(process_feed(conn, args), (0, 2))
+        # the feed isn't fetched
+        mock_feed.assert_not_called()
+        self.assertIsNone(get_feed_state(conn, "FEED_ID"))
+        with self.assertRaises(SystemExit), mock.patch("sys.stderr"):
+            parse_args(self.ARGS[:-2] + ["--fetch-only", "--publish-only"])
+
+    @mock.patch.object(PodClient, "post")
+    def test_render_at_ingest(self, mock_post):
+        args = parse_args(
+            self.ARGS + ["--quiet", "--render-at-ingest", "--summary", "--no-branding"]
+        )
+        conn = self.queue(1)
+        entries = [
+            {"id": "A", "title": "A", "link": "https://example.com/a"},
+            {"id": "B", "title": "B"},
+        ]
+        with mock.patch.object(FeedItem, "get_summary", return_value="SUMMARY"):
+            self.assertEqual(ingest_feed(conn, args, parsed={"entries": entries}), 2)
+        rendered = dict(conn.execute("SELECT guid, rendered FROM feeds").fetchall())
+        self.assertEqual(
+            rendered,
+            {
+                "GUID0": None,
+                "A": "### [A](https://example.com/a)\n\nSUMMARY\n\n",
+                # without a link there is nothing to render
+                "B": None,
+            },
+        )
+        # the items queued before are rendered when they are published
+        self.assertEqual(render_queued(conn, args), 1)
+        row = queued_items(conn, args)[0]
+        self.assertEqual(
+            row.keys(), ["guid", "rendered", "compression", "attempts", "simhash"]
+        )
+        self.assertEqual(row["rendered"], "### []()\n\n\n\n")
+        client = PodClient(url="POD", token="TOKEN")
+        self.assertEqual(publish_items(conn, client, args), 2)
+        mock_post.assert_called_with(rendered["A"], via=args.via)
+        # B fails like it would have without --render-at-ingest
+        self.assertEqual(
+            conn.execute(
+                "SELECT posted, attempts FROM feeds WHERE guid = 'B'"
+            ).fetchone()[:],
+            (0, 1),
+        )
+
+    @mock.patch.object(PodClient, "post")
+    def test_compress(self, mock_post):
+        args = parse_args(self.ARGS + ["--quiet", "--compress", "--full"])
+        conn = self.queue(1)
+        entries = [
+            {"id": "A", "title": "A", "link": "L"},
+            {"id": "B", "title": "B", "link": "L"},
+        ]
+        text = " ".join("word%s" % n for n in range(200))
+        bodies = [text, "SHORT"]
+        with mock.patch.object(FeedItem, "get_body", side_effect=bodies):
+            self.assertEqual(ingest_feed(conn, args, parsed={"entries": entries}), 2)
+        rows = conn.execute(
+            "SELECT guid, compression, typeof(body), length(body) FROM feeds \
+            ORDER BY timestamp"
+        ).fetchall()
+        self.assertEqual([tuple(r)[:3] for r in rows[1:]], [
+            ("A", TEXT_ZLIB, "blob"),
+            ("B", TEXT_PLAIN, "text"),
+        ])  # fmt: skip
+        self.assertLess(rows[1][3], len(text) / 2)
+        row = queued_items(conn, args)[1]
+        self.assertEqual(decompress_item(row)["body"], text)
+        # the old plain text rows are published along with the compressed ones
+        client = PodClient(url="POD", token="TOKEN")
+        self.assertEqual(publish_items(conn, client, args), 3)
+        self.assertIn(text, mock_post.call_args_list[1].args[0])
+        self.assertIn("SHORT", mock_post.call_args_list[2].args[0])
+        # and so are posts rendered at ingest
+        args = parse_args(
+            self.ARGS + ["--quiet", "--compress", "--render-at-ingest", "--full"]
+        )
+        entries = [{"id": "C", "title": "C", "link": "L"}]
+        with mock.patch.object(FeedItem, "get_body", return_value=text):
+            ingest_feed(conn, args, parsed={"entries": entries})
+        self.assertEqual(
+            conn.execute(
+                "SELECT typeof(rendered) FROM feeds WHERE guid = 'C'"
+            ).fetchone()[0],
+            "blob",
+        )
+        self.assertEqual(publish_items(conn, client, args), 1)
+        self.assertIn(text, mock_post.call_args.args[0])
+
+    def test_lazy_imports(self):
+        # importing the module is cheap, the stages import what they need
+        code = "import sys, sh_feeder.sh_feeder; print(' '.join(sorted(sys.modules)))"
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            stdout=subprocess.PIPE,
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.decode()
+        modules = output.split()
+        self.assertIn("sh_feeder.sh_feeder", modules)
+        for module in ("diaspy", "feedparser", "html2text", "requests", "shcli"):
+            self.assertNotIn(module, modules)
+
+    # an article, the same one with a word changed, and another article
+    TEXT = " ".join("word%s" % n for n in range(300))
+    EDITED = TEXT.replace("word150", "changed")
+    OTHER = " ".join("word%s" % n for n in range(200, 500))
+
+    def test_simhash(self):
+        fingerprint = simhash(self.TEXT)
+        self.assertEqual(simhash(self.TEXT.upper()), fingerprint)
+        self.assertLessEqual(
+            simhash_distance(simhash(self.EDITED), fingerprint),
+            SIMHASH_DISTANCE,
+        )
+        self.assertGreater(
+            simhash_distance(simhash(self.OTHER), fingerprint),
+            SIMHASH_DISTANCE,
+        )
+        self.assertIsNone(simhash("too short"))
+        # signed, like sqlite stores it
+        self.assertTrue(-(2**63) <= fingerprint < 2**63)
+        self.assertEqual(len(set(b >> 16 for b in simhash_bands(fingerprint))), 4)
+
+    def duplicates(self):
+        conn = connect_db(":memory:")
+        for feed_id, title, text in (
+            ("FEED_ID", "TITLE", self.TEXT),
+            ("OTHER_FEED_ID", "TITLE", self.EDITED),
+            ("OTHER_FEED_ID", "OTHER TITLE", self.OTHER),
+        ):
+            feed = Feed(feed_id=feed_id, parsed={"entries": []})
+            feed.items = [FeedItem({"id": feed_id + title, "title": title})]
+            feed.items[0].body = text
+            feed.items[0].simhash = simhash("%s\n%s" % (title, text))
+            feed.load_db(conn)
+        return conn
+
+    def test_find_duplicate(self):
+        conn = self.duplicates()
+        fingerprint = simhash("TITLE\n" + self.TEXT)
+        self.assertEqual(
+            conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0], 12
+        )
+        # only posted items count
+        self.assertIsNone(find_duplicate(conn, "FEED_ID", fingerprint, 1))
+        conn.execute("UPDATE feeds SET posted = 1")
+        self.assertEqual(
+            find_duplicate(conn, "FEED_ID", fingerprint, 1), "OTHER_FEED_IDTITLE"
+        )
+        self.assertIsNone(find_duplicate(conn, "OTHER_FEED_ID", None, 1))
+        # not the feed's own items, or items older than the window
+        conn.execute("UPDATE feeds SET timestamp = timestamp - 7200")
+        self.assertIsNone(find_duplicate(conn, "FEED_ID", fingerprint, 1))
+        self.assertIsNone(
+            find_duplicate(
+                conn,
+                "OTHER_FEED_ID",
+                fingerprint,
+                1,
+                [("A", "OTHER_FEED_ID", fingerprint)],
+            )
+        )
+        self.assertEqual(
+            find_duplicate(
+                conn, "OTHER_FEED_ID", fingerprint, 1, [("A", "FEED_ID", fingerprint)]
+            ),
+            "A",
+        )
+
+    def test_publish_items_duplicate(self):
+        conn = self.duplicates()
+        conn.execute("UPDATE feeds SET posted = 1 WHERE guid = 'FEED_IDTITLE'")
+        client = mock.Mock()
+        client.publish.return_value = True
+        args = parse_args(
+            "--feed-id OTHER_FEED_ID --feed-url URL --pod-url POD --token TOKEN \
+            --quiet".split()
+        )
+        self.assertEqual(publish_items(conn, client, args), 2)
+        args.duplicate_window = 1
+        conn.execute("UPDATE feeds SET posted = 0 WHERE feed_id = 'OTHER_FEED_ID'")
+        self.assertEqual(publish_items(conn, client, args), 1)
+        self.assertEqual(
+            [
+                tuple(r)
+                for r in conn.execute("SELECT guid, posted FROM feeds ORDER BY guid")
+            ],
+            [
+                ("FEED_IDTITLE", 1),
+                ("OTHER_FEED_IDOTHER TITLE", 1),
+                ("OTHER_FEED_IDTITLE", 2),
+            ],
+        )
+
+    def test_feed_hints(self):
+        self.assertEqual(feed_hints({}), (0, []))
+        self.assertEqual(feed_hints({"ttl": "60"}), (3600, []))
+        self.assertEqual(
+            feed_hints({"sy_updateperiod": "hourly", "sy_updatefrequency": "4"}),
+            (900, []),
+        )
+        self.assertEqual(
+            feed_hints({"ttl": "10", "sy_updateperiod": "Daily "}), (86400, [])
+        )
+        self.assertEqual(
+            feed_hints({"ttl": "soon", "skip_hours": ["23", "1", "24", "x", "1"]}),
+            (0, [1, 23]),
+        )
+
+    def test_next_poll(self):
+        def state(**values):
+            state = dict.fromkeys(
+                ("last_update", "update_interval", "hint_wait", "skip_hours")
+            )
+            state.update(values)
+            return state
+
+        now = 1700000000 - 1700000000 % 86400
+        self.assertEqual(next_poll(None, now=now), now + 3600)
+        self.assertEqual(next_poll(state(), 600, now=now), now + 600)
+        # every two hours on average: fetch every hour
+        learned = state(last_update=now - 600, update_interval=7200)
+        self.assertEqual(next_poll(learned, now=now), now + 3600)
+        self.assertEqual(next_poll(learned, adaptive=False, now=now), now + 3600)
+        self.assertEqual(next_poll(learned, 600, adaptive=False, now=now), now + 600)
+        # quiet for a day
+        quiet = state(last_update=now - 86400, update_interval=7200)
+        self.assertEqual(next_poll(quiet, now=now), now + 43200)
+        self.assertEqual(next_poll(quiet, max_interval=7200, now=now), now + 7200)
+        busy = state(last_update=now - 60, update_interval=120)
+        self.assertEqual(next_poll(busy, now=now), now + 300)
+        self.assertEqual(next_poll(busy, min_interval=60, now=now), now + 60)
+        # the feed's own hints
+        busy["hint_wait"] = 1800
+        self.assertEqual(next_poll(busy, now=now), now + 1800)
+        self.assertEqual(next_poll(busy, max_interval=600, now=now), now + 600)
+        busy["skip_hours"] = "0,1"
+        self.assertEqual(next_poll(busy, now=now), now + 7200)